@@ -262,10 +262,14 @@ _image_build_opts="-b --bind --build-arg -f --file --force
 _image_modify_opts="-c -S --shell"
 
 _image_common_opts="-a --arch --always-download --auth --break
-                    --cache --cache-large --dependencies -h --help
+                    --cache --cache-large --dependencies --dlcache-max
+                    --download-jobs
+                    -h --help --mirror
                     --no-cache --no-lock --no-xattrs --profile
-                    --rebuild --password-many -q --quiet -s --storage
-                    --tls-no-verify -v --verbose --version --xattrs"
+                    --rebuild --password-many -q --quiet
+                    --retries --retry-delay -s --storage
+                    --tls-no-verify --unpack-backend --unpack-jobs
+                    --unpack-snapshots -v --verbose --version --xattrs"
 
 _image_subcommands="build build-cache delete gestalt import
                     list modify pull push reset undelete"
@@ -320,8 +324,8 @@ _ch_image_complete () {
         compopt -o nospace
         return 0
         ;;
-    --cache-large)
-        # This is just a user-specified number. Can’t autocomplete
+    --cache-large|--dlcache-max|--download-jobs|--mirror|--retries|--retry-delay|--unpack-jobs|--unpack-snapshots)
+        # This is just a user-specified value. Can’t autocomplete
         COMPREPLY=()
         return 0
         ;;
@@ -334,6 +338,10 @@ _ch_image_complete () {
         fi
         return 0
         ;;
+    --unpack-backend)
+        COMPREPLY=( $(compgen -W "python tar" -- "$cur") )
+        return 0
+        ;;
     esac
 
     case "$sub_cmd" in
@@ -400,7 +408,7 @@ _ch_image_complete () {
         __ltrim_colon_completions "$cur"
         ;;
     gestalt)
-        COMPREPLY=( $(compgen -W "bucache bucache-dot python-path
+        COMPREPLY=( $(compgen -W "bucache bucache-dot dlcache python-path
                                   storage-path" -- "$cur") )
         ;;
     import)
@@ -416,7 +424,18 @@ _ch_image_complete () {
             COMPREPLY=( $(compgen -d -S / -- "$cur") )
             return 0
         fi
-        COMPREPLY=( $(compgen -W "$(_ch_list_images "$strg_dir") --image" -- "$cur") )
+        if [[ "$prev" == "--chunk-size" || "$prev" == "--mount-from" || "$prev" == "--upload-jobs" ]]; then
+            return 0
+        fi
+        if [[ "$prev" == "--compression" ]]; then
+            COMPREPLY=( $(compgen -W "gzip zstd" -- "$cur") )
+            return 0
+        fi
+        if [[ "$prev" == "--layers" ]]; then
+            COMPREPLY=( $(compgen -W "flat base" -- "$cur") )
+            return 0
+        fi
+        COMPREPLY=( $(compgen -W "$(_ch_list_images "$strg_dir") --chunk-size --compression --image --layers --mount-from --stream --upload-jobs" -- "$cur") )
         __ltrim_colon_completions "$cur"
         ;;
     undelete)
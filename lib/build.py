@@ -17,6 +17,7 @@ import build_cache as bu
 import filesystem as fs
 import force
 import image as im
+import pull
 
 
 ## Globals ##
@@ -141,6 +142,7 @@ def main(cli_):
    image_ct = sum(1 for i in tree.children_("from_"))
 
    parse_tree_traverse(tree, image_ct, cli)
+   pull.dlcache_trim()
 
 ## Functions ##
 
@@ -1198,6 +1200,7 @@ class From__G(Instruction):
          ch.WARNING("base image also exists non-cached; using cache")
       # Load metadata
       self.image.metadata_load(self.base_image)
+      self.image.metadata["base_image"] = str(self.base_image.ref)
       self.env_arg.update(argfrom)  # from pre-FROM ARG
 
       # Done.
@@ -780,6 +780,12 @@ class Enabled_Cache:
          self.git(["checkout", "--detach"], cwd=src_img.unpack_path)
       self.git(["branch", "-f", self.branch_name_ready(src_ref), dest])
 
+   def branches(self):
+      "Return the set of branch names in the cache."
+      cp = self.git(["for-each-ref", "--format=%(refname:short)",
+                     "refs/heads"])
+      return set(cp.stdout.split())
+
    def cached_p(self, git_id):
       """True iff image corresponding to “git_id” is in the cache."""
       return self.find_commit(git_id)[1] != None
@@ -1047,11 +1053,14 @@ class Enabled_Cache:
             self.file_metadata.get(path).git_restore(quick)
       t.log("restored file metadata (%s)" % ("quick" if quick else "full"))
 
-   def pull_eager(self, img, src_ref, last_layer=None):
+   def pull_eager(self, img, src_ref, last_layer=None, pullet=None):
       """Pull image, always checking if the repository version is newer. This
-         is the pull operation invoked from the command line."""
-      pullet = pull.Image_Puller(img, src_ref)
-      pullet.download()  # will use dlcache if appropriate
+         is the pull operation invoked from the command line. If pullet is not
+         None, use that Image_Puller and do not download anything (i.e.,
+         assume Image_Puller.download() has already been called)."""
+      if (pullet is None):
+         pullet = pull.Image_Puller(img, src_ref)
+         pullet.download()  # will use dlcache if appropriate
       dl_sid = self.sid_from_parent(self.root_id, pullet.sid_input)
       dl_git_hash = self.find_sid(dl_sid, img.ref.for_path)
       if (dl_git_hash is not None):
@@ -1382,6 +1391,9 @@ class Disabled_Cache(Rebuild_Cache):
    def branch_nocheckout(self, src_ref, dest):
       pass
 
+   def branches(self):
+      return set()
+
    def checkout(self, image, git_hash, base_image):
       ch.INFO("copying image ...")
       image.unpack_clear()
@@ -18,6 +18,7 @@ import shutil
 import signal
 import subprocess
 import sys
+import threading
 import time
 import traceback
 import warnings
@@ -161,6 +162,21 @@ warns = list()
 # True if the download cache is enabled.
 dlcache_p = None
 
+# Maximum number of blobs to download concurrently.
+download_jobs = None
+
+# Maximum size of download cache in bytes, or None if unlimited.
+dlcache_max = None
+
+# How to extract layers: "python" (tarfile module) or "tar" (GNU tar).
+unpack_backend = None
+
+# Maximum number of layers to extract concurrently.
+unpack_jobs = None
+
+# Maximum number of unpacked layer-chain snapshots to keep; 0 disables them.
+unpack_snapshots = None
+
 # Profiling.
 profiling = False
 profile = None
@@ -313,10 +329,15 @@ class Progress:
       By default, moves to a new line at first update, then assumes exclusive
       control of this line in the terminal, rewriting the line as needed. If
       output is not a TTY or global log_festoon is set, each update is one log
-      entry with no overwriting."""
+      entry with no overwriting.
+
+      Updates are serialized with a lock, so one meter can be shared by
+      multiple threads, e.g. to show combined progress of concurrent
+      downloads."""
 
    __slots__ = ("display_last",
                 "divisor",
+                "lock",
                 "msg",
                 "length",
                 "unit",
@@ -336,6 +357,7 @@ class Progress:
       self.precision = 1 if self.divisor >= 1000 else 0
       self.progress = 0
       self.display_last = float("-inf")
+      self.lock = threading.Lock()
       self.update(0)
 
    def done(self):
@@ -344,39 +366,45 @@ class Progress:
          INFO("")  # newline to release display line
 
    def update(self, increment, last=False):
-      now = time.monotonic()
-      self.progress += increment
-      if (last or now - self.display_last > 1):
-         if (self.length is None):
-            line = ("%s: %.*f %s"
-                    % (self.msg,
-                       self.precision, self.progress / self.divisor,
-                       self.unit))
-         else:
-            ct = "%.*f/%.*f" % (self.precision, self.progress / self.divisor,
-                                self.precision, self.length / self.divisor)
-            pct = "%d%%" % (100 * self.progress / self.length)
-            if (ct == "0.0/0.0"):
-               # too small, don’t print count
-               line = "%s: %s" % (self.msg, pct)
+      with self.lock:
+         now = time.monotonic()
+         self.progress += increment
+         if (last or now - self.display_last > 1):
+            if (self.length is None):
+               line = ("%s: %.*f %s"
+                       % (self.msg,
+                          self.precision, self.progress / self.divisor,
+                          self.unit))
             else:
-               line = ("%s: %s %s (%s)" % (self.msg, ct, self.unit, pct))
-         INFO(line, end=("\r" if self.overwrite_p else "\n"))
-         self.display_last = now
+               ct = "%.*f/%.*f" % (self.precision, self.progress / self.divisor,
+                                   self.precision, self.length / self.divisor)
+               pct = "%d%%" % (100 * self.progress / self.length)
+               if (ct == "0.0/0.0"):
+                  # too small, don’t print count
+                  line = "%s: %s" % (self.msg, pct)
+               else:
+                  line = ("%s: %s %s (%s)" % (self.msg, ct, self.unit, pct))
+            INFO(line, end=("\r" if self.overwrite_p else "\n"))
+            self.display_last = now
 
 
 class Progress_Reader:
    """Wrapper around a binary file object to maintain a progress meter while
-      reading."""
+      reading. If progress is given, it is an existing Progress object to
+      update instead, as for Progress_Writer."""
 
    __slots__ = ("fp",
                 "msg",
-                "progress")
+                "offset",  # bytes read so far
+                "progress",
+                "progress_own_p")
 
-   def __init__(self, fp, msg):
+   def __init__(self, fp, msg, progress=None):
       self.fp = fp
       self.msg = msg
-      self.progress = None
+      self.offset = 0
+      self.progress = progress
+      self.progress_own_p = (progress is None)
 
    def __iter__(self):
       return self
@@ -389,14 +417,23 @@ class Progress_Reader:
 
    def close(self):
       if (self.progress is not None):
-         self.progress.done()
+         if (self.progress_own_p):
+            self.progress.done()
          close_(self.fp)
 
    def read(self, size=-1):
      data = ossafe("can’t read: %s" % self.fp.name, self.fp.read, size)
+     self.offset += len(data)
      self.progress.update(len(data))
      return data
 
+   def rewind(self, offset=0):
+      """Go back to byte offset, by default the beginning, e.g. to retry or
+         resume an upload."""
+      ossafe("can’t seek: %s" % self.fp.name, self.fp.seek, offset)
+      self.progress.update(offset - self.offset)
+      self.offset = offset
+
    def seek(self, *args):
       raise io.UnsupportedOperation
 
@@ -407,7 +444,8 @@ class Progress_Reader:
       assert (old_pos == 0)  # math will be wrong if this isn’t true
       length = self.fp.seek(0, os.SEEK_END)
       self.fp.seek(old_pos)
-      self.progress = Progress(self.msg, "MiB", 2**20, length)
+      if (self.progress_own_p):
+         self.progress = Progress(self.msg, "MiB", 2**20, length)
 
 
 class Progress_Writer:
@@ -415,9 +453,13 @@ class Progress_Writer:
       data are written. Overwrite the file if it already exists.
 
       This downloads to a temporary file to ease recovery if the download is
-      interrupted. This uses a predictable name to support restarts in the
-      future, which would probably require verification after download. For
-      now, we just delete any leftover temporary files in Storage.init().
+      interrupted. This uses a predictable name to support restarts. If
+      resume is true and the temporary file already exists, attribute offset
+      is its size, and the caller can ask the server for only the remaining
+      data; then pass resume_p=True to start() to append rather than
+      overwrite. The caller is responsible for verifying the complete file.
+      Storage.cleanup() deletes leftover temporary files that can’t be
+      resumed.
 
       An interesting alternative is to download to an anonymous temporary file
       that vanishes if not linked into the filesystem. Recent Linux provides a
@@ -426,35 +468,126 @@ class Progress_Writer:
       (create, then immediately unlink(2)) does not support re-linking [2].
       This would also not support restarting the download.
 
+      If progress is given, it is an existing Progress object (typically
+      shared with other writers) to update instead of creating a new meter;
+      the caller is responsible for finishing it. If tee is given, it is an
+      object with write(), close(), and abandon() methods (e.g.,
+      fs.Tar_Lister) that also receives all the data, including any already
+      downloaded.
+
       [1]: https://man7.org/linux/man-pages/man2/open.2.html
       [2]: https://stackoverflow.com/questions/4171713"""
 
    __slots__ = ("fp",
                 "msg",
+                "offset",
                 "path",
                 "path_tmp",
-                "progress")
-
-   def __init__(self, path, msg):
+                "progress",
+                "progress_ct",    # bytes counted in meter, None if not started
+                "progress_own_p",
+                "tee",
+                "tee_offset")  # bytes of temporary file already given to tee
+
+   def __init__(self, path, msg, progress=None, resume=False, tee=None):
+      self.fp = None
       self.msg = msg
       self.path = path
       self.path_tmp = path.with_name("part_" + path.name)
-      self.progress = None
+      self.progress = progress
+      self.progress_ct = None
+      self.progress_own_p = (progress is None)
+      self.tee = tee
+      self.tee_offset = 0
+      if (resume and self.path_tmp.exists()):
+         self.offset = self.path_tmp.file_size()
+      else:
+         self.offset = 0
 
    def close(self):
-      if (self.progress is not None):
-         self.progress.done()
+      if (self.fp is not None):
+         if (self.progress_own_p):
+            self.progress.done()
          close_(self.fp)
          self.path.unlink(missing_ok=True)
          self.path_tmp.rename(self.path)
+      if (self.tee is not None):
+         self.tee.close()
 
-   def start(self, length):
-      self.progress = Progress(self.msg, "MiB", 2**20, length)
-      self.fp = self.path_tmp.open("wb")
+   def discard(self):
+      """Close and delete the temporary file, e.g. because its content is
+         bad. A subsequent start() begins from scratch."""
+      if (self.fp is not None):
+         close_(self.fp)
+         self.fp = None
+      self.path_tmp.unlink(missing_ok=True)
+      self.offset = 0
+
+   def reset(self):
+      """Undo everything since start(), e.g. because the source failed partway
+         and we’ll try another: discard the temporary file, remove its data
+         from the progress meter, and abandon the tee, which can’t take data
+         back. A subsequent start() begins from scratch, without a tee. Do
+         nothing if start() hasn’t been called, so data from an earlier
+         download that we’re resuming are kept."""
+      if (self.progress_ct is None):
+         return
+      self.discard()
+      if (self.progress_own_p):
+         self.progress.done()
+      else:
+         self.progress.update(-self.progress_ct)
+      self.progress_ct = None
+      if (self.tee is not None):
+         self.tee.abandon()
+         self.tee = None
+      self.tee_offset = 0
+
+   def start(self, length, resume_p=False):
+      """Open the temporary file and start the progress meter. If resume_p,
+         append to the existing data and count it as progress already made;
+         in this case, length is the length of the whole file, not just the
+         remaining data."""
+      if (not resume_p):
+         self.offset = 0
+      if (self.progress_own_p):
+         self.progress = Progress(self.msg, "MiB", 2**20, length)
+      self.progress.update(self.offset)
+      self.progress_ct = self.offset
+      if (resume_p and self.tee is not None):
+         fp = self.path_tmp.open("rb")
+         ossafe("can’t seek: %s" % self.path_tmp, fp.seek, self.tee_offset)
+         while True:
+            data = ossafe("can’t read: %s" % self.path_tmp, fp.read,
+                          HTTP_CHUNK_SIZE)
+            if (len(data) == 0):  # EOF
+               break
+            self.tee.write(data)
+         close_(fp)
+      self.fp = self.path_tmp.open("ab" if resume_p else "wb")
+
+   def suspend(self):
+      """Close the temporary file but keep it, e.g. because the download was
+         interrupted, so a subsequent start(resume_p=True) can append to it.
+         Data already written is removed from a shared progress meter because
+         start() counts it again."""
+      if (self.fp is not None):
+         close_(self.fp)
+         self.fp = None
+      self.offset = self.path_tmp.file_size()
+      self.tee_offset = self.offset
+      if (self.progress_own_p):
+         self.progress.done()
+      else:
+         self.progress.update(-self.offset)
+      self.progress_ct = None
 
    def write(self, data):
       self.progress.update(len(data))
+      self.progress_ct += len(data)
       ossafe("can’t write: %s" % self.path, self.fp.write, data)
+      if (self.tee is not None):
+         self.tee.write(data)
 
 
 class Timer:
@@ -718,6 +851,33 @@ def init(cli):
       dlcache = Download_Mode.ENABLED
    global dlcache_p
    dlcache_p = (dlcache == Download_Mode.ENABLED)
+   global download_jobs
+   if (cli.download_jobs < 1):
+      FATAL("--download-jobs must be at least 1: %d" % cli.download_jobs)
+   download_jobs = cli.download_jobs
+   VERBOSE("download jobs: %d" % download_jobs)
+   global dlcache_max
+   try:
+      dlcache_max = size_parse(cli.dlcache_max) or None
+   except ValueError as x:
+      FATAL("--dlcache-max: %s" % x)
+   VERBOSE("download cache max bytes: %s" % dlcache_max)
+   global unpack_backend
+   if (cli.unpack_backend not in ("python", "tar")):
+      FATAL("--unpack-backend: invalid backend: %s" % cli.unpack_backend)
+   unpack_backend = cli.unpack_backend
+   VERBOSE("unpack backend: %s" % unpack_backend)
+   global unpack_jobs
+   if (cli.unpack_jobs < 1):
+      FATAL("--unpack-jobs must be at least 1: %d" % cli.unpack_jobs)
+   unpack_jobs = cli.unpack_jobs
+   VERBOSE("unpack jobs: %d" % unpack_jobs)
+   global unpack_snapshots
+   if (cli.unpack_snapshots < 0):
+      FATAL("--unpack-snapshots must be non-negative: %d"
+            % cli.unpack_snapshots)
+   unpack_snapshots = cli.unpack_snapshots
+   VERBOSE("unpack snapshots: %d" % unpack_snapshots)
    # registry authentication
    if (cli.func.__module__ == "push"):
       rg.auth_p = True
@@ -728,6 +888,23 @@ def init(cli):
    else:
       rg.auth_p = False
    VERBOSE("registry authentication: %s" % rg.auth_p)
+   # registry retries
+   if (cli.retries < 0):
+      FATAL("--retries must be non-negative: %d" % cli.retries)
+   rg.retries = cli.retries
+   m = re.search(r"^(\d+(?:\.\d*)?)(?::(\d+(?:\.\d*)?))?$", cli.retry_delay)
+   if (m is None):
+      FATAL("--retry-delay: can’t parse: %s" % cli.retry_delay)
+   rg.retry_delay_base = float(m[1])
+   if (m[2] is not None):
+      rg.retry_delay_max = float(m[2])
+   VERBOSE("registry retries: %d, delay %g to %gs"
+           % (rg.retries, rg.retry_delay_base, rg.retry_delay_max))
+   # registry mirrors
+   for spec in cli.mirror:
+      rg.mirror_add(spec)
+   for (regy, mirrors) in rg.mirrors.items():
+      VERBOSE("mirrors for %s: %s" % (regy, " ".join(str(m) for m in mirrors)))
    # Red Hat Python warns about tar bugs, citing CVE-2007-4559.
    # We mitigate this already, so suppress the noise. (#1818)
    warnings.filterwarnings("ignore", module=r"^tarfile$",
@@ -880,6 +1057,27 @@ def sigterm(signum, frame):
    ERROR("received %s, exiting" % signame)
    FATAL("received %s" % signame)
 
+def size_parse(text):
+   """Parse text as a size in bytes, optionally with a binary suffix K, M, G,
+      or T (which may be followed by “iB” or “B”), and return an integer. E.g.:
+
+        >>> size_parse("512")
+        512
+        >>> size_parse("50G")
+        53687091200
+        >>> size_parse("1.5MiB")
+        1572864
+        >>> size_parse("lots")
+        Traceback (most recent call last):
+          ...
+        ValueError: invalid size: lots"""
+   m = re.search(r"^(\d+(?:\.\d*)?)\s*(?:([KMGT])(?:i?B)?|B)?$", text.strip(),
+                 re.IGNORECASE)
+   if (m is None):
+      raise ValueError("invalid size: %s" % text)
+   exp = " KMGT".index(m[2].upper()) if m[2] else 0
+   return int(float(m[1]) * 1024**exp)
+
 def user():
    "Return the current username; exit with error if it can’t be obtained."
    try:
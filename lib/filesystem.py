@@ -1,3 +1,5 @@
+import collections
+import concurrent.futures
 import errno
 import fcntl
 import fnmatch
@@ -10,11 +12,26 @@ import re
 import shutil
 import stat
 import struct
+import subprocess
+import sys
 import tarfile
+import tempfile
+import threading
+import zlib
 
 import charliecloud as ch
 
 
+## Hairy imports ##
+
+# Zstandard is optional; if it’s not installed, we use zstd(1) instead, if
+# that is, for zstd-compressed layers.
+try:
+   import zstandard
+except ImportError:
+   zstandard = None
+
+
 ## Constants ##
 
 # Storage directory format version. We refuse to operate on storage
@@ -26,6 +43,24 @@ import charliecloud as ch
 #   $ git grep -E '^STORAGE_VERSION =' $(git tag | sort -V)
 STORAGE_VERSION = 7
 
+# ioctl(2) request to clone a file’s data copy-on-write, from
+# <linux/fs.h>. See ioctl_ficlone(2).
+FICLONE = 0x40049409
+
+# Size of the blocks Gzip_Writer compresses independently, in bytes. Output
+# depends on this, so changing it changes layer hashes.
+GZIP_BLOCK_SIZE = 2**20
+
+# Format version of the layer member listings saved in the download cache
+# (see Tar_Member.listing_save()). Increment when Tar_Member’s attributes
+# change; listings with other versions are ignored and re-created.
+LISTING_VERSION = 2
+
+# First four bytes of a zstd frame [1].
+#
+# [1]: https://datatracker.ietf.org/doc/html/rfc8878 §3.1.1
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
 
 ## Globals ##
 
@@ -47,9 +82,126 @@ def copy(src, dst, follow_symlinks=False):
       dst = Path(dst)
    src.copy(dst)
 
+def gnu_tar_check():
+   """Exit with an error if GNU tar(1), which TarFile.extractall_tar() needs,
+      isn’t available."""
+   cp = ch.cmd_base(["tar", "--version"], fail_ok=True, encoding="UTF-8",
+                    stdout=subprocess.PIPE)
+   if (cp.returncode != 0 or "GNU tar" not in cp.stdout):
+      ch.FATAL("--unpack-backend=tar needs GNU tar(1)")
+   ch.VERBOSE("found: %s" % cp.stdout.partition("\n")[0])
+
+def zstd_check():
+   """Exit with an error if we can’t compress or decompress zstd, i.e.
+      neither the zstandard Python module nor zstd(1) is available."""
+   if (zstandard is None and shutil.which("zstd") is None):
+      ch.FATAL("zstd compression needs Python module “zstandard” or zstd(1)")
+
 
 ## Classes ##
 
+class Gzip_Writer:
+   """Binary file object that gzips the data written to it and writes the
+      result to binary file object fp, which need not be seekable, using
+      multiple threads. Like pigz(1), the data are split into blocks of
+      GZIP_BLOCK_SIZE bytes that are compressed in parallel, each primed with
+      the last 32 KiB of the previous block so compression barely suffers,
+      and joined into a single gzip member. zlib releases the GIL while it
+      works, so this does use multiple cores.
+
+      Output depends only on the data, level, and block size, not the number
+      of threads (by default, one per CPU available) or how the data were
+      split into write() calls. The header timestamp is zero (see issue
+      #1080). close() finishes the gzip stream but does not close fp. E.g.:
+
+        >>> import io
+        >>> data = b"".join(b"%d," % i for i in range(1000000))  # 6.9 MB
+        >>> def gz(jobs, step):
+        ...    out = io.BytesIO()
+        ...    w = Gzip_Writer(out, 6, jobs)
+        ...    for i in range(0, len(data), step):
+        ...       w.write(data[i:i+step])
+        ...    w.close()
+        ...    return out.getvalue()
+        >>> a = gz(1, GZIP_BLOCK_SIZE)
+        >>> a == gz(4, 12345) == gz(16, len(data))
+        True
+
+      The result is an ordinary gzip file:
+
+        >>> cp = subprocess.run(["gzip", "-dc"], input=a, capture_output=True)
+        >>> (cp.returncode, cp.stdout == data)
+        (0, True)"""
+
+   __slots__ = ("buf",
+                "crc",
+                "dict_",    # last 32 KiB of previous block
+                "fp",
+                "jobs",
+                "level",
+                "pending",  # futures for compressed blocks, in order
+                "pool",
+                "size")
+
+   def __init__(self, fp, level=6, jobs=None):
+      self.buf = bytearray()
+      self.crc = 0
+      self.dict_ = None
+      self.fp = fp
+      self.jobs = jobs or len(os.sched_getaffinity(0))
+      self.level = level
+      self.pending = collections.deque()
+      self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+      self.size = 0
+      # Header [1]: magic, method (deflate), flags (none), mtime (zero), extra
+      # flags (slowest or fastest compression), OS (Unix).
+      #
+      # [1]: https://datatracker.ietf.org/doc/html/rfc1952 §2.3.1
+      xfl = { 9: 2, 1: 4 }.get(level, 0)
+      self.fp.write(struct.pack("<4sIBB", b"\x1f\x8b\x08\x00", 0, xfl, 3))
+
+   @staticmethod
+   def deflate(data, dict_, level, last):
+      """Return data compressed as raw deflate, not finishing the stream
+         unless last."""
+      if (dict_ is None):
+         c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+      else:
+         c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                              zdict=dict_)
+      return c.compress(data) + c.flush(zlib.Z_FINISH if last
+                                        else zlib.Z_SYNC_FLUSH)
+
+   def block_submit(self, data, last):
+      self.crc = zlib.crc32(data, self.crc)
+      self.size += len(data)
+      self.pending.append(self.pool.submit(self.deflate, data, self.dict_,
+                                           self.level, last))
+      self.dict_ = data[-32768:]
+      # Limit memory use by not getting too far ahead of the output.
+      while (len(self.pending) > 2 * self.jobs):
+         self.fp.write(self.pending.popleft().result())
+
+   def close(self):
+      self.block_submit(bytes(self.buf), True)
+      self.buf = bytearray()
+      while (len(self.pending) > 0):
+         self.fp.write(self.pending.popleft().result())
+      self.pool.shutdown()
+      # Trailer: CRC-32 and size modulo 2^32 of the uncompressed data.
+      self.fp.write(struct.pack("<II", self.crc, self.size & 0xffffffff))
+
+   def flush(self):
+      pass
+
+   def write(self, data):
+      self.buf += data
+      while (len(self.buf) >= GZIP_BLOCK_SIZE):
+         self.block_submit(bytes(self.buf[:GZIP_BLOCK_SIZE]), False)
+         del self.buf[:GZIP_BLOCK_SIZE]
+      return len(data)
+
+
 class Path(os.PathLike):
    """Path class roughly corresponding to pathlib.PosixPath. While it does
       subclass os.PathLike, it does not subclass anything in pathlib because:
@@ -116,7 +268,8 @@ class Path(os.PathLike):
    # Call self._tidy() if these can’t be assumed.
    __slots__ = ("path",)
 
-   # Name of the gzip(1) to use for file_gzip(); set on first call.
+   # Name of the gzip(1) to use for file_gzip(), or None to use Gzip_Writer;
+   # set on first call.
    gzip = None
 
    def __init__(self, *segments):
@@ -157,10 +310,26 @@ class Path(os.PathLike):
       if (cls.gzip is None):
          if (shutil.which("pigz") is not None):
             cls.gzip = "pigz"
-         elif (shutil.which("gzip") is not None):
-            cls.gzip = "gzip"
          else:
-            ch.FATAL("can’t find path to gzip or pigz")
+            ch.VERBOSE("pigz not found, using built-in parallel gzip")
+            cls.gzip = False
+
+   def _file_compress(self, path_c, class_, level):
+      """Compress file at path to path_c by writing it to a class_ object
+         (e.g. Gzip_Writer) created with level, then delete the original
+         file, like gzip(1)."""
+      fp_in = self.open("rb")
+      fp_out = path_c.open("wb")
+      writer = class_(fp_out, level)
+      while True:
+         data = ch.ossafe("can’t read: %s" % self, fp_in.read, GZIP_BLOCK_SIZE)
+         if (len(data) == 0):  # EOF
+            break
+         ch.ossafe("can’t write: %s" % path_c, writer.write, data)
+      ch.ossafe("can’t write: %s" % path_c, writer.close)
+      ch.close_(fp_out)
+      ch.close_(fp_in)
+      self.unlink()
 
    def _tidy(self):
       "Repair self.path assumptions (see attribute docs above)."
@@ -804,12 +973,13 @@ class Path(os.PathLike):
          ch.close_(fp)
 
    def file_gzip(self, args=[]):
-      """Run pigz(1) if it’s available, otherwise gzip(1), on file at path and
-         return the file’s new name. Pass args to the gzip executable. This
-         lets us gzip files (a) in parallel if pigz(1) is installed and
-         (b) without reading them into memory."""
+      """Run pigz(1) if it’s available, otherwise Gzip_Writer, on file at
+         path and return the file’s new name. Pass args to pigz; Gzip_Writer
+         understands only the compression level (e.g. “-9”). This lets us
+         gzip files (a) in parallel and (b) without reading them into
+         memory."""
       path_c = self.suffix_add(".gz")
-      # On first call, remember first available of pigz and gzip using class
+      # On first call, remember whether pigz is available using class
       # attribute 'gzip'.
       self.__class__._gzip_set()
       # Remove destination if it already exists, because “gzip --force” does
@@ -818,7 +988,14 @@ class Path(os.PathLike):
       if (path_c.exists()):
          path_c.unlink()
       # Compress.
-      ch.cmd([self.gzip] + args + [str(self)])
+      if (self.gzip):
+         ch.cmd([self.gzip] + args + [str(self)])
+      else:
+         level = 6  # same default as gzip(1)
+         for arg in args:
+            if (re.search(r"^-[1-9]$", arg)):
+               level = int(arg[1:])
+         self._file_compress(path_c, Gzip_Writer, level)
       # Zero out GZIP header timestamp, bytes 4–7 zero-indexed inclusive [1],
       # to ensure layer hash is consistent. See issue #1080.
       # [1]: https://datatracker.ietf.org/doc/html/rfc1952 §2.3.1
@@ -835,6 +1012,11 @@ class Path(os.PathLike):
            >>> Path("/dev/null").file_hash()
            'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
       """
+      return self.file_hasher().hexdigest()
+
+   def file_hasher(self):
+      """Return a SHA-256 hash object that has been updated with the data in
+         file at path, e.g. to continue hashing an interrupted download."""
       fp = self.open("rb")
       h = hashlib.sha256()
       while True:
@@ -843,7 +1025,7 @@ class Path(os.PathLike):
             break
          h.update(data)
       ch.close_(fp)
-      return h.hexdigest()
+      return h
 
    def file_read_all(self, text=True):
       """Return the contents of file at path, or exit with error. If text,
@@ -871,6 +1053,25 @@ class Path(os.PathLike):
            0"""
       return self.stat(follow_symlinks).st_size
 
+   def file_unzstd(self):
+      """Return an anonymous temporary file, open for reading, containing the
+         decompressed contents of zstd-compressed file at path. It’s in our
+         own download cache, not necessarily the directory containing path,
+         which may be a read-only shared cache, and vanishes when closed."""
+      zstd_check()
+      dir_ = ch.storage.download_cache
+      tmp = ch.ossafe("can’t create temporary file in: %s" % dir_,
+                      tempfile.TemporaryFile, dir=dir_)
+      if (zstandard is not None):
+         fp = self.open("rb")
+         ch.ossafe("can’t decompress: %s" % self,
+                   zstandard.ZstdDecompressor().copy_stream, fp, tmp)
+         ch.close_(fp)
+      else:
+         ch.cmd_base(["zstd", "-q", "-d", "-c", self], stdout=tmp)
+      ch.ossafe("can’t seek: %s" % tmp, tmp.seek, 0)
+      return tmp
+
    def file_write(self, content):
       """e.g.:
 
@@ -882,6 +1083,23 @@ class Path(os.PathLike):
       ch.ossafe("can’t write: %s" % self, fp.write, content)
       ch.close_(fp)
 
+   def file_zstd(self, level):
+      """Compress file at path with zstd at level using Zstd_Writer, replacing
+         it like file_gzip(), and return the compressed file’s name."""
+      path_c = self.suffix_add(".zst")
+      self._file_compress(path_c, Zstd_Writer, level)
+      return path_c
+
+   def file_zstd_p(self):
+      """Return True if file at path is zstd-compressed, False otherwise.
+
+           >>> Path("/dev/null").file_zstd_p()
+           False"""
+      fp = self.open("rb")
+      magic = ch.ossafe("can’t read: %s" % self, fp.read, len(ZSTD_MAGIC))
+      ch.close_(fp)
+      return (magic == ZSTD_MAGIC)
+
    def grep_p(self, rx):
       """Return True if file at path contains a line matching regular
          expression rx, False if it does not.
@@ -963,6 +1181,85 @@ class Path(os.PathLike):
       # the root filesystem.
       return self.__class__("/")
 
+   def reflink(self, dst):
+      """Make dst, which must not exist, a copy-on-write clone of regular
+         file myself, i.e., a copy that shares data blocks until either is
+         modified. Return True if successful, or False if the filesystem
+         can’t do that (e.g., src and dst on different filesystems, or
+         filesystem without reflink support), in which case dst doesn’t
+         exist. Other errors are fatal."""
+      try:
+         src_fd = os.open(self, os.O_RDONLY|os.O_NOFOLLOW)
+         dst_fd = os.open(dst, os.O_WRONLY|os.O_NOFOLLOW|os.O_CREAT|os.O_EXCL,
+                          0o644)
+      except OSError as x:
+         ch.FATAL("can’t open for reflink: %s -> %s: %s"
+                  % (self, dst, x.strerror))
+      try:
+         fcntl.ioctl(dst_fd, FICLONE, src_fd)
+         success = True
+      except OSError as x:
+         if (x.errno not in { errno.EBADF, errno.EINVAL, errno.ENOTTY,
+                              errno.EOPNOTSUPP, errno.EXDEV }):
+            ch.FATAL("can’t reflink: %s -> %s: %s" % (self, dst, x.strerror))
+         ch.DEBUG("reflink not possible: %s -> %s: %s"
+                  % (self, dst, x.strerror))
+         success = False
+      os.close(src_fd)
+      os.close(dst_fd)
+      if (not success):
+         dst.unlink()
+      return success
+
+   def reflink_tree(self, dst):
+      """Make dst, which must not exist, a copy of directory tree myself in
+         which regular files are reflinks (see reflink()). Symlinks are
+         copied as symlinks, hard links within the tree are preserved, and
+         permissions and timestamps are copied, but not ownership. Return True
+         if successful, or False if a file can’t be reflinked, in which case
+         dst doesn’t exist. Other errors, including other file types, are
+         fatal."""
+      links = dict()  # (device, inode) of multiply-linked file -> first copy
+      dirs = list()   # (copy, stat result) of each directory, parents first
+      todo = [(self, dst)]
+      try:
+         while (len(todo) > 0):
+            (src_dir, dst_dir) = todo.pop()
+            dirs.append((dst_dir, os.lstat(src_dir)))
+            os.mkdir(dst_dir, 0o700)
+            with os.scandir(src_dir) as entries:
+               for entry in entries:
+                  src = src_dir // entry.name
+                  dst_ = dst_dir // entry.name
+                  st = entry.stat(follow_symlinks=False)
+                  if (stat.S_ISDIR(st.st_mode)):
+                     todo.append((src, dst_))
+                     continue
+                  elif (stat.S_ISLNK(st.st_mode)):
+                     os.symlink(os.readlink(src), dst_)
+                  elif (not stat.S_ISREG(st.st_mode)):
+                     ch.FATAL("can’t reflink: invalid file type 0%o: %s"
+                              % (stat.S_IFMT(st.st_mode), src))
+                  elif ((st.st_dev, st.st_ino) in links):
+                     os.link(links[(st.st_dev, st.st_ino)], dst_)
+                     continue
+                  elif (src.reflink(dst_)):
+                     if (st.st_nlink > 1):
+                        links[(st.st_dev, st.st_ino)] = dst_
+                     os.chmod(dst_, stat.S_IMODE(st.st_mode))
+                  else:
+                     dst.rmtree()
+                     return False
+                  os.utime(dst_, ns=(st.st_atime_ns, st.st_mtime_ns),
+                           follow_symlinks=False)
+         for (dir_, st) in reversed(dirs):  # children before parents
+            os.chmod(dir_, stat.S_IMODE(st.st_mode))
+            os.utime(dir_, ns=(st.st_atime_ns, st.st_mtime_ns))
+      except OSError as x:
+         ch.FATAL("can’t copy directory %s: %s: %s"
+                  % (self, x.filename, x.strerror))
+      return True
+
    def rmtree(self):
       ch.TRACE("deleting directory: %s" % self)
       try:
@@ -1007,6 +1304,20 @@ class Path(os.PathLike):
             dirs.sort()
       return md
 
+   def stat_hash_recursive(self):
+      """Return the hash, as a hex string, of stat_bytes_recursive(), feeding
+         it incrementally rather than building the whole bytearray, which can
+         be quite large for big trees."""
+      h = hashlib.sha256()
+      h.update(self.stat_bytes(True))
+      if (self.is_dir()):
+         for (dir_, dirs, files) in ch.walk(self):
+            h.update(dir_.stat_bytes(False))
+            for f in sorted(files):
+               h.update((dir_ // f).stat_bytes(False))
+            dirs.sort()
+      return h.hexdigest()
+
    def strip(self, left=0, right=0):
       """Return a copy of self with n leading components removed. E.g.:
 
@@ -1101,6 +1412,22 @@ class Storage:
    def download_cache(self):
       return self.root // "dlcache"
 
+   @property
+   def download_caches_shared(self):
+      """List of read-only download caches shared with other storage
+         directories, from $CH_IMAGE_SHARED_DLCACHE (colon-separated); empty
+         if not set. These are outside the storage directory, but their
+         contents are named the same way as ours."""
+      dirs = list()
+      for dir_ in os.environ.get("CH_IMAGE_SHARED_DLCACHE", "").split(":"):
+         if (dir_ == ""):
+            continue
+         dir_ = Path(dir_)
+         if (not dir_.is_absolute()):
+            ch.FATAL("$CH_IMAGE_SHARED_DLCACHE: not absolute path: %s" % dir_)
+         dirs.append(dir_)
+      return dirs
+
    @property
    def image_tmp(self):
       return self.root // "imgtmp"
@@ -1113,6 +1440,20 @@ class Storage:
    def mount_point(self):
       return self.root // "mnt"
 
+   @property
+   def snapshot_cache(self):
+      return self.root // "sncache"
+
+   @property
+   def snapshot_chains(self):
+      """File recording the layer chain of each image unpacked with
+         snapshots (see image.Image.unpack_layers_snapshot())."""
+      return self.snapshot_cache // "chains.json"
+
+   @property
+   def token_cache(self):
+      return self.root // "tokens.json"
+
    @property
    def unpack_base(self):
       return self.root // "img"
@@ -1140,10 +1481,15 @@ class Storage:
 
    def cleanup(self):
       "Called during initialization after we know the storage dir is valid."
-      # Delete partial downloads.
+      # Delete partial downloads, except blobs. These are named by digest, so
+      # they can be resumed by HTTP.blob_to_file(); other files (e.g.,
+      # manifests) can change and are small anyway.
       part_ct = 0
       for path in self.download_cache.glob("part_*"):
          path = Path(path)
+         if (re.search(r"^part_[0-9a-f]{64}\.", path.name)):
+            ch.VERBOSE("keeping for resume: %s" % path)
+            continue
          ch.VERBOSE("deleting: %s" % path)
          path.unlink()
          part_ct += 1
@@ -1206,6 +1552,16 @@ class Storage:
       self.validate_strict()
       self.cleanup()
 
+   def layers_for_upload(self, image_ref):
+      """Return the path of the file recording the layers prepared for pushing
+         image_ref (see push.Image_Pusher.layers_cached())."""
+      return self.upload_cache // ("%s.layers.json" % image_ref.for_path)
+
+   def listing_for_download(self, layer_hash):
+      """Return the path of the file caching the member listing of layer
+         layer_hash (see Tar_Member.listing_save())."""
+      return self.download_cache // ("%s.listing" % layer_hash)
+
    def lock(self):
       """Lock the storage directory. Charliecloud does not at present support
          concurrent use of ch-image(1) against the same storage directory."""
@@ -1242,6 +1598,13 @@ class Storage:
       else:
          ch.FATAL("%s not a builder storage" % (self.root));
 
+   def snapshot_for_layers(self, layer_hashes):
+      """Return the path of the directory holding the unpacked snapshot of
+         layer chain layer_hashes, lowest first. Its metadata is in the same
+         path plus “.json”."""
+      key = hashlib.sha256("\n".join(layer_hashes).encode("UTF-8"))
+      return self.snapshot_cache // key.hexdigest()
+
    def unpack(self, image_ref):
       return self.unpack_base // image_ref.for_path
 
@@ -1268,7 +1631,8 @@ class Storage:
          except KeyError:
             ch.FATAL("%s: missing file or directory: %s" % (msg_prefix, entry))
       # Ignore some files that may or may not exist.
-      entries -= { i.name for i in (self.lockfile, self.mount_point) }
+      entries -= { i.name for i in (self.lockfile, self.mount_point,
+                                    self.snapshot_cache, self.token_cache) }
       # Delete some files that exist only if we crashed.
       for i in (self.image_tmp, ):
          if (i.name in entries):
@@ -1293,6 +1657,11 @@ class Storage:
             ch.FATAL("%s: storage directory broken: bad image dir name: %s"
                      % (msg_prefix, img), ch.BUG_REPORT_PLZ)
 
+   def validators_for_download(self, path):
+      """Return the path of the file recording HTTP cache validators (ETag and
+         digest) for the manifest or manifest list downloaded to path."""
+      return path.suffix_add(".validators")
+
    def version_read(self):
       # While support for storage v1 was dropped some time ago, let’s at least
       # retain the ability to recognize it.
@@ -1324,6 +1693,11 @@ class TarFile(tarfile.TarFile):
    # [4]: https://bugs.python.org/issue19974
    # [5]: https://bugs.python.org/issue23228
 
+   # If false, clobber() refuses to replace anything, because the caller
+   # knows that no member should overwrite another, so an existing file
+   # means a conflict (see Image.unpack_layers_parallel()).
+   clobber_p = True
+
    @staticmethod
    def fix_link_target(ti, tb):
       """Deal with link (symbolic or hard) weirdness or breakage. If it can be
@@ -1364,10 +1738,11 @@ class TarFile(tarfile.TarFile):
       assert (ti.name[0] != "/")  # absolute paths unsafe but shouldn’t happen
       if (not (ti.isfile() or ti.isdir() or ti.issym() or ti.islnk())):
          ch.FATAL("invalid file type: %s" % ti.name)
-      ti.uid = 0
-      ti.uname = "root"
-      ti.gid = 0
-      ti.gname = "root"
+      if (isinstance(ti, tarfile.TarInfo)):  # Tar_Member has no owner
+         ti.uid = 0
+         ti.uname = "root"
+         ti.gid = 0
+         ti.gname = "root"
       if (ti.mode & stat.S_ISUID):
          ch.VERBOSE("stripping unsafe setuid bit: %s" % ti.name)
          ti.mode &= ~stat.S_ISUID
@@ -1399,6 +1774,8 @@ class TarFile(tarfile.TarFile):
          st = None
       except OSError as x:
          ch.FATAL("can’t lstat: %s" % targetpath, targetpath)
+      if (st is not None and not self.clobber_p):
+         ch.FATAL("can’t extract, path already exists: %s" % targetpath)
       if (st is not None):
          if (stat.S_ISREG(st.st_mode)):
             if (regulars):
@@ -1413,6 +1790,63 @@ class TarFile(tarfile.TarFile):
             ch.FATAL("invalid file type 0%o in previous layer; see inode(7): %s"
                      % (stat.S_IFMT(st.st_mode), targetpath))
 
+   def extractall_tar(self, path, members):
+      """Like extractall(), but have GNU tar(1) do the work, avoiding our
+         per-member Python overhead. We feed it a new archive containing only
+         members (a sequence of TarInfo objects), with headers re-generated
+         from them, so changes the caller made (e.g., paths, link targets,
+         modes, and owner) take effect; file data are copied over without
+         interpretation. Sparse files are expanded.
+
+         tar(1) replaces existing files and symlinks like clobber(), or
+         refuses to replace anything if not clobber_p. Caveats:
+
+           1. It won’t replace a directory with a non-directory. (Its
+              --recursive-unlink would, but that also empties directories
+              that are replaced with a directory, e.g. “./” in every layer.)
+              This can’t happen after Image.overwrites_resolve() except for
+              directories kept because they contain hard link targets.
+
+           2. Within one archive, GNU tar creates symlinks whose target
+              contains “..” only at the end, for safety, so members
+              extracted through such a symlink in the same layer fail."""
+      argv = ["tar", "-x", "-f", "-", "-C", str(path), "--numeric-owner",
+              "--same-permissions"]
+      if (not self.clobber_p):
+         argv.append("--keep-old-files")
+      ch.VERBOSE("executing: %s" % ch.argv_to_string(argv))
+      err = tempfile.TemporaryFile()  # a pipe might fill and deadlock
+      proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stderr=err,
+                              bufsize=ch.HTTP_CHUNK_SIZE)
+      try:
+         for ti in members:
+            data = self.extractfile(ti) if ti.isreg() else None
+            if (data is not None):
+               ti.type = tarfile.REGTYPE  # sparse files come out expanded
+            proc.stdin.write(ti.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING,
+                                      "surrogateescape"))
+            if (data is not None):
+               tarfile.copyfileobj(data, proc.stdin, ti.size)
+               (_, remainder) = divmod(ti.size, tarfile.BLOCKSIZE)
+               if (remainder > 0):
+                  proc.stdin.write(tarfile.NUL
+                                   * (tarfile.BLOCKSIZE - remainder))
+         proc.stdin.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))  # EOF
+         proc.stdin.close()
+      except BrokenPipeError:
+         # tar(1) exited early; error reported below. close() still closes
+         # the pipe even though flushing fails.
+         try:
+            proc.stdin.close()
+         except BrokenPipeError:
+            pass
+      if (proc.wait() != 0):
+         err.seek(0)
+         sys.stderr.write(err.read().decode("UTF-8", errors="replace"))
+         sys.stderr.flush()
+         ch.FATAL("tar failed with code %d" % proc.returncode)
+      err.close()
+
    def makedir(self, tarinfo, targetpath):
       # Note: This gets called a lot, e.g. once for each component in the path
       # of the member being extracted.
@@ -1429,3 +1863,310 @@ class TarFile(tarfile.TarFile):
       ch.TRACE("makelink: %s -> %s" % (targetpath, tarinfo.linkname))
       self.clobber(targetpath, regulars=True, symlinks=True, dirs=True)
       super().makelink(tarinfo, targetpath)
+
+   def members_compact(self):
+      """Read the archive to the end and return a list of Tar_Member objects
+         describing it. Unlike getmembers(), each TarInfo is discarded as
+         soon as it’s converted, so peak memory is much lower for archives
+         with many members. Must be called before anything else reads the
+         member list; afterwards, the TarFile’s own list is empty."""
+      members = list()
+      while True:
+         ti = self.next()  # first call returns member read by open()
+         if (ti is None):
+            break
+         members.append(Tar_Member(ti))
+         self.members.clear()
+      return members
+
+   def members_set(self, members):
+      """Use members (a sequence of TarInfo objects describing this archive)
+         as the member list rather than reading the whole archive to find
+         them. An empty sequence means we won’t need the list at all, e.g.
+         because members were listed separately as Tar_Member objects."""
+      # TarFile reads the archive to the end the first time it needs the full
+      # member list unless _loaded is set, which isn’t public API but has
+      # been stable since at least Python 3.2. If it ever goes away, let
+      # TarFile read the archive as usual: slower, but still correct.
+      if (not hasattr(self, "_loaded")):
+         ch.VERBOSE("can’t set tar member list; will read archive: %s"
+                    % self.name)
+         return
+      self.members = list(members)
+      self._loaded = True
+
+
+class Tar_Lister:
+   """List the members of a tar stream, compressed or not, as its bytes
+      arrive, e.g. while the tarball is downloading. Data are passed with
+      write(), and a thread parses them. Offsets in the resulting Tar_Member
+      objects are into the uncompressed stream, so they are valid for the
+      same tarball opened with TarFile.open() later.
+
+      Parse errors are not fatal; they just mean no listing is available
+      (attribute members is None), because the caller verifies the download
+      separately and can list the tarball the usual way."""
+
+   __slots__ = ("members",
+                "name",
+                "pipe_w",
+                "thread")
+
+   def __init__(self, name):
+      self.members = None
+      self.name = name
+      (fd_r, fd_w) = os.pipe()
+      self.pipe_w = os.fdopen(fd_w, "wb")
+      self.thread = threading.Thread(target=self.run,
+                                     args=(os.fdopen(fd_r, "rb"),),
+                                     daemon=True)
+      self.thread.start()
+
+   def abandon(self):
+      """Stop listing, e.g. because the data so far came from a source that
+         failed partway. No listing is available afterwards."""
+      ch.close_(self.pipe_w)
+      self.thread.join()
+      self.members = None
+      ch.VERBOSE("streaming listing abandoned: %s" % self.name)
+
+   def close(self):
+      "Signal end of data and wait for parsing to finish."
+      ch.close_(self.pipe_w)
+      self.thread.join()
+      if (self.members is None):
+         ch.VERBOSE("streaming listing unavailable: %s" % self.name)
+      else:
+         ch.VERBOSE("listed %d members while streaming: %s"
+                    % (len(self.members), self.name))
+
+   def run(self, fp):
+      try:
+         tf = tarfile.open(fileobj=fp, mode="r|*")
+         members = list()
+         while True:
+            ti = tf.next()  # skips over member data as it arrives
+            if (ti is None):
+               break
+            members.append(Tar_Member(ti))
+            tf.members.clear()  # don’t keep a TarInfo for every member
+         tf.close()
+         self.members = members
+      except (EOFError, OSError, tarfile.TarError, zlib.error) as x:
+         ch.VERBOSE("can’t list while streaming: %s: %s" % (self.name, x))
+      finally:
+         # Consume whatever’s left so the writer never blocks.
+         while (len(fp.read(2**16)) > 0):
+            pass
+         fp.close()
+
+   def write(self, data):
+      self.pipe_w.write(data)
+
+
+class Tar_Member:
+   """Compact stand-in for a tarfile.TarInfo object, for keeping the member
+      lists of many large layers in memory at once. TarInfo has many more
+      attributes, including a dictionary of PAX headers and separate owner
+      name strings, which add up for images with millions of files. This has
+      only what we need to validate and extract members; tarinfo() converts
+      back for extraction. The owner is always root (see
+      TarFile.fix_member_uidgid()), so it’s not stored.
+
+      Lists of these can be saved to disk as JSON so a layer needn’t be read
+      again just to list it. Each member is saved as a plain list of its
+      attributes, in __slots__ order, which is smaller than an object. E.g.:
+
+        >>> import io, tempfile
+        >>> buf = io.BytesIO()
+        >>> with tarfile.open(fileobj=buf, mode="w", format=tarfile.GNU_FORMAT) as tf:
+        ...    for (name, type_, mode, target) in (
+        ...          ("d", tarfile.DIRTYPE, 0o755, ""),
+        ...          ("d/f", tarfile.REGTYPE, 0o4644, ""),
+        ...          ("d/s", tarfile.SYMTYPE, 0o777, "/d/f"),
+        ...          ("d/h", tarfile.LNKTYPE, 0o644, "d/f"),
+        ...          ("d/" + "l" * 200, tarfile.REGTYPE, 0o600, "")):
+        ...       ti = tarfile.TarInfo(name)
+        ...       (ti.type, ti.mode, ti.linkname, ti.mtime) = (type_, mode, target, 1)
+        ...       ti.size = 5 if ti.isreg() else 0
+        ...       tf.addfile(ti, io.BytesIO(b"hello"))
+        >>> _ = buf.seek(0)
+        >>> members = TarFile.open(fileobj=buf).members_compact()
+        >>> path = Path(tempfile.mkdtemp()) // "listing"
+        >>> Tar_Member.listing_save(path, members)
+        >>> members2 = Tar_Member.listing_load(path)
+        >>> state = lambda ms: [[getattr(m, a) for a in Tar_Member.__slots__]
+        ...                     for m in ms]
+        >>> state(members) == state(members2)
+        True
+
+      Converted back, they match what tarfile itself reads, once made safe:
+
+        >>> _ = buf.seek(0)
+        >>> tis = tarfile.open(fileobj=buf).getmembers()
+        >>> for ti in tis:
+        ...    TarFile.fix_member_uidgid(ti)
+        >>> [ti.name[:5] for ti in tis]
+        ['d', 'd/f', 'd/s', 'd/h', 'd/lll']
+        >>> state([m.tarinfo() for m in members2]) == state(tis)
+        True
+        >>> {(m.tarinfo().uid, m.tarinfo().uname) for m in members2}
+        {(0, 'root')}
+        >>> path.unlink(); path.parent.rmdir()"""
+
+   __slots__ = ("linkname",
+                "mode",
+                "mtime",
+                "name",
+                "offset",
+                "offset_data",
+                "size",
+                "sparse",
+                "type")
+
+   def __init__(self, ti):
+      self.linkname = ti.linkname
+      self.mode = ti.mode
+      self.mtime = ti.mtime
+      self.name = ti.name
+      self.offset = ti.offset
+      self.offset_data = ti.offset_data
+      self.size = ti.size
+      self.sparse = ti.sparse
+      self.type = ti.type
+
+   @staticmethod
+   def listing_load(path):
+      """Return the list of members saved in path by listing_save(), or None
+         if there isn’t one or it’s unusable, e.g. written by a different
+         version of Charliecloud."""
+      if (not path.exists()):
+         return None
+      try:
+         listing = json.loads(path.file_read_all())
+         version = listing["version"]
+         if (version != LISTING_VERSION):
+            ch.VERBOSE("ignoring listing with version %s: %s"
+                       % (version, path))
+            return None
+         members = list()
+         for state in listing["members"]:
+            if (len(state) != len(Tar_Member.__slots__)):
+               raise ValueError("wrong member length: %d" % len(state))
+            m = Tar_Member.__new__(Tar_Member)
+            for (a, v) in zip(Tar_Member.__slots__, state):
+               setattr(m, a, v)
+            if (m.sparse is not None):
+               m.sparse = [tuple(i) for i in m.sparse]
+            m.type = m.type.encode("ASCII")
+            members.append(m)
+      except (AttributeError, KeyError, TypeError, ValueError) as x:
+         ch.VERBOSE("ignoring bad listing: %s: %s" % (path, x))
+         return None
+      return members
+
+   @staticmethod
+   def listing_save(path, members):
+      "Save sequence members to path for later listing_load()."
+      path_tmp = path.suffix_add(".tmp")
+      # type is bytes, which JSON can’t represent, but it’s always ASCII.
+      states = [[(m.type.decode("ASCII") if a == "type" else getattr(m, a))
+                 for a in Tar_Member.__slots__]
+                for m in members]
+      path_tmp.file_write(json.dumps({ "version": LISTING_VERSION,
+                                       "members": states }))
+      path_tmp.rename(path)  # atomic, so a partial listing is never used
+
+   def isdev(self):
+      return (self.type in (tarfile.CHRTYPE, tarfile.BLKTYPE,
+                            tarfile.FIFOTYPE))
+
+   def isdir(self):
+      return (self.type == tarfile.DIRTYPE)
+
+   def isfile(self):
+      return (self.type in tarfile.REGULAR_TYPES)
+
+   def islnk(self):
+      return (self.type == tarfile.LNKTYPE)
+
+   def issym(self):
+      return (self.type == tarfile.SYMTYPE)
+
+   def tarinfo(self):
+      "Return an equivalent TarInfo object."
+      ti = tarfile.TarInfo(self.name)
+      ti.linkname = self.linkname
+      ti.mode = self.mode
+      ti.mtime = self.mtime
+      ti.offset = self.offset
+      ti.offset_data = self.offset_data
+      ti.size = self.size
+      ti.sparse = self.sparse
+      ti.type = self.type
+      TarFile.fix_member_uidgid(ti)
+      return ti
+
+
+class Zstd_Writer:
+   """Binary file object that compresses the data written to it with zstd
+      at level and writes the result to binary file object fp, which need not
+      be seekable, using all available cores. Use the zstandard module if
+      available, otherwise zstd(1) in a subprocess. close() finishes the zstd
+      stream but does not close fp."""
+
+   __slots__ = ("error",    # exception raised copying zstd(1) output
+                "fp",
+                "proc",     # zstd(1) subprocess, or None
+                "thread",   # copies zstd(1) output to fp
+                "writer")
+
+   def __init__(self, fp, level):
+      zstd_check()
+      self.error = None
+      self.fp = fp
+      if (zstandard is not None):
+         ch.VERBOSE("compressing with zstandard module, level %d" % level)
+         self.proc = None
+         self.thread = None
+         self.writer = zstandard.ZstdCompressor(level=level, threads=-1) \
+                                .stream_writer(fp, closefd=False)
+      else:
+         argv = ["zstd", "-q", "-c", "-T0", "-%d" % level]
+         if (level > 19):
+            argv.insert(1, "--ultra")
+         ch.VERBOSE("executing: %s" % ch.argv_to_string(argv))
+         self.proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+         self.thread = threading.Thread(target=self.copy_out, daemon=True)
+         self.thread.start()
+         self.writer = self.proc.stdin
+
+   def close(self):
+      self.writer.close()
+      if (self.proc is not None):
+         self.thread.join()
+         if (self.error is not None):
+            raise self.error
+         if (self.proc.wait() != 0):
+            ch.FATAL("zstd failed with code %d" % self.proc.returncode)
+
+   def copy_out(self):
+      while True:
+         data = self.proc.stdout.read(ch.HTTP_CHUNK_SIZE)
+         if (len(data) == 0):  # EOF
+            break
+         if (self.error is None):
+            # If writing fails, keep reading so zstd(1) doesn’t block, and
+            # re-raise in close().
+            try:
+               self.fp.write(data)
+            except BaseException as x:
+               self.error = x
+
+   def flush(self):
+      pass
+
+   def write(self, data):
+      self.writer.write(data)
+      return len(data)
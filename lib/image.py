@@ -1,14 +1,20 @@
+import bisect
 import collections
+import concurrent.futures
 import copy
 import datetime
+import filecmp
 import json
 import os
 import re
+import resource
+import stat
 import sys
 import tarfile
 
 import charliecloud as ch
 import filesystem as fs
+import version
 
 
 ## Hairy Imports ##
@@ -213,6 +219,81 @@ class Image:
          self.unpack_path = ch.storage.unpack(self.ref)
       self.metadata_init()
 
+   @staticmethod
+   def snapshot_chains_load():
+      """Return a dictionary mapping the unpack path of each image unpacked
+         with snapshots to its layer chain (list of hashes, lowest first)."""
+      if (not ch.storage.snapshot_chains.exists()):
+         return dict()
+      return ch.storage.snapshot_chains.json_from_file("snapshot chains")
+
+   @staticmethod
+   def snapshot_meta(path):
+      """Return the metadata of the snapshot in directory path, or None if
+         it’s not usable, e.g. incomplete or made by a different version of
+         Charliecloud."""
+      meta_path = path.suffix_add(".json")
+      if (not meta_path.exists()):  # written last, so missing if incomplete
+         ch.DEBUG("no snapshot metadata: %s" % path)
+         return None
+      meta = meta_path.json_from_file("snapshot metadata")
+      if (   not isinstance(meta, dict)
+          or meta.get("version") != version.VERSION
+          or not os.path.isdir(path)):
+         return None
+      return meta
+
+   @staticmethod
+   def snapshot_trim(chains):
+      """Save chains (see snapshot_chains_load()), minus images that no longer
+         exist, then evict snapshots. A snapshot’s reference count is the
+         number of those images whose chain starts with its layers. Snapshots
+         with no references, as well as unusable ones (see snapshot_meta()),
+         are deleted, then the least recently used until at most
+         ch.unpack_snapshots remain. A snapshot’s last-used time is the
+         modification time of its metadata file."""
+      cache = ch.storage.snapshot_cache
+      cache.mkdir()
+      chains = { path: chain for (path, chain) in chains.items()
+                             if os.path.isdir(path) }
+      ch.storage.snapshot_chains.file_write(json.dumps(chains, indent=2)
+                                            + "\n")
+      evict = list()
+      snaps = list()
+      for name in sorted(cache.listdir()):
+         path = cache // name
+         if (name == ch.storage.snapshot_chains.name):
+            continue
+         elif (name.endswith(".json")):
+            if (not os.path.isdir(cache // name[:-len(".json")])):
+               path.unlink()
+            continue
+         meta = None
+         if (not name.endswith(".partial")):
+            meta = Image.snapshot_meta(path)
+         if (meta is None):
+            ch.VERBOSE("snapshot %s: unusable" % name[:7])
+            evict.append(path)
+            continue
+         refs = sum(1 for chain in chains.values()
+                    if chain[:len(meta["layers"])] == meta["layers"])
+         ch.VERBOSE("snapshot %s: %d layers, %d references"
+                    % (name[:7], len(meta["layers"]), refs))
+         if (refs == 0):
+            evict.append(path)
+         else:
+            snaps.append((path.suffix_add(".json").stat(False).st_mtime,
+                          path))
+      snaps.sort(key=lambda s: s[0])
+      evict += [path for (_, path) in snaps[:-ch.unpack_snapshots]]
+      for path in evict:
+         ch.VERBOSE("evicting snapshot: %s" % path.name)
+         path.rmtree()
+         path.suffix_add(".json").unlink(missing_ok=True)
+      if (len(evict) > 0):
+         ch.INFO("layer snapshots: evicted %d, %d remain"
+                 % (len(evict), len(snaps[-ch.unpack_snapshots:])))
+
    @classmethod
    def glob(class_, image_glob):
       """Return a possibly-empty iterator of images in the storage directory
@@ -275,16 +356,31 @@ class Image:
       (self.unpack_path // GIT_DIR).unlink(missing_ok=True)
       self.unpack_init()
 
-   def layers_open(self, layer_tars):
+   def layers_open(self, layer_tars, listings=None, listing_cache_p=False,
+                   start=1):
       """Open the layer tarballs and read some metadata (which unfortunately
-         means reading the entirety of every file). Return an OrderedDict:
+         means reading the entirety of every file, unless the member list is
+         already in listings, a dictionary mapping layer hash to a sequence of
+         fs.Tar_Member objects, e.g. gathered while downloading; entries are
+         removed as they are used). If listing_cache_p, the tarballs are named
+         by their digest, as in the download cache, and listings are also
+         loaded from and saved to the download cache. start is the number of
+         the first layer, for messages, if lower layers were unpacked some
+         other way. Return an OrderedDict:
 
            keys:    layer hash (full)
            values:  namedtuple with two fields:
                       fp:       open TarFile object
-                      members:  sequence of members (OrderedSet)
+                      members:  sequence of members (OrderedSet of
+                                fs.Tar_Member)
 
-         Empty layers are skipped.
+         We don’t keep TarInfo objects around (the TarFile’s own member list
+         is left empty), because for images with millions of files they can
+         take gigabytes of memory.
+
+         Empty layers are skipped. Layers may be compressed with anything
+         tarfile understands, or zstd, which is decompressed to a temporary
+         file first.
 
          Important note: TarFile.extractall() extracts the given members in
          the order they are specified, so we need to preserve their order from
@@ -297,13 +393,43 @@ class Image:
       # entries like CMD (https://github.com/containers/skopeo/issues/393).
       # Unpacking an empty layer doesn’t accomplish anything, so ignore them.
       empty_cnt = 0
-      for (i, path) in enumerate(layer_tars, start=1):
+      if (listings is None):
+         listings = dict()
+      layer_ct = start - 1 + len(layer_tars)
+      for (i, path) in enumerate(layer_tars, start=start):
          lh = os.path.basename(path).split(".", 1)[0]
          lh_short = lh[:7]
-         ch.INFO("layer %d/%d: %s: listing" % (i, len(layer_tars), lh_short))
          try:
-            fp = fs.TarFile.open(path)
-            members = ch.OrderedSet(fp.getmembers())  # reads whole file :(
+            if (fs.Path(path).file_zstd_p()):
+               ch.INFO("layer %d/%d: %s: decompressing zstd"
+                       % (i, layer_ct, lh_short))
+               fp = fs.TarFile.open(fileobj=fs.Path(path).file_unzstd())
+            else:
+               fp = fs.TarFile.open(path)
+            listing_path = None
+            if (listing_cache_p):
+               listing_path = ch.storage.listing_for_download(lh)
+            members = None
+            if (lh in listings):
+               ch.INFO("layer %d/%d: %s: listed while downloading"
+                       % (i, layer_ct, lh_short))
+               members = listings.pop(lh)
+            elif (listing_path is not None and ch.dlcache_p):
+               members = fs.Tar_Member.listing_load(listing_path)
+               if (members is not None):
+                  ch.INFO("layer %d/%d: %s: using cached listing"
+                          % (i, layer_ct, lh_short))
+                  listing_path = None  # already saved
+            if (members is None):
+               ch.INFO("layer %d/%d: %s: listing"
+                       % (i, layer_ct, lh_short))
+               members = fp.members_compact()  # reads whole file :(
+            else:
+               fp.members_set([])
+            if (listing_path is not None):
+               ch.VERBOSE("saving listing: %s" % listing_path)
+               fs.Tar_Member.listing_save(listing_path, members)
+            members = ch.OrderedSet(members)
          except tarfile.TarError as x:
             ch.FATAL("cannot open: %s: %s" % (path, x))
          if (lh in layers and len(members) > 0):
@@ -435,37 +561,158 @@ class Image:
       for path in metadata["volumes"]:
          (self.unpack_path // path).mkdirs()
 
-   def tarballs_write(self, tarball_dir):
-      """Write one uncompressed tarball per layer to tarball_dir. Return a
-         sequence of tarball basenames, with the lowest layer first."""
-      # FIXME: Yes, there is only one layer for now and we’ll need to update
-      # it when (if) we have multiple layers. But, I wanted the interface to
-      # support multiple layers.
-      base = "%s.tar" % self.ref.for_path
-      path = tarball_dir // base
+   def overwrites_resolve(self, layers, last_layer):
+      """Ignore members that a later layer (up to last_layer) would replace
+         anyway, so each path is written at most once when extracting. This
+         is (1) members with the same path as a member of a later layer, and
+         (2) members under a path that’s a non-directory in a later layer,
+         because extracting that deletes the directory. Members that are the
+         target of a hard link are kept, since the link might need them.
+         Whiteouts must already be resolved."""
+      ch.VERBOSE("resolving overwrites")
+      links = { os.path.normpath(m.linkname)
+                for (_, members) in layers.values()
+                for m in members if m.islnk() }
+      later = set()          # paths in later layers
+      later_nondirs = set()  # non-directory paths in later layers
+      layers_r = list(enumerate(layers.items(), start=1))[:last_layer]
+      layers_r.reverse()
+      ig_total = 0
+      for (i, (lh, (fp, members))) in layers_r:
+         paths = list()
+         ig_ct = 0
+         for m in list(members):  # copy b/c we remove items from the set
+            path = os.path.normpath(m.name)
+            paths.append((path, m.isdir()))
+            if (path in links):
+               continue
+            parent = os.path.dirname(path)
+            overwrite = (path in later)
+            while (not overwrite and parent not in ("", "/")):
+               overwrite = (parent in later_nondirs)
+               parent = os.path.dirname(parent)
+            if (overwrite):
+               ch.TRACE("layer %d/%d: %s: overwritten later: %s"
+                        % (i, len(layers), lh[:7], m.name))
+               members.remove(m)
+               ig_ct += 1
+         for (path, dir_p) in paths:
+            later.add(path)
+            if (not dir_p):
+               later_nondirs.add(path)
+         if (ig_ct > 0):
+            ch.VERBOSE("layer %d/%d: %s: %d members overwritten later"
+                       % (i, len(layers), lh[:7], ig_ct))
+         ig_total += ig_ct
+      ch.VERBOSE("skipping %d overwritten members" % ig_total)
+
+   def snapshot_save(self, layer_hashes, top_dirs):
+      """Keep a snapshot of the unpack directory, which must contain exactly
+         the layer chain layer_hashes, whose top-level directories are
+         top_dirs."""
+      path = ch.storage.snapshot_for_layers(layer_hashes)
+      tmp = path.suffix_add(".partial")
+      ch.VERBOSE("saving snapshot: %s" % path)
+      ch.storage.snapshot_cache.mkdir()
+      for i in (path, tmp):  # unusable, e.g. from another version
+         if (os.path.isdir(i)):
+            i.rmtree()
+      if (not self.unpack_path.reflink_tree(tmp)):
+         ch.WARNING("can’t reflink in storage directory; not saving snapshot")
+         return
+      tmp.rename(path)
+      path.suffix_add(".json").file_write(json.dumps(
+         { "layers": list(layer_hashes),
+           "top_dirs": sorted(top_dirs),
+           "version": version.VERSION }, indent=2) + "\n")
+
+   def tarball_write(self, fp, lower=None):
+      """Write the image as an uncompressed layer tarball to binary file
+         object fp, which need not be seekable. If lower (another Image) is
+         given, write only what’s needed to turn lower into this image when
+         applied on top of it: new and changed files and whiteouts for
+         removed ones."""
       try:
-         ch.INFO("layer 1/1: gathering")
-         ch.VERBOSE("writing tarball: %s" % path)
-         fp = fs.TarFile.open(path, "w", format=tarfile.PAX_FORMAT)
+         tf = fs.TarFile.open(fileobj=fp, mode="w|",
+                              format=tarfile.PAX_FORMAT)
          unpack_path = self.unpack_path.resolve()  # aliases use symlinks
          ch.VERBOSE("canonicalized unpack path: %s" % unpack_path)
-         fp.add_(unpack_path, arcname=".")
-         fp.close()
+         if (lower is None):
+            tf.add_(unpack_path, arcname=".")
+         else:
+            ch.VERBOSE("relative to: %s" % lower.unpack_path)
+            self.tarball_write_diff(tf, unpack_path,
+                                    lower.unpack_path.resolve(), ".")
+         tf.close()
       except OSError as x:
          ch.FATAL("can’t write tarball: %s" % x.strerror)
-      return [base]
 
-   def unpack(self, layer_tars, last_layer=None):
+   def tarball_write_diff(self, tf, upper, lower, rel):
+      """Add to TarFile tf the differences between directory rel (relative
+         path starting with “.”) in trees upper and lower, recursively. A
+         file is unchanged if its type, mode, and size are the same, and
+         either its modification time or content are too (so checking out
+         the same files again doesn’t count as a change)."""
+      names_upper = sorted(os.listdir(upper // rel))
+      names_lower = set(os.listdir(lower // rel))
+      whiteouts = names_lower - set(names_upper)
+      # If the type changed, white out the old one and add the new one from
+      # scratch, lest they be merged (e.g., directories) or clobber oddly.
+      for name in names_upper:
+         if (name in names_lower):
+            st_u = (upper // rel // name).stat(False)
+            st_l = (lower // rel // name).stat(False)
+            if (stat.S_IFMT(st_u.st_mode) != stat.S_IFMT(st_l.st_mode)):
+               names_lower.remove(name)
+               whiteouts.add(name)
+      # Whiteouts go before other entries in the same directory, per the OCI
+      # spec.
+      for name in sorted(whiteouts):
+         if ("%s/%s" % (rel, name) in ("./ch/git", "./ch/git.pickle")):
+            continue  # never pushed (see TarFile.add_())
+         ch.DEBUG("whiteout: %s/%s" % (rel, name))
+         ti = tarfile.TarInfo("%s/.wh.%s" % (rel, name))
+         ti.mode = 0o644
+         tf.addfile(ti)
+      for name in names_upper:
+         path_u = upper // rel // name
+         path_l = lower // rel // name
+         arcname = "%s/%s" % (rel, name)
+         if (name not in names_lower):
+            tf.add_(path_u, arcname=arcname)  # new: add recursively
+            continue
+         st_u = path_u.stat(False)
+         st_l = path_l.stat(False)
+         if (stat.S_ISDIR(st_u.st_mode)):
+            if (st_u.st_mode != st_l.st_mode):
+               tf.add_(path_u, arcname=arcname, recursive=False)
+            self.tarball_write_diff(tf, upper, lower, arcname)
+         elif (   st_u.st_mode != st_l.st_mode
+               or st_u.st_size != st_l.st_size
+               or (    stat.S_ISLNK(st_u.st_mode)
+                   and os.readlink(path_u) != os.readlink(path_l))
+               or (    stat.S_ISREG(st_u.st_mode)
+                   and st_u.st_mtime_ns != st_l.st_mtime_ns
+                   and not filecmp.cmp(path_u, path_l, shallow=False))):
+            tf.add_(path_u, arcname=arcname)
+
+   def unpack(self, layer_tars, last_layer=None, listings=None,
+              listing_cache_p=False):
       """Unpack config_json (path to JSON config file) and layer_tars
          (sequence of paths to tarballs, with lowest layer first) into the
          unpack directory, validating layer contents and dealing with
          whiteouts. Empty layers are ignored. The unpack directory must not
-         exist."""
+         exist. listings and listing_cache_p are passed to layers_open(); if
+         the latter, layers may also be unpacked from snapshots (see
+         unpack_layers_snapshot())."""
       if (last_layer is None):
          last_layer = sys.maxsize
       ch.INFO("flattening image")
-      self.unpack_layers(layer_tars, last_layer)
+      self.unpack_layers(layer_tars, last_layer, listings, listing_cache_p)
       self.unpack_init()
+      # ru_maxrss is in KiB on Linux.
+      ch.VERBOSE("peak memory: %d MiB"
+                 % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
 
    def unpack_cache_unlink(self):
       (self.unpack_path // ".git").unlink()
@@ -522,26 +769,366 @@ class Image:
       (self.unpack_path // "etc/hosts").file_ensure_exists()
       (self.unpack_path // "etc/resolv.conf").file_ensure_exists()
 
-   def unpack_layers(self, layer_tars, last_layer):
-      layers = self.layers_open(layer_tars)
-      self.validate_members(layers)
-      self.whiteouts_resolve(layers)
-      self.unpack_path.mkdir()  # create directory in case no layers
-      for (i, (lh, (fp, members))) in enumerate(layers.items(), start=1):
-         lh_short = lh[:7]
+   def unpack_layer(self, i, layer_ct, lh, fp, members, waits=()):
+      """Extract members of layer i (of layer_ct) from TarFile fp, after the
+         futures in waits are done."""
+      for f in waits:
+         f.result()
+      ch.INFO("layer %d/%d: %s: extracting" % (i, layer_ct, lh[:7]))
+      try:
+         if (ch.unpack_backend == "tar"):
+            fp.extractall_tar(self.unpack_path,
+                              (m.tarinfo() for m in members))
+         else:
+            fp.extractall(path=self.unpack_path,
+                          members=(m.tarinfo() for m in members))
+      except OSError as x:
+         ch.FATAL("can’t extract layer %d: %s" % (i, x.strerror))
+
+   def unpack_layers(self, layer_tars, last_layer, listings=None,
+                     listing_cache_p=False):
+      if (ch.unpack_backend == "tar"):
+         fs.gnu_tar_check()
+      if (    listing_cache_p and ch.unpack_snapshots > 0
+          and last_layer >= len(layer_tars)):
+         self.unpack_layers_snapshot(layer_tars, listings)
+      else:
+         layers = self.layers_open(layer_tars, listings, listing_cache_p)
+         self.validate_members(layers)
+         self.unpack_path.mkdir()  # create directory in case no layers
+         self.unpack_layers_extract(layers, last_layer)
+
+   def unpack_layers_deps(self, layers):
+      """Return a dictionary mapping the index of each layer in layers, a
+         sequence of (index, hash, TarFile, members) tuples, to the set of
+         indexes of layers that must be extracted before it because it has
+         hard links to their files. Return None if the layers are unsuitable
+         for parallel extraction, i.e. a path is written more than once (only
+         possible within a layer or for hard link targets; see
+         overwrites_resolve()), a hard link precedes its target, or a hard
+         link target is under a path that’s a non-directory in some layer
+         (overwrites_resolve() keeps the target, so its directory would
+         already exist when the non-directory is extracted). E.g., this image
+         unpacks the same with one job or several:
+
+           >>> import io, tempfile
+           >>> def tarball(*members):
+           ...    buf = io.BytesIO()
+           ...    with tarfile.open(fileobj=buf, mode="w") as tf:
+           ...       for (name, type_, target, data) in members:
+           ...          ti = tarfile.TarInfo(name)
+           ...          (ti.type, ti.linkname, ti.size) = (type_, target,
+           ...                                             len(data))
+           ...          tf.addfile(ti, io.BytesIO(data))
+           ...    return buf
+           >>> bufs = [tarball(("bin", tarfile.DIRTYPE, "", b""),
+           ...                 ("a", tarfile.DIRTYPE, "", b""),
+           ...                 ("a/t", tarfile.REGTYPE, "", b"target"),
+           ...                 ("h", tarfile.LNKTYPE, "a/t", b"")),
+           ...         tarball(("a", tarfile.REGTYPE, "", b"not a dir"))]
+           >>> def unpack(jobs):
+           ...    layers = collections.OrderedDict()
+           ...    for (i, buf) in enumerate(bufs):
+           ...       _ = buf.seek(0)
+           ...       tf = fs.TarFile.open(fileobj=buf)
+           ...       layers[str(i)] = (tf, tf.members_compact())
+           ...    img = Image.__new__(Image)  # no attributes needed
+           ...    img.unpack_path = fs.Path(tempfile.mkdtemp())
+           ...    img.validate_members(layers)
+           ...    (jobs_old, ch.unpack_jobs) = (ch.unpack_jobs, jobs)
+           ...    try:
+           ...       img.unpack_layers_extract(layers, len(layers))
+           ...    finally:
+           ...       ch.unpack_jobs = jobs_old
+           ...    result = [(img.unpack_path // p).file_read_all()
+           ...              for p in ("a", "h")]
+           ...    img.unpack_path.rmtree()
+           ...    return result
+           >>> unpack(1)
+           ['not a dir', 'target']
+           >>> unpack(2)
+           ['not a dir', 'target']"""
+      nondirs = set()
+      targets = dict()  # key: hard link target, value: layers with links
+      for (i, _, _, members) in layers:
+         names = set()
+         for m in members:
+            if (m.name in names):
+               ch.VERBOSE("layer %d: duplicate member: %s" % (i, m.name))
+               return None
+            names.add(m.name)
+            if (not m.isdir()):
+               nondirs.add(m.name)
+            if (m.islnk()):
+               targets.setdefault(os.path.normpath(m.linkname), set()).add(i)
+      deps = { i: set() for (i, _, _, _) in layers }
+      if (len(targets) == 0):
+         return deps
+      writers = dict()  # key: hard link target, value: layer writing it
+      for (i, _, _, members) in layers:
+         for m in members:
+            if (m.name in targets):
+               if (m.name in writers):
+                  ch.VERBOSE("hard link target in layers %d and %d: %s"
+                             % (writers[m.name], i, m.name))
+                  return None
+               writers[m.name] = i
+      for path in writers:
+         parent = os.path.dirname(path)
+         while (parent != ""):
+            if (parent in nondirs):
+               ch.VERBOSE("layer %d: hard link target under non-directory: %s"
+                          % (writers[path], path))
+               return None
+            parent = os.path.dirname(parent)
+      for (path, linkers) in targets.items():
+         for i in linkers:
+            j = writers.get(path, i)  # missing target fails as usual
+            if (j > i):
+               ch.VERBOSE("layer %d: hard link to later layer %d: %s"
+                          % (i, j, path))
+               return None
+            if (j < i):
+               deps[i].add(j)
+      return deps
+
+   def unpack_layers_extract(self, layers, last_layer, start=1,
+                             layer_ct=None):
+      """Resolve whiteouts and overwrites in layers, as returned by
+         layers_open() and validated, then extract them into the unpack
+         directory, which must exist. start is the number of the first layer
+         and layer_ct the total, for messages. If start is greater than 1, the
+         unpack directory already contains the lower layers, so whiteouts are
+         applied to them too and the files to be replaced are removed first
+         (see unpack_lower_clear())."""
+      if (layer_ct is None):
+         layer_ct = len(layers)
+      whiteouts = self.whiteouts_resolve(layers)
+      self.overwrites_resolve(layers, last_layer)
+      if (start > 1):
+         self.whiteouts_apply(whiteouts)
+         self.unpack_lower_clear(layers)
+      todo = list()
+      for (i, (lh, (fp, members))) in enumerate(layers.items(), start=start):
          if (i > last_layer):
             ch.INFO("layer %d/%d: %s: skipping per --last-layer"
-                 % (i, len(layers), lh_short))
+                 % (i, layer_ct, lh[:7]))
          else:
-            ch.INFO("layer %d/%d: %s: extracting" % (i, len(layers), lh_short))
+            todo.append((i, lh, fp, members))
+      deps = None
+      if (min(ch.unpack_jobs, len(todo)) > 1):
+         deps = self.unpack_layers_deps(todo)
+      if (deps is None):
+         for (i, lh, fp, members) in todo:
+            self.unpack_layer(i, layer_ct, lh, fp, members)
+      else:
+         self.unpack_layers_parallel(todo, layer_ct, deps)
+
+   def unpack_layers_parallel(self, layers, layer_ct, deps):
+      """Extract layers, a sequence of (index, hash, TarFile, members)
+         tuples, using up to ch.unpack_jobs workers, each decompressing and
+         extracting one layer at a time. deps is as returned by
+         unpack_layers_deps().
+
+         Because overwrites are already resolved and no path is written
+         twice, layers are independent, except for (1) members inside or
+         through directories and symlinks from other layers and (2) hard
+         links to files in other layers. We deal with (1) by first creating,
+         serially in layer order, all directories and symlinks, plus
+         directories that exist only implicitly as parents of other members;
+         these have no data, so this is quick. Workers then extract regular
+         files and hard links without replacing anything (see
+         TarFile.clobber_p). For (2), a layer’s worker waits for the layers
+         its hard links point into. Finally, because the workers changed
+         their mtimes, directory modification times are set again."""
+      ch.INFO("creating directories and symlinks")
+      for (i, lh, fp, members) in layers:
+         parents = set()
+         for m in members:
+            if (not (m.isdir() or m.issym())):
+               parents.add(os.path.dirname(m.name))
+         try:
+            fp.extractall(path=self.unpack_path,
+                          members=(m.tarinfo() for m in members
+                                   if (m.isdir() or m.issym())))
+         except OSError as x:
+            ch.FATAL("can’t extract layer %d: %s" % (i, x.strerror))
+         for parent in sorted(parents):
+            (self.unpack_path // parent).mkdirs()
+      jobs = min(ch.unpack_jobs, len(layers))
+      ch.VERBOSE("extracting %d layers with %d workers" % (len(layers), jobs))
+      futures = dict()
+      with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+         # Layers are submitted in order and only wait for earlier ones, which
+         # are therefore already running or done, so waiting can’t deadlock.
+         for (i, lh, fp, members) in layers:
+            fp.clobber_p = False
+            futures[i] = pool.submit(self.unpack_layer, i, layer_ct, lh, fp,
+                                     [m for m in members
+                                        if not (m.isdir() or m.issym())],
+                                     [futures[j] for j in sorted(deps[i])])
+         try:
+            for f in concurrent.futures.as_completed(futures.values()):
+               f.result()  # re-raise exception from worker, if any
+         except BaseException:
+            for f in futures.values():
+               f.cancel()
+            raise
+      for (i, lh, fp, members) in layers:
+         for m in members:
+            if (m.isdir()):
+               try:
+                  fp.utime(m.tarinfo(), self.unpack_path // m.name)
+               except tarfile.ExtractError as x:
+                  ch.VERBOSE("layer %d: %s: %s" % (i, m.name, x))
+
+   def unpack_layers_snapshot(self, layer_tars, listings):
+      """Like unpack_layers(), but using snapshots: trees containing exactly
+         the first k layers of some image, kept in the storage directory so
+         that later images with the same first k layers (e.g., a common base
+         image) can start from a copy instead of unpacking those layers
+         again. layer_tars must be named by digest.
+
+         Copies are reflinks, which are cheap and independent of the
+         original, so this needs a filesystem that supports them. (Hard links
+         would be cheap too, but then modifying a file in one image would
+         modify it in the snapshot and every other image too.) We start from
+         the longest snapshot of our layers, if any. If we share more layers
+         with another image unpacked this way, we then unpack only those,
+         save that as a new snapshot, and continue. Each image’s chain is
+         recorded for reference counting (see snapshot_trim()).
+
+         Snapshots are only kept if the layers can’t be converted to a
+         tarbomb (see validate_members()), which would depend on any layers
+         above."""
+      hashes = [os.path.basename(p).split(".", 1)[0] for p in layer_tars]
+      chains = self.snapshot_chains_load()
+      chains.pop(str(self.unpack_path), None)  # we’re replacing it
+      # commonprefix() works with any sequences, not just strings.
+      shared = max((len(os.path.commonprefix((hashes, chain)))
+                    for chain in chains.values()), default=0)
+      have = 0  # number of layers from snapshot
+      top_dirs = set()
+      for k in range(len(hashes), 0, -1):
+         path = ch.storage.snapshot_for_layers(hashes[:k])
+         meta = self.snapshot_meta(path)
+         if (meta is None or meta["layers"] != hashes[:k]):
+            continue
+         ch.INFO("layer %d/%d: %s: copying snapshot of layers up to here"
+                 % (k, len(hashes), hashes[k-1][:7]))
+         if (not path.reflink_tree(self.unpack_path)):
+            ch.WARNING("can’t reflink snapshot; unpacking all layers")
+         else:
+            os.utime(path.suffix_add(".json"))  # last used for eviction
+            have = k
+            top_dirs = set(meta["top_dirs"])
+         break
+      if (have == 0):
+         self.unpack_path.mkdir()
+      layers = self.layers_open(layer_tars[have:], listings, True, have + 1)
+      if (self.validate_members(layers, top_dirs) or shared <= have):
+         self.unpack_layers_extract(layers, sys.maxsize, have + 1,
+                                    len(hashes))
+      else:
+         # Split off the layers above the shared ones.
+         lower = set(hashes[have:shared])
+         upper = collections.OrderedDict((lh, layer)
+                                         for (lh, layer) in layers.items()
+                                         if lh not in lower)
+         for lh in upper:
+            del layers[lh]
+         for (_, members) in layers.values():
+            top_dirs |= { m.name.partition("/")[0] for m in members
+                          if m.name != "." and ("/" in m.name or m.isdir()) }
+         self.unpack_layers_extract(layers, sys.maxsize, have + 1,
+                                    len(hashes))
+         if (len(top_dirs) == 1 and top_dirs.isdisjoint(STANDARD_DIRS)):
+            ch.VERBOSE("not saving snapshot: layers could become tarbomb")
+         else:
+            ch.INFO("layer %d/%d: %s: saving snapshot of layers up to here"
+                    % (shared, len(hashes), hashes[shared-1][:7]))
+            self.snapshot_save(hashes[:shared], top_dirs)
+         self.unpack_layers_extract(upper, sys.maxsize, shared + 1,
+                                    len(hashes))
+      chains[str(self.unpack_path)] = hashes
+      self.snapshot_trim(chains)
+
+   def unpack_lower_clear(self, layers):
+      """Remove files in the unpack directory that members of layers will
+         replace, except directories replaced by directories. This way a file
+         from a lower layer is never modified in place (it might be a hard
+         link to another file), and it’s safe to extract with
+         TarFile.clobber_p false or with tar(1), which won’t replace a
+         directory with a non-directory."""
+      ch.VERBOSE("removing lower-layer files replaced by upper layers")
+      rm_ct = 0
+      for (fp, members) in layers.values():
+         for m in members:
+            path = self.unpack_path // m.name
             try:
-               fp.extractall(path=self.unpack_path, members=members)
-            except OSError as x:
-               ch.FATAL("can’t extract layer %d: %s" % (i, x.strerror))
-
-   def validate_members(self, layers):
+               st = os.lstat(path)
+            except (FileNotFoundError, NotADirectoryError):
+               continue
+            if (not stat.S_ISDIR(st.st_mode)):
+               path.unlink()
+            elif (not m.isdir()):
+               path.rmtree()
+            else:
+               continue
+            rm_ct += 1
+      ch.VERBOSE("removed %d files" % rm_ct)
+
+   def validate_members(self, layers, top_dirs=()):
+      """Validate and fix the members of layers, as returned by
+         layers_open(). top_dirs are the top-level directories of lower layers
+         not in layers, which affect conversion to tarbomb. Return True if
+         converted, False otherwise.
+
+         Members can be TarInfo or fs.Tar_Member objects, with the same
+         results, including for whiteouts_resolve() afterwards:
+
+           >>> import io
+           >>> def tarball(*members):
+           ...    buf = io.BytesIO()
+           ...    with tarfile.open(fileobj=buf, mode="w") as tf:
+           ...       for (name, type_, mode, target) in members:
+           ...          ti = tarfile.TarInfo(name)
+           ...          (ti.type, ti.mode, ti.linkname) = (type_, mode, target)
+           ...          tf.addfile(ti)
+           ...    return buf
+           >>> (D, R, S, H) = (tarfile.DIRTYPE, tarfile.REGTYPE,
+           ...                 tarfile.SYMTYPE, tarfile.LNKTYPE)
+           >>> bufs = [tarball(("/x", D, 0o500, ""), ("bin", D, 0o755, ""),
+           ...                 ("x/d", D, 0o755, ""),
+           ...                 ("./x/d/f", R, 0o4400, ""), ("x/gone", R, 0, ""),
+           ...                 ("x/s", S, 0o777, "/x/d/f"),
+           ...                 ("x/h", H, 0o644, "/x/d/f")),
+           ...         tarball(("x/.wh.gone", R, 0o644, ""),
+           ...                 ("x/d/.wh..wh..opq", R, 0o644, ""),
+           ...                 ("x/d/g", R, 0o644, ""),
+           ...                 (".gitignore", R, 0o644, ""))]
+           >>> def resolve(compact):
+           ...    layers = collections.OrderedDict()
+           ...    for (i, buf) in enumerate(bufs):
+           ...       _ = buf.seek(0)
+           ...       tf = fs.TarFile.open(fileobj=buf)
+           ...       layers[str(i)] = (tf, (tf.members_compact() if compact
+           ...                              else tf.getmembers()))
+           ...    img = Image.__new__(Image)  # no attributes needed
+           ...    bomb_p = img.validate_members(layers)
+           ...    whiteouts = img.whiteouts_resolve(layers)
+           ...    members = [(m.name, m.type, oct(m.mode), m.linkname)
+           ...               for (_, ms) in layers.values() for m in ms]
+           ...    return (bomb_p, whiteouts, members)
+           >>> resolve(False) == resolve(True)
+           True
+           >>> resolve(True)  # doctest: +NORMALIZE_WHITESPACE
+           (False, [('x/gone', False), ('x/d', True)],
+            [('x', b'5', '0o700', ''), ('bin', b'5', '0o755', ''),
+             ('x/s', b'2', '0o777', '../x/d/f'),
+             ('x/h', b'1', '0o644', 'x/d/f'), ('x/d/g', b'0', '0o644', '')])"""
       ch.INFO("validating tarball members")
-      top_dirs = set()
+      top_dirs = set(top_dirs)
       ch.VERBOSE("pass 1: canonicalizing member paths")
       for (i, (lh, (fp, members))) in enumerate(layers.items(), start=1):
          abs_ct = 0
@@ -551,41 +1138,42 @@ class Image:
                ch.WARNING("layer %d/%d: %s: skipping member with empty path"
                        % (i, len(layers), lh[:7]))
                members.remove(m)
-            # Convert member paths to fs.Path objects for easier processing.
-            # Note: In my testing, parsing a string into a fs.Path object took
-            # about 2.5µs, so this should be plenty fast.
-            m.name = fs.Path(m.name)
+               continue
             # Reject members with up-levels.
-            if (".." in m.name.parts):
+            if (".." in m.name.split("/")):
                ch.FATAL("rejecting up-level member: %s: %s" % (fp.name, m.name))
+            # Canonicalize with plain string operations, which are much
+            # cheaper than a round trip through fs.Path for millions of
+            # members. Up-levels are gone, so normpath() only removes
+            # redundant slashes and “.” components.
+            m.name = os.path.normpath(m.name)
             # Correct absolute paths.
-            if (m.name.is_absolute()):
-               m.name = m.name.relative_to("/")
+            if (m.name.startswith("/")):
+               m.name = m.name.lstrip("/") or "."
                abs_ct += 1
             # Record top-level directory.
-            if (len(m.name.parts) > 1 or m.isdir()):
-               top_dirs.add(m.name.first)
+            if (m.name != "." and ("/" in m.name or m.isdir())):
+               top_dirs.add(m.name.partition("/")[0])
          if (abs_ct > 0):
             ch.WARNING("layer %d/%d: %s: fixed %d absolute member paths"
                     % (i, len(layers), lh[:7], abs_ct))
-      top_dirs.discard(None)  # ignore “.”
       # Convert to tarbomb if (1) there is a single enclosing directory and
       # (2) that directory is not one of the standard directories, e.g. to
       # allow images containing just “/bin/fooprog”.
-      if (len(top_dirs) != 1 or not top_dirs.isdisjoint(STANDARD_DIRS)):
+      bomb_p = (len(top_dirs) == 1 and top_dirs.isdisjoint(STANDARD_DIRS))
+      if (not bomb_p):
          ch.VERBOSE("pass 2: conversion to tarbomb not needed")
       else:
          ch.VERBOSE("pass 2: converting to tarbomb")
          for (i, (lh, (fp, members))) in enumerate(layers.items(), start=1):
             for m in members:
-               if (len(m.name.parts) > 0):  # ignore “.”
-                  m.name = fs.Path(*m.name.parts[1:])  # strip first component
+               if (m.name != "."):
+                  m.name = m.name.partition("/")[2] or "."  # strip first
       ch.VERBOSE("pass 3: analyzing members")
       for (i, (lh, (fp, members))) in enumerate(layers.items(), start=1):
          dev_ct = 0
          link_fix_ct = 0
          for m in list(members):  # copy again
-            m.name = str(m.name)  # other code assumes strings
             if (m.isdev()):
                # Device or FIFO: Ignore.
                dev_ct += 1
@@ -621,30 +1209,113 @@ class Image:
          if (link_fix_ct > 0):
             ch.INFO("layer %d/%d: %s: changed %d absolute symbolic and/or hard links to relative"
                     % (i, len(layers), lh[:7], link_fix_ct))
+      return bomb_p
 
-   def whiteout_rm_prefix(self, layers, max_i, prefix):
+   def whiteout_rm_prefix(self, layers, indexes, max_i, prefix):
       """Ignore members of all layers from 1 to max_i inclusive that have path
          prefix of prefix. For example, if prefix is foo/bar, then ignore
-         foo/bar and foo/bar/baz but not foo/barbaz. Return count of members
-         ignored."""
+         foo/bar and foo/bar/baz but not foo/barbaz; if prefix is “.”, ignore
+         everything. Return count of members ignored.
+
+         indexes is a dictionary mapping layer number to a tuple of parallel
+         lists (paths, members): the layer’s normalized member paths, sorted,
+         and the corresponding members. Missing ones are created here, and
+         ignored members are removed from them too. Because a subtree is
+         contiguous when sorted, finding it is a binary search, so this takes
+         time proportional to the number of members ignored rather than the
+         size of every layer."""
       ch.TRACE("finding members with prefix: %s" % prefix)
       prefix = os.path.normpath(prefix)  # "./foo" == "foo"
       ignore_ct = 0
       for (i, (lh, (fp, members))) in enumerate(layers.items(), start=1):
          if (i > max_i): break
-         members2 = list(members)  # copy b/c we’ll alter members
-         for m in members2:
-            if (ch.prefix_path(prefix, m.name)):
+         if (i not in indexes):
+            index = sorted((os.path.normpath(m.name), j, m)
+                           for (j, m) in enumerate(members))
+            indexes[i] = ([p for (p, _, _) in index], [m for (_, _, m) in index])
+         (paths, mems) = indexes[i]
+         if (prefix == "."):
+            ranges = [(0, len(paths))]
+         else:
+            # Descendants are between “prefix/” and “prefix0”, because “0”
+            # sorts immediately after “/”. Other paths may sort between them
+            # and prefix itself (e.g. “prefix-foo”), so find it separately.
+            # Later range first so deleting it doesn’t move the earlier one.
+            ranges = [(bisect.bisect_left(paths, prefix + "/"),
+                       bisect.bisect_left(paths, prefix + "0")),
+                      (bisect.bisect_left(paths, prefix),
+                       bisect.bisect_right(paths, prefix))]
+         for (lo, hi) in ranges:
+            for m in mems[lo:hi]:
                ignore_ct += 1
                members.remove(m)
                ch.TRACE("layer %d/%d: %s: ignoring %s"
                      % (i, len(layers), lh[:7], m.name))
+            del paths[lo:hi]
+            del mems[lo:hi]
       return ignore_ct
 
+   def whiteouts_apply(self, whiteouts):
+      """Apply whiteouts, as returned by whiteouts_resolve(), to the lower
+         layers already in the unpack directory. Whiteouts through a symlink
+         are ignored, so we never delete anything outside the image."""
+      ch.VERBOSE("applying %d whiteouts to lower layers" % len(whiteouts))
+      rm_ct = 0
+      for (path, opaque_p) in whiteouts:
+         parts = os.path.normpath(path).split("/")
+         # An opaque whiteout’s directory mustn’t be a symlink either.
+         if (any(os.path.islink(self.unpack_path // "/".join(parts[:i]))
+                 for i in range(1, len(parts) + int(opaque_p)))):
+            ch.VERBOSE("ignoring whiteout through symlink: %s" % path)
+            continue
+         path = self.unpack_path // "/".join(parts)
+         if (not opaque_p):
+            victims = [path] if os.path.lexists(path) else []
+         elif (os.path.isdir(path)):
+            victims = [path // i for i in sorted(path.listdir())]
+         else:
+            victims = []
+         for victim in victims:
+            ch.TRACE("whiteout: removing: %s" % victim)
+            if (os.path.isdir(victim) and not os.path.islink(victim)):
+               victim.rmtree()
+            else:
+               victim.unlink()
+            rm_ct += 1
+      ch.VERBOSE("removed %d files and directories" % rm_ct)
+
    def whiteouts_resolve(self, layers):
       """Resolve whiteouts. See:
-         https://github.com/opencontainers/image-spec/blob/master/layer.md"""
+         https://github.com/opencontainers/image-spec/blob/master/layer.md
+
+         Return a list of (path, opaque_p) tuples, one for each whiteout, so
+         they can also be applied to lower layers not in layers (see
+         whiteouts_apply()). For example, siblings that sort between a
+         whited-out directory and its contents survive:
+
+           >>> def layer(*names):
+           ...    return (None, [tarfile.TarInfo(n) for n in names])
+           >>> layers = collections.OrderedDict((
+           ...    ("1", layer("dir", "dir/a", "dir/b/c", "./dir-foo", "dir.bak",
+           ...                "dir.bak/x", "dir0", "dirx", "top", "topx")),
+           ...    ("2", layer(".wh.dir", "./.wh.top", "dir.bak/.wh..wh..opq",
+           ...                "new"))))
+           >>> img = Image.__new__(Image)  # no attributes needed
+           >>> img.whiteouts_resolve(layers)
+           [('dir', False), ('./top', False), ('dir.bak', True)]
+           >>> [[m.name for m in ms] for (_, ms) in layers.values()]
+           [['./dir-foo', 'dir0', 'dirx', 'topx'], ['new']]
+
+         An opaque whiteout at top level removes everything below it:
+
+           >>> layers["3"] = layer(".wh..wh..opq", "z")
+           >>> img.whiteouts_resolve(layers)
+           [('', True)]
+           >>> [[m.name for m in ms] for (_, ms) in layers.values()]
+           [[], [], ['z']]"""
       ch.INFO("resolving whiteouts")
+      indexes = dict()  # see whiteout_rm_prefix()
+      whiteouts = list()
       for (i, (lh, (fp, members))) in enumerate(layers.items(), start=1):
          wo_ct = 0
          ig_ct = 0
@@ -658,15 +1329,21 @@ class Image:
                if (filename == ".wh..wh..opq"):
                   # “Opaque whiteout”: remove contents of dir_.
                   ch.DEBUG("found opaque whiteout: %s" % m.name)
-                  ig_ct += self.whiteout_rm_prefix(layers, i - 1, dir_)
+                  ig_ct += self.whiteout_rm_prefix(layers, indexes, i - 1,
+                                                   dir_)
+                  whiteouts.append((dir_, True))
                else:
                   # “Explicit whiteout”: remove same-name file without ".wh.".
+                  # Note dir_ is empty at top level.
                   ch.DEBUG("found explicit whiteout: %s" % m.name)
-                  ig_ct += self.whiteout_rm_prefix(layers, i - 1,
-                                                   dir_ + "/" + filename[4:])
+                  path = os.path.join(dir_, filename[4:])
+                  ig_ct += self.whiteout_rm_prefix(layers, indexes, i - 1,
+                                                   path)
+                  whiteouts.append((path, False))
          if (wo_ct > 0):
             ch.VERBOSE("layer %d/%d: %s: %d whiteouts; %d members ignored"
                     % (i, len(layers), lh[:7], wo_ct, ig_ct))
+      return whiteouts
 
 
 class Reference:
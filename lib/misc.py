@@ -12,6 +12,7 @@ import build_cache as bu
 import filesystem as fs
 import image as im
 import pull
+import push
 import version
 
 
@@ -65,11 +66,16 @@ def delete(cli):
          bu.cache.unpack_delete(img)
          to_delete = im.Reference.ref_to_pathstr(str(img))
          bu.cache.branch_delete(to_delete)
+         push.ulcache_forget(img.ref)
          delete_ct += 1
       if (delete_ct == 0):
          fail_ct += 1
          ch.ERROR("no matching image, can’t delete: %s" % ref)
    bu.cache.worktrees_fix()
+   # Forget the deleted images’ layer chains, evicting snapshots that only
+   # they used. (Reset removes the whole snapshot cache along with storage.)
+   if (ch.storage.snapshot_chains.exists()):
+      im.Image.snapshot_trim(im.Image.snapshot_chains_load())
    if (fail_ct > 0):
       ch.FATAL("unable to delete %d invalid image(s)" % fail_ct)
 
@@ -80,6 +86,20 @@ def gestalt_bucache_dot(cli):
    bu.have_deps()
    bu.have_dot()
 
+def gestalt_dlcache(cli):
+   (files, protected) = pull.dlcache_files()
+   def line(label, files):
+      (size, suffix) = ch.si_binary_bytes(sum(size for (_, size, _) in files))
+      print("%-10s %.1f%s in %d files" % (label + ":", size, suffix, len(files)))
+   print("%-10s %s" % ("path:", ch.storage.download_cache))
+   line("size", files)
+   if (ch.dlcache_max is None):
+      print("%-10s none" % "limit:")
+   else:
+      print("%-10s %.1f%s" % (("limit:",) + ch.si_binary_bytes(ch.dlcache_max)))
+   line("protected", [f for f in files if f[0] in protected])
+   line("evictable", [f for f in files if f[0] not in protected])
+
 def gestalt_logging(cli):
    ch.TRACE("trace")
    ch.DEBUG("debug")
@@ -1,9 +1,12 @@
+import concurrent.futures
 import json
 import os
 import os.path
+import stat
 
 import charliecloud as ch
 import build_cache as bu
+import filesystem as fs
 import image as im
 import registry as rg
 
@@ -20,26 +23,234 @@ manifests_internal = {
 }
 
 
+## Globals ##
+
+# If true, list layer tarballs while they download (--stream).
+stream_p = False
+
+
 ## Main ##
 
 def main(cli):
    # Set things up.
-   src_ref = im.Reference(cli.source_ref)
-   dst_ref = src_ref if cli.dest_ref is None else im.Reference(cli.dest_ref)
+   if (cli.from_file is not None):
+      if (cli.source_ref is not None):
+         ch.FATAL("--from-file incompatible with IMAGE_REF")
+      refs = refs_from_file(cli.from_file)
+   elif (cli.source_ref is None):
+      ch.FATAL("no image to pull", "specify IMAGE_REF or --from-file")
+   else:
+      refs = [(cli.source_ref, cli.dest_ref)]
+   refs = [(im.Reference(src), im.Reference(dst or src)) for (src, dst) in refs]
    if (cli.parse_only):
-      print(src_ref.as_verbose_str)
+      for (src_ref, _) in refs:
+         print(src_ref.as_verbose_str)
       ch.exit(0)
    if (ch.xattrs_save):
       ch.WARNING("--xattrs unsupported for “ch-image pull” (see FAQ)")
+   global stream_p
+   stream_p = cli.stream
+   if (cli.from_file is not None):
+      pull_many(refs, cli.last_layer)
+      dlcache_trim()
+      ch.done_notify()
+      return
+   (src_ref, dst_ref) = refs[0]
    dst_img = im.Image(dst_ref)
    ch.INFO("pulling image:    %s" % src_ref)
    if (src_ref != dst_ref):
       ch.INFO("destination:      %s" % dst_ref)
    ch.INFO("requesting arch:  %s" % ch.arch)
    bu.cache.pull_eager(dst_img, src_ref, cli.last_layer)
+   dlcache_trim()
    ch.done_notify()
 
 
+## Functions ##
+
+def blobs_download(blobs):
+   """Download blobs, which is a sequence of (HTTP, digest, path, size,
+      message, tee) tuples; size is the expected size in bytes or None if
+      unknown, and tee is None or passed to HTTP.blob_to_file(). Use up to
+      ch.download_jobs concurrent workers. Blobs are verified individually
+      against their digests.
+
+      If there is only one worker (or one blob), download serially with a
+      progress meter for each blob. Otherwise, log the messages up front and
+      show a single combined meter, because overlapping meters are
+      unreadable."""
+   jobs = min(ch.download_jobs, len(blobs))
+   if (jobs <= 1):
+      for (reg, digest, path, _, msg, tee) in blobs:
+         reg.blob_to_file(digest, path, msg, tee=tee)
+      return
+   for (_, _, _, _, msg, _) in blobs:
+      ch.INFO(msg)
+   sizes = [size for (_, _, _, size, _, _) in blobs]
+   length = None if None in sizes else sum(sizes)
+   ch.VERBOSE("downloading %d blobs with %d workers" % (len(blobs), jobs))
+   progress = ch.Progress("downloading %d blobs" % len(blobs),
+                          "MiB", 2**20, length)
+   with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+      futures = [pool.submit(reg.blob_to_file, digest, path, msg, progress,
+                             tee)
+                 for (reg, digest, path, _, msg, tee) in blobs]
+      try:
+         for f in concurrent.futures.as_completed(futures):
+            f.result()  # re-raise exception from worker, if any
+      except BaseException:
+         # Don’t start anything new; in-progress downloads finish anyway.
+         for f in futures:
+            f.cancel()
+         raise
+   progress.done()
+
+
+def dlcache_files():
+   """Return a list of (name, size, mtime) tuples for the regular files in
+      the download cache, and the set of those names that are protected from
+      eviction because they belong to images in the storage directory or the
+      build cache: manifests named for such an image, their cache validators,
+      and the config and layers they list."""
+   dlcache = ch.storage.download_cache
+   files = list()
+   for name in dlcache.listdir():
+      st = (dlcache // name).stat(False)
+      if (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+         files.append((name, st.st_size, st.st_mtime))
+   refs = set(ch.storage.unpack_base.listdir())
+   refs |= { b.rstrip("#") for b in bu.cache.branches() }
+   protected = set()
+   for (name, _, _) in files:
+      # Manifests are named “REF%DIGEST.manifest.json” or “REF.fat.json”,
+      # where REF may itself contain “%”.
+      if (name.endswith(".manifest.json")):
+         ref = name[:-len(".manifest.json")].rpartition("%")[0]
+      elif (name.endswith(".fat.json")):
+         ref = name[:-len(".fat.json")]
+      else:
+         continue
+      if (ref not in refs):
+         continue
+      protected |= { name,
+                     ch.storage.validators_for_download(dlcache // name).name }
+      try:
+         manifest = json.loads((dlcache // name).file_read_all())
+      except (json.JSONDecodeError, UnicodeDecodeError):
+         continue  # not our problem here
+      hashes = [manifest.get("config", {}).get("digest")]
+      hashes += [l.get("digest") or l.get("blobSum")
+                 for l in manifest.get("layers", manifest.get("fsLayers", []))]
+      for h in hashes:
+         if (h is not None):
+            h = ch.digest_trim(h)
+            protected |= { h + ".json", h + ".listing", h + ".tar.gz" }
+   return (files, protected)
+
+def dlcache_touch(path):
+   """Mark path, a file in the download cache, as recently used for LRU
+      eviction. Ignore failures, e.g. if it’s a hard link to someone else’s
+      file in a shared download cache."""
+   try:
+      os.utime(path, follow_symlinks=False)
+   except OSError as x:
+      ch.DEBUG("can’t touch: %s: %s" % (path, x.strerror))
+
+def dlcache_trim():
+   """If the download cache is larger than ch.dlcache_max, delete least
+      recently used files that aren’t protected (see dlcache_files()) until
+      it isn’t. File modification time is the last-used time."""
+   if (ch.dlcache_max is None):
+      return
+   (files, protected) = dlcache_files()
+   total = sum(size for (_, size, _) in files)
+   ch.VERBOSE("download cache: %d bytes, max %d" % (total, ch.dlcache_max))
+   if (total <= ch.dlcache_max):
+      return
+   evict_ct = 0
+   evict_bytes = 0
+   for (name, size, _) in sorted(files, key=lambda f: f[2]):
+      if (total <= ch.dlcache_max):
+         break
+      if (name in protected):
+         continue
+      ch.VERBOSE("evicting from download cache: %s" % name)
+      (ch.storage.download_cache // name).unlink()
+      total -= size
+      evict_ct += 1
+      evict_bytes += size
+   ch.INFO("download cache: evicted %d files (%.1f%s), now %.1f%s of %.1f%s"
+           % ((evict_ct,) + ch.si_binary_bytes(evict_bytes)
+              + ch.si_binary_bytes(total) + ch.si_binary_bytes(ch.dlcache_max)))
+   if (total > ch.dlcache_max):
+      ch.WARNING("download cache over limit, but the rest is in use by images")
+
+def pull_many(refs, last_layer=None):
+   """Pull the images in refs, a sequence of (source, destination) reference
+      pairs. First get all the manifests, then download the blobs needed by
+      any image, each only once, and finally unpack the images one at a time.
+      Unpacking is serial because the build cache is one Git repository."""
+   ch.INFO("requesting arch:  %s" % ch.arch)
+   pullets = list()
+   try:
+      for (i, (src_ref, dst_ref)) in enumerate(refs, start=1):
+         ch.INFO("image %d/%d: %s" % (i, len(refs), src_ref))
+         pullet = Image_Puller(im.Image(dst_ref), src_ref)
+         pullets.append(pullet)
+         # Architecture-unaware images switch to yolo, which must not stick.
+         arch = ch.arch
+         pullet.manifests_download()
+         ch.arch = arch
+      # Blob files are named by digest, so the same path means the same blob.
+      blobs = dict()
+      for (i, pullet) in enumerate(pullets, start=1):
+         for (reg, digest, path, size, msg, tee) in pullet.blobs_needed():
+            if (path in blobs):
+               ch.VERBOSE("already downloading for another image: %s"
+                          % path.name)
+               if (tee is not None):
+                  tee.close()  # never written, so listed the usual way later
+            else:
+               blobs[path] = (reg, digest, path, size,
+                              "image %d/%d: %s" % (i, len(pullets), msg), tee)
+      ch.INFO("downloading %d unique blobs for %d images"
+              % (len(blobs), len(pullets)))
+      blobs_download(list(blobs.values()))
+      for (i, pullet) in enumerate(pullets, start=1):
+         ch.INFO("image %d/%d: pulling: %s"
+                 % (i, len(pullets), pullet.src_ref))
+         if (pullet.image.ref != pullet.src_ref):
+            ch.INFO("destination:      %s" % pullet.image.ref)
+         bu.cache.pull_eager(pullet.image, pullet.src_ref, last_layer, pullet)
+   finally:
+      # Log mirror statistics and close sessions even if something failed.
+      for pullet in pullets:
+         pullet.done()
+
+def refs_from_file(path):
+   """Return a list of (source, destination) image reference strings from
+      the file at path. Each line is a source reference, optionally followed
+      by whitespace and a destination reference (otherwise, destination is
+      None). Blank lines and comments starting with “#” are ignored. Pulling
+      the same destination twice is an error."""
+   refs = list()
+   dsts = set()
+   for (i, line) in enumerate(path.file_read_all().splitlines(), start=1):
+      words = line.partition("#")[0].split()
+      if (len(words) == 0):
+         continue
+      if (len(words) > 2):
+         ch.FATAL("%s:%d: expected IMAGE_REF [DEST_REF]" % (path, i))
+      (src, dst) = (words + [None])[:2]
+      if ((dst or src) in dsts):
+         ch.FATAL("%s:%d: duplicate destination: %s" % (path, i, dst or src))
+      dsts.add(dst or src)
+      refs.append((src, dst))
+   if (len(refs) == 0):
+      ch.FATAL("no images listed: %s" % path)
+   return refs
+
+
 ## Classes ##
 
 class Image_Puller:
@@ -49,6 +260,9 @@ class Image_Puller:
                 "digests",
                 "image",
                 "layer_hashes",
+                "layer_sizes",   # bytes, or None if manifest doesn’t say
+                "listers",       # key: layer hash, value: fs.Tar_Lister
+                "paths_shared",  # key: layer hash, value: path read in place
                 "registry",
                 "sid_input",
                 "src_ref")
@@ -59,6 +273,9 @@ class Image_Puller:
       self.digests = dict()
       self.image = image
       self.layer_hashes = None
+      self.layer_sizes = None
+      self.listers = dict()
+      self.paths_shared = dict()
       self.registry = rg.HTTP(src_ref)
       self.sid_input = None
       self.src_ref = src_ref
@@ -85,62 +302,89 @@ class Image_Puller:
             digest = self.architectures[ch.arch]
          return ch.storage.manifest_for_download(self.image.ref, digest)
 
-   def done(self):
-      self.registry.close()
+   def blob_shared_get(self, path, in_place_ok):
+      """If a blob with the same filename as path is in a shared download
+         cache, make it available at path, preferably with a hard link, then
+         a reflink. If neither is possible and in_place_ok, return the shared
+         path so it can be read where it is; otherwise, copy it. Return None
+         if the blob isn’t shared, otherwise the path to use.
 
-   def download(self):
-      "Download image metadata and layers and put them in the download cache."
-      # Spec: https://docs.docker.com/registry/spec/manifest-v2-2/
-      ch.VERBOSE("downloading image: %s" % self.image)
-      have_skinny = False
-      try:
-         # fat manifest
-         if (ch.arch != "yolo"):
-            try:
-               self.fatman_load()
-               if (not self.architectures.in_warn(ch.arch)):
-                  ch.FATAL("requested arch unavailable: %s" % ch.arch,
-                           ("available: %s"
-                            % " ".join(sorted(self.architectures.keys()))))
-            except ch.No_Fatman_Error:
-               # currently, this error is only raised if we’ve downloaded the
-               # skinny manifest.
-               have_skinny = True
-               if (ch.arch == "amd64"):
-                  # We’re guessing that enough arch-unaware images are amd64 to
-                  # barge ahead if requested architecture is amd64.
-                  ch.arch = "yolo"
-                  ch.WARNING("image is architecture-unaware")
-                  ch.WARNING("requested arch is amd64; using --arch=yolo")
-               else:
-                  ch.FATAL("image is architecture-unaware",
-                           "consider --arch=yolo")
-         # manifest
-         self.manifest_load(have_skinny)
-      except ch.Image_Unavailable_Error:
-         if (ch.user() == "qwofford"):
-            h = "Quincy, use --auth!!"
-         else:
-            h = "if your registry needs authentication, use --auth"
-         ch.FATAL("unauthorized or not in registry: %s" % self.registry.ref, h)
+         Shared blobs are trusted, i.e., not verified against their digest,
+         so the shared directories should be writeable only by people
+         trusted to put blobs in them."""
+      if (not ch.dlcache_p):
+         return None
+      for dir_ in ch.storage.download_caches_shared:
+         src = dir_ // path.name
+         if (not src.is_file()):
+            continue
+         ch.VERBOSE("found in shared download cache: %s" % src)
+         path.unlink(missing_ok=True)
+         try:
+            os.link(src, path)
+            ch.VERBOSE("hard linked: %s" % path)
+            return path
+         except OSError as x:
+            # E.g., EXDEV (different filesystems) or EPERM (hard links to
+            # others’ files forbidden by fs.protected_hardlinks).
+            ch.VERBOSE("can’t hard link: %s" % x.strerror)
+         if (src.reflink(path)):
+            ch.VERBOSE("reflinked: %s" % path)
+            return path
+         if (in_place_ok):
+            ch.VERBOSE("reading in place: %s" % src)
+            return src
+         src.copy(path)
+         ch.VERBOSE("copied: %s" % path)
+         return path
+      return None
+
+   def blobs_needed(self):
+      """Return a list of blobs (config and layers) that are not already in
+         the download cache, in the format expected by blobs_download(). Log
+         the ones that are, or that can be used from a shared download
+         cache."""
+      blobs = list()
       # config
       ch.VERBOSE("config path: %s" % self.config_path)
       if (self.config_path is not None):
          if (os.path.exists(self.config_path) and ch.dlcache_p):
             ch.INFO("config: using existing file")
+            dlcache_touch(self.config_path)
+         elif (self.blob_shared_get(self.config_path, False) is not None):
+            ch.INFO("config: using shared file")
          else:
-            self.registry.blob_to_file(self.config_hash, self.config_path,
-                                       "config: downloading")
+            blobs.append((self.registry, self.config_hash, self.config_path,
+                          None, "config: downloading", None))
       # layers
-      for (i, lh) in enumerate(self.layer_hashes, start=1):
+      for (i, (lh, size)) in enumerate(zip(self.layer_hashes,
+                                           self.layer_sizes), start=1):
          path = self.layer_path(lh)
          ch.VERBOSE("layer path: %s" % path)
          msg = "layer %d/%d: %s" % (i, len(self.layer_hashes), lh[:7])
          if (os.path.exists(path) and ch.dlcache_p):
             ch.INFO("%s: using existing file" % msg)
+            dlcache_touch(path)
+            continue
+         path_shared = self.blob_shared_get(path, True)
+         if (path_shared is not None):
+            ch.INFO("%s: using shared file" % msg)
+            if (path_shared != path):
+               self.paths_shared[lh] = path_shared
          else:
-            self.registry.blob_to_file(lh, path, "%s: downloading" % msg)
-      # done
+            if (stream_p):
+               self.listers[lh] = fs.Tar_Lister(path.name)
+            blobs.append((self.registry, lh, path, size,
+                          "%s: downloading" % msg, self.listers.get(lh)))
+      return blobs
+
+   def done(self):
+      self.registry.close()
+
+   def download(self):
+      "Download image metadata and layers and put them in the download cache."
+      self.manifests_download()
+      blobs_download(self.blobs_needed())
       self.registry.close()
 
    def error_decode(self, data):
@@ -175,8 +419,7 @@ class Image_Puller:
          self.digests[ch.arch_host] = "no digest"
          return
       # raises Image_Unavailable_Error if needed
-      self.registry.fatman_to_file(self.fatman_path,
-                                   "manifest list: downloading")
+      self.registry.fatman_to_file(self.fatman_path, "manifest list")
       fm = self.fatman_path.json_from_file("fat manifest")
       if ("layers" in fm or "fsLayers" in fm):
          # Check for skinny manifest. If not present, create a symlink to the
@@ -217,8 +460,13 @@ class Image_Puller:
          ch.WARNING("no valid architectures found")
 
    def layer_path(self, layer_hash):
-      "Return the path to tarball for layer layer_hash."
-      return ch.storage.download_cache // (layer_hash + ".tar.gz")
+      """Return the path to tarball for layer layer_hash. This is in the
+         download cache unless it’s being read in place from a shared
+         download cache."""
+      try:
+         return self.paths_shared[layer_hash]
+      except KeyError:
+         return ch.storage.download_cache // (layer_hash + ".tar.gz")
 
    def manifest_digest_by_arch(self):
       "Return skinny manifest digest for target architecture."
@@ -252,6 +500,7 @@ class Image_Puller:
          ch.FATAL("manifest: %s: no key: %s" % (self.manifest_path, key))
       self.config_hash = None
       self.layer_hashes = None
+      self.layer_sizes = None
       # obtain the manifest
       try:
          # internal manifest library, e.g. for “FROM scratch”
@@ -265,9 +514,8 @@ class Image_Puller:
             digest = self.architectures[ch.arch]
          ch.DEBUG("manifest digest: %s" % digest)
          if (not have_skinny):
-            self.registry.manifest_to_file(self.manifest_path,
-                                          "manifest: downloading",
-                                          digest=digest)
+            self.registry.manifest_to_file(self.manifest_path, "manifest",
+                                           digest=digest)
          manifest = self.manifest_path.json_from_file("manifest")
       # validate schema version
       try:
@@ -301,21 +549,81 @@ class Image_Puller:
       if (key1 not in manifest):
          bad_key(key1)
       self.layer_hashes = list()
+      self.layer_sizes = list()
       for i in manifest[key1]:
          if (key2 not in i):
             bad_key("%s/%s" % (key1, key2))
          self.layer_hashes.append(ch.digest_trim(i[key2]))
+         self.layer_sizes.append(i.get("size"))  # absent in version 1
       if (version == 1):
          self.layer_hashes.reverse()
+         self.layer_sizes.reverse()
+      # zstd-compressed layers need a decompressor we may not have, so check
+      # now rather than after downloading. (We also detect them by content
+      # when unpacking, in case the media type lies.)
+      zstd_ct = sum(1 for i in manifest[key1]
+                      if i.get("mediaType", "").endswith("+zstd"))
+      if (zstd_ct > 0):
+         ch.VERBOSE("zstd-compressed layers: %d" % zstd_ct)
+         fs.zstd_check()
       # Remember State_ID input. We can’t rely on the manifest existing in
       # serialized form (e.g. for internal manifests), so re-serialize.
       self.sid_input = json.dumps(manifest, sort_keys=True)
 
+   def manifests_download(self):
+      """Download the fat manifest, if any, and manifest, and load them, so
+         we know which blobs the image needs. Mark them recently used even if
+         they didn’t need downloading."""
+      # Spec: https://docs.docker.com/registry/spec/manifest-v2-2/
+      ch.VERBOSE("downloading image: %s" % self.image)
+      have_skinny = False
+      try:
+         # fat manifest
+         if (ch.arch != "yolo"):
+            try:
+               self.fatman_load()
+               if (not self.architectures.in_warn(ch.arch)):
+                  ch.FATAL("requested arch unavailable: %s" % ch.arch,
+                           ("available: %s"
+                            % " ".join(sorted(self.architectures.keys()))))
+            except ch.No_Fatman_Error:
+               # currently, this error is only raised if we’ve downloaded the
+               # skinny manifest.
+               have_skinny = True
+               if (ch.arch == "amd64"):
+                  # We’re guessing that enough arch-unaware images are amd64 to
+                  # barge ahead if requested architecture is amd64.
+                  ch.arch = "yolo"
+                  ch.WARNING("image is architecture-unaware")
+                  ch.WARNING("requested arch is amd64; using --arch=yolo")
+               else:
+                  ch.FATAL("image is architecture-unaware",
+                           "consider --arch=yolo")
+         # manifest
+         self.manifest_load(have_skinny)
+      except ch.Image_Unavailable_Error:
+         if (ch.user() == "qwofford"):
+            h = "Quincy, use --auth!!"
+         else:
+            h = "if your registry needs authentication, use --auth"
+         ch.FATAL("unauthorized or not in registry: %s" % self.registry.ref, h)
+      for path in (self.fatman_path, self.manifest_path):
+         if (isinstance(path, fs.Path) and path.exists(links=True)):
+            dlcache_touch(path)
+
    def unpack(self, last_layer=None):
       layer_paths = [self.layer_path(h) for h in self.layer_hashes]
+      listings = { lh: l.members for (lh, l) in self.listers.items()
+                                 if l.members is not None }
+      self.listers.clear()  # so layers_open() can free listings as it goes
+      for lh in self.layer_hashes:
+         dlcache_touch(ch.storage.listing_for_download(lh))
       bu.cache.unpack_delete(self.image, missing_ok=True)
-      self.image.unpack(layer_paths, last_layer)
+      self.image.unpack(layer_paths, last_layer, listings, True)
       self.image.metadata_replace(self.config_path)
+      # Remember where we came from, so pushes can mount layers from there.
+      self.image.metadata["pulled_from"] = str(self.src_ref.canonical)
+      self.image.metadata_save()
       # Check architecture we got. This is limited because image metadata does
       # not store the variant. Move fast and break things, I guess.
       arch_image = self.image.metadata["arch"] or "unknown"
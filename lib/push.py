@@ -1,7 +1,11 @@
+import concurrent.futures
+import hashlib
 import json
 import os.path
 
 import charliecloud as ch
+import build_cache as bu
+import filesystem as fs
 import image as im
 import registry as rg
 import version
@@ -10,6 +14,20 @@ import version
 ## Main ##
 
 def main(cli):
+   try:
+      rg.upload_chunk_size = ch.size_parse(cli.chunk_size)
+   except ValueError as x:
+      ch.FATAL("--chunk-size: %s" % x)
+   ch.VERBOSE("upload chunk size: %d" % rg.upload_chunk_size)
+   if (cli.upload_jobs < 1):
+      ch.FATAL("--upload-jobs must be at least 1: %d" % cli.upload_jobs)
+   try:
+      compression = compression_parse(cli.compression)
+   except ValueError as x:
+      ch.FATAL("--compression: %s" % x)
+   ch.VERBOSE("compression: %s level %d" % compression)
+   if (compression[0] == "zstd"):
+      fs.zstd_check()
    src_ref = im.Reference(cli.source_ref)
    ch.INFO("pushing image:   %s" % src_ref)
    image = im.Image(src_ref, cli.image)
@@ -28,32 +46,107 @@ def main(cli):
       ch.INFO("destination:     %s" % dst_ref)
    else:
       dst_ref = im.Reference(cli.source_ref)
-   up = Image_Pusher(image, dst_ref)
+   up = Image_Pusher(image, dst_ref, cli.mount_from, cli.stream, cli.layers,
+                     cli.upload_jobs, compression)
    up.push()
    ch.done_notify()
 
 
+## Functions ##
+
+def compression_parse(text):
+   """Parse a --compression argument, “ALGORITHM[:LEVEL]”, and return a tuple
+      (algorithm, level). If level is not given, use 9 for gzip (the most
+      compression) and 3 for zstd (its own default, since its higher levels
+      are very slow). Raise ValueError if invalid.
+
+        >>> compression_parse("gzip")
+        ('gzip', 9)
+        >>> compression_parse("zstd:19")
+        ('zstd', 19)
+        >>> compression_parse("zstd:23")
+        Traceback (most recent call last):
+          ...
+        ValueError: invalid level for zstd, must be 1–22: 23"""
+   levels = { "gzip": (9, 1, 9),      # default, minimum, maximum
+              "zstd": (3, 1, 22) }
+   (alg, _, level) = text.partition(":")
+   if (alg not in levels):
+      raise ValueError("unknown algorithm: %s" % alg)
+   (default, min_, max_) = levels[alg]
+   if (level == ""):
+      return (alg, default)
+   if (not (level.isdigit() and min_ <= int(level) <= max_)):
+      raise ValueError("invalid level for %s, must be %d–%d: %s"
+                       % (alg, min_, max_, level))
+   return (alg, int(level))
+
+def ulcache_forget(ref):
+   """Delete the layers prepared for pushing image ref, if any, from the
+      upload cache."""
+   index = ch.storage.layers_for_upload(ref)
+   if (index.exists()):
+      for l in index.json_from_file("upload cache index")["layers"]:
+         (ch.storage.upload_cache // l["path"]).unlink(missing_ok=True)
+      index.unlink()
+
+
 ## Classes ##
 
+class Hash_Writer:
+   """Binary file-like object that passes data written to it through to
+      another, keeping a running SHA-256 hash and count of the data."""
+
+   __slots__ = ("fp",
+                "hash",
+                "size")
+
+   def __init__(self, fp):
+      self.fp = fp
+      self.hash = hashlib.sha256()
+      self.size = 0
+
+   def flush(self):
+      self.fp.flush()
+
+   def write(self, data):
+      self.hash.update(data)
+      self.size += len(data)
+      return self.fp.write(data)
+
+
 class Image_Pusher:
 
    # Note; We use functions to create the blank config and manifest to to
    # avoid copy/deepcopy complexity from just copying a default dict.
 
-   __slots__ = ("config",    # sequence of bytes
-                "dst_ref",   # destination of upload
-                "image",     # Image object we are uploading
-                "layers",    # list of (digest, .tar.gz path), lowest first
-                "manifest",  # sequence of bytes
-                "registry")  # destination registry
+   __slots__ = ("compression", # (algorithm, level) tuple for layers
+                "config",      # sequence of bytes
+                "dst_ref",     # destination of upload
+                "image",       # Image object we are uploading
+                "images",      # Images whose differences are the layers
+                "jobs",        # maximum number of concurrent uploads
+                "layers",      # list of dicts (see layers_cached())
+                "layers_mode", # “flat” or “base” (see image_chain())
+                "manifest",    # sequence of bytes
+                "mount_from",  # list of image refs to mount layers from
+                "registry",    # destination registry
+                "stream_p")    # True to prepare and upload layers in one pass
 
-   def __init__(self, image, dst_ref):
+   def __init__(self, image, dst_ref, mount_from=(), stream_p=False,
+                layers_mode="flat", jobs=1, compression=("gzip", 9)):
+      self.compression = compression
       self.config = None
       self.dst_ref = dst_ref
       self.image = image
+      self.images = None
+      self.jobs = jobs
       self.layers = None
+      self.layers_mode = layers_mode
       self.manifest = None
+      self.mount_from = list(mount_from)
       self.registry = None
+      self.stream_p = stream_p
 
    @classmethod
    def config_new(class_):
@@ -72,58 +165,164 @@ class Image_Pusher:
                "weirdal": "yankovic" }
 
    @classmethod
-   def manifest_new(class_):
-      "Return an empty manifest, ready to be filled in."
+   def manifest_new(class_, schema="docker2"):
+      """Return an empty manifest of schema (a key in rg.TYPES_MANIFEST),
+         ready to be filled in."""
       return { "schemaVersion": 2,
-               "mediaType": rg.TYPES_MANIFEST["docker2"],
-               "config": { "mediaType": rg.TYPE_CONFIG,
+               "mediaType": rg.TYPES_MANIFEST[schema],
+               "config": { "mediaType": (rg.TYPE_CONFIG_OCI if schema == "oci1"
+                                         else rg.TYPE_CONFIG),
                            "size": None,
                            "digest": None },
                "layers": [],
                "weirdal": "yankovic" }
 
-   def cleanup(self):
-      ch.INFO("cleaning up")
-      # Delete the tarballs since we can’t yet cache them.
-      for (_, tar_c) in self.layers:
-         ch.VERBOSE("deleting tarball: %s" % tar_c)
-         tar_c.unlink()
+   @property
+   def schema(self):
+      """Key in rg.TYPES_MANIFEST of the manifest we push. Docker’s works with
+         more registries, but zstd layers need OCI’s."""
+      return "oci1" if self.compression[0] == "zstd" else "docker2"
 
-   def prepare(self):
-      """Prepare self.image for pushing to self.dst_ref. Return tuple: (list
-         of gzipped layer tarball paths, config as a sequence of bytes,
-         manifest as a sequence of bytes).
+   def image_chain(self):
+      """Return the list of images whose differences make up our layers,
+         bottom first. With --layers=flat, that’s just the image itself. With
+         --layers=base, it’s also the image’s base image (i.e., its FROM),
+         that image’s base, and so on, as long as they’re in storage."""
+      chain = [self.image]
+      if (self.layers_mode == "base"):
+         img = self.image
+         while ("base_image" in img.metadata):
+            base = im.Image(im.Reference(img.metadata["base_image"]))
+            if (not base.unpack_exist_p):
+               ch.INFO("base image not in storage, not separating: %s"
+                       % base.ref)
+               break
+            if (str(base.ref) in (str(i.ref) for i in chain)):
+               break  # shouldn’t happen, but don’t loop forever
+            base.metadata_load()
+            chain.insert(0, base)
+            img = base
+         if (len(chain) == 1):
+            ch.WARNING("no base image known, pushing one layer: %s"
+                       % self.image.ref)
+         else:
+            ch.INFO("layers from: %s" % " ".join(str(i.ref) for i in chain))
+      return chain
 
-         There is not currently any support for re-using any previously
-         prepared files already in the upload cache, because we don’t yet have
-         a way to know if these have changed until they are already build."""
-      # Initializing an HTTP instance for the registry and doing a 'GET'
-      # request right out the gate ensures the user needs to authenticate
-      # before we prepare the image for upload (#1426).
-      self.registry = rg.HTTP(self.dst_ref)
-      self.registry.request("GET", self.registry._url_base)
-      tars_uc = self.image.tarballs_write(ch.storage.upload_cache)
-      tars_c = list()
-      config = self.config_new()
-      manifest = self.manifest_new()
-      # Prepare layers.
-      for (i, tar_uc) in enumerate(tars_uc, start=1):
-         ch.INFO("layer %d/%d: preparing" % (i, len(tars_uc)))
-         path_uc = ch.storage.upload_cache // tar_uc
+   def layers_cached(self, key):
+      """Return the layers prepared by a previous push of the image, as a list
+         of dictionaries with keys “diff_id” (hash of uncompressed tarball),
+         “digest” and “size” (of compressed tarball), and “path” (name of
+         compressed tarball in the upload cache), lowest first. If the image
+         has changed since then (i.e., key is different) or we don’t have
+         them, return None."""
+      index = ch.storage.layers_for_upload(self.image.ref)
+      if (not index.exists()):
+         return None
+      cached = index.json_from_file("upload cache index")
+      if (cached.get("key") != key):
+         ch.VERBOSE("prepared layers out of date: %s" % index)
+         return None
+      for l in cached["layers"]:
+         path = ch.storage.upload_cache // l["path"]
+         if (not path.exists() or path.file_size() != l["size"]):
+            ch.VERBOSE("prepared layer missing or wrong size: %s" % path)
+            return None
+      return cached["layers"]
+
+   def layers_key(self):
+      """Return a string that changes when the layers would: the layer mode,
+         the compression, and for each image in self.images, its build cache
+         commit, if any, plus a hash of the metadata of all its files, which
+         also catches changes made outside the build cache (e.g. “ch-run -w”)
+         and images not in the cache at all."""
+      key = [version.VERSION, self.layers_mode, "%s:%d" % self.compression]
+      for img in self.images:
+         (_, commit) = bu.cache.find_image(img)
+         tree = img.unpack_path.resolve().stat_hash_recursive()
+         key += [str(img.ref), str(commit), tree]
+      return " ".join(key)
+
+   def layers_pairs(self):
+      """Return a list of (lower, upper) tuples, one per layer, lowest first:
+         the layer is the changes from Image lower to Image upper, or all of
+         upper if lower is None."""
+      return list(zip([None] + self.images[:-1], self.images))
+
+   def layers_prepare(self, key):
+      """Write the image’s layer tarballs to the upload cache, compress them,
+         and record them with key for next time. Return them as for
+         layers_cached()."""
+      layers = list()
+      for (i, (lower, upper)) in enumerate(self.layers_pairs(), start=1):
+         msg = "layer %d/%d" % (i, len(self.images))
+         if (len(self.images) == 1):
+            name = "%s.tar" % self.image.ref.for_path
+         else:
+            name = "%s.%d.tar" % (self.image.ref.for_path, i)
+         path_uc = ch.storage.upload_cache // name
+         ch.INFO("%s: gathering" % msg)
+         ch.VERBOSE("writing tarball: %s" % path_uc)
+         fp = path_uc.open("wb")
+         upper.tarball_write(fp, lower)
+         ch.close_(fp)
+         ch.INFO("%s: preparing" % msg)
          hash_uc = path_uc.file_hash()
-         config["rootfs"]["diff_ids"].append("sha256:" + hash_uc)
-         size_uc = path_uc.file_size()
-         path_c = path_uc.file_gzip(["-9", "--no-name"])
-         tar_c = path_c.name
-         hash_c = path_c.file_hash()
-         size_c = path_c.file_size()
-         tars_c.append((hash_c, path_c))
-         manifest["layers"].append({ "mediaType": rg.TYPE_LAYER,
-                                     "size": size_c,
-                                     "digest": "sha256:" + hash_c })
-      # Prepare metadata.
+         (alg, level) = self.compression
+         if (alg == "zstd"):
+            path_c = path_uc.file_zstd(level)
+         else:
+            path_c = path_uc.file_gzip(["-%d" % level, "--no-name"])
+         layers.append({ "diff_id": hash_uc,
+                         "digest": path_c.file_hash(),
+                         "path": path_c.name,
+                         "size": path_c.file_size() })
+      ch.storage.layers_for_upload(self.image.ref).file_write(
+         json.dumps({ "key": key, "layers": layers }, indent=2))
+      return layers
+
+   def layers_stream(self):
+      """Upload the layers in one pass over the image: archive each one,
+         compressing the tarball and uploading the result as we go, and
+         hashing both the tarball and the compressed data along the way.
+         Nothing is written to disk. Return the layers as for
+         layers_cached(), except without “path”.
+
+         The downside is that we don’t know a layer’s digest until it’s
+         uploaded, so it’s uploaded even if the registry already has it."""
+      layers = list()
+      for (i, (lower, upper)) in enumerate(self.layers_pairs(), start=1):
+         msg = "layer %d/%d" % (i, len(self.images))
+         ch.INFO("%s: streaming" % msg)
+         up = self.registry.blob_upload_open("%s: uploading" % msg)
+         c = Hash_Writer(up)
+         (alg, level) = self.compression
+         if (alg == "zstd"):
+            cw = fs.Zstd_Writer(c, level)
+         else:
+            cw = fs.Gzip_Writer(c, level)
+         uc = Hash_Writer(cw)
+         upper.tarball_write(uc, lower)
+         cw.close()
+         up.close(c.hash.hexdigest())
+         layers.append({ "diff_id": uc.hash.hexdigest(),
+                         "digest": c.hash.hexdigest(),
+                         "size": c.size })
+      return layers
+
+   def metadata_prepare(self):
+      """Prepare config and manifest for self.layers, which must be known, as
+         sequences of bytes."""
       ch.INFO("preparing metadata")
-      self.image.metadata_load()
+      config = self.config_new()
+      manifest = self.manifest_new(self.schema)
+      type_layer = (rg.TYPE_LAYER_ZSTD if self.compression[0] == "zstd"
+                    else rg.TYPE_LAYER)
+      for l in self.layers:
+         config["rootfs"]["diff_ids"].append("sha256:" + l["diff_id"])
+         manifest["layers"].append({ "mediaType": type_layer,
+                                     "size": l["size"],
+                                     "digest": "sha256:" + l["digest"] })
       # Environment. Note that this is *not* a dictionary for some reason but
       # a list of name/value pairs separated by equals [1], with no quoting.
       #
@@ -140,21 +339,25 @@ class Image_Pusher:
       # (https://github.com/opencontainers/image-spec/blob/main/config.md).
       #
       # Thus, to push images built (or pulled) with Charliecloud we ensure the
-      # the total number of non-empty layers always totals one (1). To do this
-      # we iterate over the history entires backward searching for the first
-      # non-empty entry and preserve it; all others are set to empty.
+      # the total number of non-empty entries equals the number of layers
+      # we’re pushing (one, unless --layers=base). To do this we iterate over
+      # the history entries backward and preserve the first such non-empty
+      # entries; all others are set to empty. If there aren’t enough, we add
+      # entries for the missing layers at the beginning.
       hist = self.image.metadata["history"]
-      non_empty_winner = None
+      non_empty_winners = list()
       for i in range(len(hist) - 1, -1, -1):
-         if (   "empty_layer" not in hist[i].keys()
-             or (    "empty_layer" in hist[i].keys()
-                 and not hist[i]["empty_layer"])):
-            non_empty_winner = i
+         if (len(non_empty_winners) >= len(self.layers)):
             break
-      assert(non_empty_winner is not None)
-      for i in range(len(hist) - 1):
-         if (i != non_empty_winner):
+         if (not hist[i].get("empty_layer", False)):
+            non_empty_winners.append(i)
+      for i in range(len(hist)):
+         if (i not in non_empty_winners):
             hist[i]["empty_layer"] = True
+      for i in range(len(self.layers) - len(non_empty_winners)):
+         hist.insert(0, { "created": ch.now_utc_iso8601(),
+                          "created_by": "ch-image push (layer)",
+                          "empty_layer": False })
       config["history"] = hist
       # Pack it up to go.
       config_bytes = json.dumps(config, indent=2).encode("UTF-8")
@@ -164,21 +367,127 @@ class Image_Pusher:
       ch.DEBUG("config: %s\n%s" % (config_hash, config_bytes.decode("UTF-8")))
       manifest_bytes = json.dumps(manifest, indent=2).encode("UTF-8")
       ch.DEBUG("manifest:\n%s" % manifest_bytes.decode("UTF-8"))
-      # Store for the next steps.
-      self.layers = tars_c
       self.config = config_bytes
       self.manifest = manifest_bytes
 
+   def mount_sources(self):
+      """Return the list of repositories on the destination registry that
+         might already have our layers, to mount them from rather than upload
+         them: first those given with --mount-from, then the one the image (or
+         its base image) was pulled from, if known. Skip duplicates, the
+         destination itself, and those on other registries."""
+      dst = self.dst_ref.canonical
+      refs = [im.Reference(r) for r in self.mount_from]
+      if ("pulled_from" in self.image.metadata):
+         refs.append(im.Reference(self.image.metadata["pulled_from"]))
+      repos = list()
+      for ref in refs:
+         ref = ref.canonical
+         if ((ref.host, ref.port) != (dst.host, dst.port)):
+            ch.VERBOSE("can’t mount from other registry: %s" % ref)
+         elif (ref.path_full != dst.path_full
+               and ref.path_full not in repos):
+            repos.append(ref.path_full)
+      return repos
+
+   def prepare(self):
+      """Prepare self.image for pushing to self.dst_ref: set self.layers,
+         self.config, and self.manifest. When streaming, the layers (and thus
+         config and manifest) are instead prepared during upload.
+
+         Compressed layer tarballs are kept in the upload cache, so if the image
+         hasn’t changed since it was last pushed, we re-use them rather than
+         preparing them again (see layers_key())."""
+      # Initializing an HTTP instance for the registry and doing a 'GET'
+      # request right out the gate ensures the user needs to authenticate
+      # before we prepare the image for upload (#1426).
+      self.registry = rg.HTTP(self.dst_ref)
+      self.registry.request("GET", self.registry._url_base)
+      self.image.metadata_load()
+      self.images = self.image_chain()
+      self.registry.mount_from = self.mount_sources()
+      if (len(self.registry.mount_from) > 0):
+         ch.INFO("will try mounting layers from: %s"
+                 % " ".join(self.registry.mount_from))
+      if (self.stream_p):
+         return
+      # Prepare layers, unless we still have them from last time. Compute the
+      # key first so changes while we prepare them make it stale.
+      key = self.layers_key()
+      self.layers = self.layers_cached(key)
+      if (self.layers is not None):
+         ch.INFO("using %d prepared layer(s) from upload cache"
+                 % len(self.layers))
+      else:
+         ulcache_forget(self.image.ref)  # names may differ this time
+         self.layers = self.layers_prepare(key)
+      self.metadata_prepare()
+
    def push(self):
       self.prepare()
       self.upload()
-      self.cleanup()
 
    def upload(self):
       ch.INFO("starting upload")
-      for (i, (digest, tarball)) in enumerate(self.layers, start=1):
-         self.registry.layer_from_file(digest, tarball,
-                                 "layer %d/%d: " % (i, len(self.layers)))
-      self.registry.config_upload(self.config)
-      self.registry.manifest_upload(self.manifest)
+      if (self.stream_p):
+         self.layers = self.layers_stream()
+         self.metadata_prepare()
+         self.registry.config_upload(self.config)
+      elif (self.jobs == 1):
+         for (i, l) in enumerate(self.layers, start=1):
+            self.registry.layer_from_file(
+               l["digest"], ch.storage.upload_cache // l["path"],
+               "layer %d/%d: " % (i, len(self.layers)))
+         self.registry.config_upload(self.config)
+      else:
+         self.upload_parallel()
+      self.registry.manifest_upload(self.manifest,
+                                    rg.TYPES_MANIFEST[self.schema])
       self.registry.close()
+
+   def upload_parallel(self):
+      """Upload the layers and config using up to self.jobs concurrent
+         workers, which share the registry session. First, ask the registry
+         which blobs it already has, all at once; then upload the missing
+         layers with a single combined progress meter, as in
+         pull.blobs_download(). Thus, the upload takes about as long as the
+         largest missing layer rather than all of them.
+
+         Streamed layers aren’t uploaded this way because they’re produced
+         one at a time anyway."""
+      digests = [l["digest"] for l in self.layers]
+      digests.append(ch.bytes_hash(self.config))
+      ch.INFO("checking if %d blobs already in repository" % len(digests))
+      with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.jobs, len(digests))) as pool:
+         exists = list(pool.map(self.registry.blob_exists_p, digests))
+      # Config is small, so just upload it now.
+      self.registry.config_upload(self.config, exists.pop())
+      missing = list()
+      for (i, (l, e)) in enumerate(zip(self.layers, exists), start=1):
+         note = "layer %d/%d: %s" % (i, len(self.layers), l["digest"][:7])
+         if (e):
+            ch.INFO("%s: already present" % note)
+         else:
+            ch.INFO("%s: not present, uploading" % note)
+            missing.append((l, "layer %d/%d: " % (i, len(self.layers))))
+      if (len(missing) == 0):
+         return
+      jobs = min(self.jobs, len(missing))
+      ch.VERBOSE("uploading %d layers with %d workers" % (len(missing), jobs))
+      progress = ch.Progress("uploading %d layers" % len(missing), "MiB",
+                             2**20, sum(l["size"] for (l, _) in missing))
+      with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+         futures = [pool.submit(self.registry.layer_from_file, l["digest"],
+                                ch.storage.upload_cache // l["path"], note,
+                                False, progress)
+                    for (l, note) in missing]
+         try:
+            for f in concurrent.futures.as_completed(futures):
+               f.result()  # re-raise exception from worker, if any
+         except BaseException:
+            # Don’t start anything new; in-progress uploads finish anyway.
+            for f in futures:
+               f.cancel()
+            raise
+      progress.done()
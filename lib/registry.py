@@ -1,10 +1,16 @@
+import email.utils
 import getpass
 import hashlib
 import io
+import json
 import os
+import random
 import re
+import threading
+import time
 import types
 import urllib
+import urllib.parse
 
 import charliecloud as ch
 
@@ -36,7 +42,31 @@ TYPES_INDEX = \
    {"docker2": "application/vnd.docker.distribution.manifest.list.v2+json",
     "oci1":    "application/vnd.oci.image.index.v1+json"}
 TYPE_CONFIG = "application/vnd.docker.container.image.v1+json"
+TYPE_CONFIG_OCI = "application/vnd.oci.image.config.v1+json"
 TYPE_LAYER = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+TYPE_LAYER_ZSTD = "application/vnd.oci.image.layer.v1.tar+zstd"
+
+# Default bytes per request for chunked blob uploads.
+UPLOAD_CHUNK_SIZE_DEFAULT = 64 * 2**20
+
+# Seconds to wait for a mirror to respond if not specified.
+MIRROR_TIMEOUT_DEFAULT = 10
+
+# Response statuses that indicate a failure that might work if retried.
+STATUSES_TRANSIENT = { 408,   # Request Timeout
+                       429,   # Too Many Requests
+                       500,   # Internal Server Error
+                       502,   # Bad Gateway
+                       503,   # Service Unavailable
+                       504 }  # Gateway Timeout
+
+# Bearer token lifetime in seconds if the registry doesn’t say. This is the
+# default in the Docker token authentication specification.
+TOKEN_EXPIRES_DEFAULT = 60
+
+# Seconds before a bearer token’s stated expiry that we stop using it, to
+# allow for clock skew and request latency.
+TOKEN_EXPIRES_MARGIN = 10
 
 ## Globals ##
 
@@ -46,6 +76,118 @@ tls_verify = True
 # True if we talk to registries authenticated; false if anonymously.
 auth_p = False
 
+# Mirrors to try before the registry itself when pulling. Key is registry
+# host, optionally followed by colon and port; value is list of Mirror
+# objects in the order to try them.
+mirrors = dict()
+
+# Serializes read-modify-write of the token cache among threads.
+tokens_lock = threading.Lock()
+
+# Maximum number of times to retry a request that failed transiently, and
+# the initial and maximum delay in seconds between retries.
+retries = 5
+retry_delay_base = 1.0
+retry_delay_max = 60.0
+
+# Number of retries and seconds spent waiting for them, for the summary.
+retry_ct = 0
+retry_secs = 0.0
+retry_lock = threading.Lock()
+
+# Bytes per request when uploading blobs, or zero to upload each one in a
+# single request.
+upload_chunk_size = UPLOAD_CHUNK_SIZE_DEFAULT
+
+
+## Functions ##
+
+def mirror_add(spec):
+   """Add mirrors for a registry, given as “REGISTRY=MIRROR[,MIRROR...]”,
+      where REGISTRY is a host optionally followed by “:PORT”. See Mirror for
+      the mirror syntax. E.g.:
+
+        >>> mirror_add("quay.io=m1.example.com,m2.example.com:8443@5")
+        >>> [str(m) for m in mirrors["quay.io"]]
+        ['https://m1.example.com:443/v2/', 'https://m2.example.com:8443/v2/']"""
+   (regy, _, specs) = spec.partition("=")
+   if (regy == "" or specs == ""):
+      ch.FATAL("invalid mirror specification: %s" % spec,
+               "expected REGISTRY=MIRROR[,MIRROR...]")
+   mirrors.setdefault(regy, list()).extend(Mirror(s) for s in specs.split(","))
+
+def mirrors_for(ref):
+   """Return the list of mirrors for the registry of canonical image reference
+      ref. Mirrors configured for “HOST:PORT” come before those for “HOST”."""
+   return (  mirrors.get("%s:%d" % (ref.host, ref.port), list())
+           + mirrors.get(ref.host, list()))
+
+def retries_report():
+   "Log the number of retries and time spent waiting for them, if any."
+   if (retry_ct > 0):
+      ch.INFO("registry requests retried %d times, waiting %.1fs total"
+              % (retry_ct, retry_secs))
+
+def retry_after_parse(text):
+   """Return the delay in seconds given by the value of a Retry-After header,
+      which is either a number of seconds or an HTTP date, or None if it can’t
+      be parsed. E.g.:
+
+        >>> retry_after_parse("120")
+        120
+        >>> retry_after_parse("Wed, 21 Oct 2015 07:28:00 GMT")
+        0
+        >>> retry_after_parse("soon") is None
+        True"""
+   try:
+      return max(0, int(text))
+   except ValueError:
+      pass
+   try:
+      when = email.utils.parsedate_to_datetime(text)
+   except (TypeError, ValueError):
+      return None
+   return max(0, int(when.timestamp() - time.time()))
+
+def tokens_load():
+   """Return the dictionary of unexpired bearer tokens in the token cache,
+      which is empty if there is no cache or it can’t be parsed. Malformed
+      entries are skipped."""
+   path = ch.storage.token_cache
+   if (not path.exists()):
+      return dict()
+   try:
+      tokens = json.loads(path.file_read_all())
+   except json.JSONDecodeError as x:
+      ch.WARNING("ignoring invalid token cache: %s: %s" % (path, x.msg))
+      return dict()
+   if (not isinstance(tokens, dict)):
+      ch.WARNING("ignoring invalid token cache: %s: not an object" % path)
+      return dict()
+   now = time.time()
+   tokens_ok = dict()
+   for (k, v) in tokens.items():
+      if (not (    isinstance(v, dict)
+               and v.get("class") in ("Auth_Bearer_Anon", "Auth_Bearer_IDed")
+               and isinstance(v.get("token"), str)
+               and isinstance(v.get("auth_d"), dict)
+               and isinstance(v.get("expires"), (int, float)))):
+         ch.VERBOSE("ignoring malformed token cache entry: %s" % k)
+      elif (v["expires"] > now):
+         tokens_ok[k] = v
+   return tokens_ok
+
+def tokens_save(tokens):
+   """Write dictionary tokens to the token cache, readable only by the
+      user because the tokens are secrets."""
+   path = ch.storage.token_cache
+   fd = ch.ossafe("can’t open: %s" % path, os.open, path,
+                  os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+   ch.ossafe("can’t chmod: %s" % path, os.fchmod, fd, 0o600)
+   fp = ch.ossafe("can’t open: %s" % path, os.fdopen, fd, "wt")
+   ch.ossafe("can’t write: %s" % path, fp.write, json.dumps(tokens, indent=2))
+   ch.close_(fp)
+
 
 ## Classes ##
 
@@ -92,6 +234,13 @@ class Auth(requests.auth.AuthBase):
    def escalators(self):
       ...
 
+   @property
+   def stale_p(self):
+      """True if the authorization should be discarded, and the escalation
+         chain re-started from scratch, on HTTP 401 rather than escalating
+         from here; False otherwise."""
+      return False
+
    def escalate(self, reg, res):
       """Escalate to a higher level of authorization. Use the WWW-Authenticate
          header in failed response res if there is one."""
@@ -171,11 +320,15 @@ class Auth_Bearer_IDed(Auth):
    variant = "IDed"
 
    __slots__ = ("auth_d",
+                "cached_p",  # True if loaded from token cache
+                "expires",   # seconds since epoch when we stop using token
                 "token")
 
-   def __init__(self, token, auth_d):
+   def __init__(self, token, auth_d, expires, cached_p=False):
       self.token = token
       self.auth_d = auth_d
+      self.expires = expires
+      self.cached_p = cached_p
 
    @classmethod
    def authenticate(class_, reg, auth_d):
@@ -193,7 +346,10 @@ class Auth_Bearer_IDed(Auth):
          ch.VERBOSE("bearer token request rejected")
          return None
       # Create new instance.
-      i = class_(res.json()["token"], auth_d)
+      res_d = res.json()
+      expires = (  time.time() - TOKEN_EXPIRES_MARGIN
+                 + res_d.get("expires_in", TOKEN_EXPIRES_DEFAULT))
+      i = class_(res_d["token"], auth_d, expires)
       ch.VERBOSE("received bearer token: %s" % (i.token_short))
       return i
 
@@ -222,6 +378,13 @@ class Auth_Bearer_IDed(Auth):
       # the token request will fail.
       return (Auth_Bearer_IDed,)
 
+   @property
+   def stale_p(self):
+      # Tokens from the cache might be rejected for reasons other than
+      # insufficient scope, e.g. revocation, and expired ones certainly will
+      # be. Neither can be escalated in anonymous mode.
+      return (self.cached_p or time.time() >= self.expires)
+
    @property
    def token_short(self):
       return ("%s..%s" % (self.token[:8], self.token[-8:]))
@@ -301,19 +464,49 @@ class HTTP:
    """Transfers image data to and from a remote image repository via HTTPS.
 
       Note that ref refers to the *remote* image. Objects of this class have
-      no information about the local image."""
+      no information about the local image.
+
+      Requests may be made from multiple threads at once, e.g. for concurrent
+      blob downloads; these share the session and authorization. The lock
+      serializes escalation so only one thread does it.
+
+      If mirror is given, this object talks to that mirror instead of the
+      registry named in ref. Otherwise, it has one such object for each
+      mirror configured for ref’s registry, which share its credentials and
+      are used by request_mirrored().
+
+      When uploading, blobs missing from the repository are first mounted
+      from the repositories in mount_from, if any, which must be on the same
+      registry."""
 
    __slots__ = ("auth",
                 "creds",
+                "hits",        # requests answered by mirror
+                "lock",
+                "mirror",      # Mirror object, or None if talking to registry
+                "mirrors",     # HTTP objects for mirrors to try first
+                "misses",      # requests mirror failed to answer
+                "mount_from",  # repository paths to try mounting blobs from
                 "ref",
                 "session")
 
-   def __init__(self, ref):
+   def __init__(self, ref, mirror=None):
       # Need an image ref with all the defaults filled in.
       self.ref = ref.canonical
       self.auth = Auth_None()
       self.creds = Credentials()
+      self.hits = 0
+      self.lock = threading.Lock()
+      self.mirror = mirror
+      self.misses = 0
+      self.mount_from = list()
       self.session = None
+      self.mirrors = list()
+      if (mirror is None):
+         for m in mirrors_for(self.ref):
+            reg = HTTP(ref, m)
+            reg.creds = self.creds
+            self.mirrors.append(reg)
       # This is commented out because it prints full request and response
       # bodies to standard output (not stderr), which overwhelms the terminal.
       # Normally, a better debugging approach if you need this is to sniff the
@@ -365,10 +558,42 @@ class HTTP:
          ch.INFO("Docker Hub rate limit: %s pulls left of %s per %s hours (%s)"
                  % (left_ct, pull_ct, period, reason))
 
+   @staticmethod
+   def location(res):
+      """Return the URL in the Location header of response res, which may be
+         relative to the request URL."""
+      return urllib.parse.urljoin(res.url, res.headers["Location"])
+
+   @staticmethod
+   def upload_chunk_args(chunk, offset):
+      """Return keyword arguments for request() to PATCH chunk, which starts
+         at byte offset, to an upload session."""
+      headers = { "Content-Type": "application/octet-stream" }
+      if (len(chunk) > 0):
+         headers["Content-Range"] = "%d-%d" % (offset, offset + len(chunk) - 1)
+      return { "data": chunk, "headers": headers }
+
    @property
    def _url_base(self):
+      if (self.mirror is not None):
+         return self.mirror.url_base
       return "https://%s:%d/v2/" % (self.ref.host, self.ref.port)
 
+   @property
+   def token_key(self):
+      """Key in the token cache for our registry, repository, and identity
+         (username, or “anonymous”), or None if we don’t know the username
+         yet, because asking might be unnecessary."""
+      if (not auth_p):
+         identity = "anonymous"
+      elif (self.creds.username is not None):
+         identity = self.creds.username
+      elif ("CH_IMAGE_USERNAME" in os.environ):
+         identity = os.environ["CH_IMAGE_USERNAME"]
+      else:
+         return None
+      return "%s%s %s" % (self._url_base, self.ref.path_full, identity)
+
    def _url_of(self, type_, address):
       "Return an appropriate repository URL."
       return self._url_base + "/".join((self.ref.path_full, type_, address))
@@ -391,53 +616,144 @@ class HTTP:
       res = self.request("HEAD", url, {200,401,404})
       return (res.status_code == 200)
 
-   def blob_to_file(self, digest, path, msg):
-      "GET the blob with hash digest and save it at path."
+   def blob_mount(self, digest, note=""):
+      """Try to mount the blob with hash digest into the repository from each
+         repository in self.mount_from in turn, i.e., ask the registry to
+         link its existing copy rather than uploading it again [1]. Return a
+         tuple (mounted_p, url): mounted_p is True if this worked, and url is
+         the upload URL if the registry declined by starting an ordinary
+         upload session instead (HTTP 202), otherwise None. We stop at the
+         first such session rather than leave it dangling to try the next
+         repository.
+
+         [1]: https://github.com/opencontainers/distribution-spec/blob/main/spec.md#mounting-a-blob-from-another-repository"""
+      url = None
+      for repo in self.mount_from:
+         ch.VERBOSE("%s%s: trying mount from %s" % (note, digest[:7], repo))
+         # 401 and 404 mean we can’t read the source repository or it doesn’t
+         # exist; either way, try the next one.
+         res = self.request("POST", self._url_of("blobs", "uploads/"),
+                            {201, 202, 401, 404},
+                            params={ "mount": "sha256:%s" % digest,
+                                     "from": repo })
+         if (res.status_code == 201):
+            ch.INFO("%s%s: mounted from %s" % (note, digest[:7], repo))
+            return (True, None)
+         if (res.status_code == 202):
+            ch.VERBOSE("%s%s: mount declined; using its upload session"
+                       % (note, digest[:7]))
+            return (False, self.location(res))
+      return (False, None)
+
+   def blob_to_file(self, digest, path, msg, progress=None, tee=None):
+      """GET the blob with hash digest and save it at path. If progress is
+         given, update that meter rather than creating a new one. If tee is
+         given, also pass the data to it (see Progress_Writer)."""
       # /v2/library/hello-world/blobs/<layer-hash>
-      url = self._url_of("blobs", "sha256:" + digest)
-      sw = ch.Progress_Writer(path, msg)
-      self.request("GET", url, out=sw, hd=digest)
+      address = "sha256:" + digest
+      # If a previous download was interrupted, ask for just the rest of the
+      # blob. Servers that don’t support ranges ignore the header and send
+      # the whole thing (HTTP 200), which request() handles by starting over.
+      sw = ch.Progress_Writer(path, msg, progress, resume=ch.dlcache_p,
+                              tee=tee)
+      if (sw.offset > 0):
+         ch.VERBOSE("resuming partial download at byte %d: %s"
+                    % (sw.offset, sw.path_tmp))
+         res = self.request_mirrored("GET", "blobs", address,
+                                     {200, 206, 416}, out=sw, hd=digest,
+                                     headers={ "Range": "bytes=%d-"
+                                                        % sw.offset })
+         if (res.status_code == 416):
+            # Range not satisfiable, e.g. the partial file is actually
+            # complete or somehow too long; discard it and start over.
+            ch.VERBOSE("can’t resume: %s" % res.reason)
+            sw.discard()
+            self.request_mirrored("GET", "blobs", address, out=sw, hd=digest)
+      else:
+         self.request_mirrored("GET", "blobs", address, out=sw, hd=digest)
       sw.close()
 
-   def blob_upload(self, digest, data, note=""):
+   def blob_upload(self, digest, data, note="", exists_p=None,
+                   progress=None):
       """Upload blob with hash digest to url. data is the data to upload, and
          can be anything requests can handle; if it’s an open file, then it’s
-         wrapped in a Progress_Reader object. note is a string to prepend to
-         the log messages; default empty string."""
-      ch.INFO("%s%s: checking if already in repository" % (note, digest[:7]))
+         wrapped in a Progress_Reader object, which updates progress if
+         given (see Progress_Reader); the caller is then responsible for
+         logging the upload. note is a string to prepend to the log
+         messages; default empty string. If exists_p is not None, it’s what
+         blob_exists_p() already said about this blob, e.g. when checking
+         many blobs at once, and we don’t ask again.
+
+         Open files are uploaded in chunks of upload_chunk_size bytes (unless
+         it’s zero), which lets us resume rather than start over if the
+         connection fails and stay under request size limits of some
+         proxies; other data are uploaded in one request."""
       # 1. Check if blob already exists. If so, stop.
-      if (self.blob_exists_p(digest)):
+      if (exists_p is None):
+         ch.INFO("%s%s: checking if already in repository"
+                 % (note, digest[:7]))
+         exists_p = self.blob_exists_p(digest)
+      if (exists_p):
          ch.INFO("%s%s: already present" % (note, digest[:7]))
          return
+      # 2. Try to mount it from elsewhere on the registry. If that fails, the
+      # registry may have started an upload session for us to use instead.
+      (mounted_p, url) = self.blob_mount(digest, note)
+      if (mounted_p):
+         return
       msg = "%s%s: not present, uploading" % (note, digest[:7])
       if (isinstance(data, io.IOBase)):
-         data = ch.Progress_Reader(data, msg)
+         data = ch.Progress_Reader(data, msg, progress)
          data.start()
       else:
          ch.INFO(msg)
-      # 2. Get upload URL for blob.
-      url = self._url_of("blobs", "uploads/")
-      res = self.request("POST", url, {202})
-      # 3. Upload blob. We do a “monolithic” upload (i.e., send all the
-      # content in a single PUT request) as opposed to a “chunked” upload
-      # (i.e., send data in multiple PATCH requests followed by a PUT request
-      # with no body).
-      url = res.headers["Location"]
-      res = self.request("PUT", url, {201}, data=data,
-                         params={ "digest": "sha256:%s" % digest })
+      # 3. Get upload URL for blob, unless we have one already.
+      if (url is None):
+         url = self.upload_start()
+      # 4. Upload blob. Either a “chunked” upload (i.e., send data in multiple
+      # PATCH requests followed by a PUT request with no body) or a
+      # “monolithic” one (i.e., send all the content in a single PUT).
+      if (isinstance(data, ch.Progress_Reader) and upload_chunk_size > 0):
+         url = self.upload_chunks(url, data)
+         self.request("PUT", url, {201},
+                      params={ "digest": "sha256:%s" % digest },
+                      retry_restart=lambda kwargs: url)
+      else:
+         def upload_restart(kwargs):
+            # A failed upload might have left partial data in the registry’s
+            # upload session, so start over with a new one.
+            if (isinstance(data, ch.Progress_Reader)):
+               data.rewind()
+            return self.upload_start()
+         self.request("PUT", url, {201}, data=data,
+                      params={ "digest": "sha256:%s" % digest },
+                      retry_restart=upload_restart)
       if (isinstance(data, ch.Progress_Reader)):
          data.close()
-      # 4. Verify blob now exists.
+      # 5. Verify blob now exists.
       if (not self.blob_exists_p(digest)):
          ch.FATAL("blob just uploaded does not exist: %s" % digest[:7])
 
+   def blob_upload_open(self, msg):
+      """Start a chunked blob upload and return an Upload_Writer to write the
+         blob to. Unlike blob_upload(), the blob’s digest need not be known
+         in advance. msg is the progress meter message."""
+      return Upload_Writer(self, self.upload_start(), msg)
+
    def close(self):
+      for reg in self.mirrors:
+         if (reg.hits + reg.misses > 0):
+            ch.VERBOSE("mirror %s: %d hits, %d misses"
+                       % (reg.mirror, reg.hits, reg.misses))
+            reg.hits = 0
+            reg.misses = 0
+         reg.close()
       if (self.session is not None):
          self.session.close()
 
-   def config_upload(self, config):
+   def config_upload(self, config, exists_p=None):
       "Upload config (sequence of bytes)."
-      self.blob_upload(ch.bytes_hash(config), config, "config: ")
+      self.blob_upload(ch.bytes_hash(config), config, "config: ", exists_p)
 
    def escalate(self, res):
       "Try to escalate authorization; return True if successful, else False."
@@ -446,11 +762,13 @@ class HTTP:
          return False
       else:
          self.auth = auth
+         self.token_save()
          return True
 
-   def fatman_to_file(self, path, msg):
-      """GET the manifest for self.image and save it at path. This seems to
-         have four possible results:
+   def fatman_to_file(self, path, note):
+      """GET the manifest for self.image and save it at path, unless the copy
+         already there is current (see manifest_get()). note is the prefix for
+         log messages. This seems to have four possible results:
 
             1. HTTP 200, and body is a fat manifest: image exists and is
                architecture-aware.
@@ -464,135 +782,514 @@ class HTTP:
 
          This method raises Image_Unavailable_Error in case 3. The caller is
          responsible for distinguishing cases 1 and 2."""
-      url = self._url_of("manifests", self.ref.version)
-      pw = ch.Progress_Writer(path, msg)
       # Including TYPES_MANIFEST avoids the server trying to convert its v2
       # manifest to a v1 manifest, which currently fails for images
       # Charliecloud pushes. The error in the test registry is “empty history
       # when trying to create schema1 manifest”.
       accept = "%s;q=0.5" % ",".join(  list(TYPES_INDEX.values())
                                      + list(TYPES_MANIFEST.values()))
-      res = self.request("GET", url, out=pw, statuses={200, 401, 404, 429},
-                         headers={ "Accept" : accept })
-      pw.close()
+      res = self.manifest_get(path, note, self.ref.version,
+                              {200, 401, 404, 429}, accept)
+      if (res is None):
+         return
       if (res.status_code == 429):
          if (self.auth.anon_p):
             hint = "consider --auth"
          else:
             hint = None
          ch.FATAL("registry rate limit exceeded (HTTP 429)", hint)
-      elif (res.status_code != 200):
+      elif (res.status_code not in {200, 304}):
          ch.DEBUG(res.content)
          raise ch.Image_Unavailable_Error()
 
-   def layer_from_file(self, digest, path, note=""):
-      "Upload gzipped tarball layer at path, which must have hash digest."
+   def layer_from_file(self, digest, path, note="", exists_p=None,
+                       progress=None):
+      """Upload gzipped tarball layer at path, which must have hash digest.
+         exists_p and progress are as for blob_upload()."""
       # NOTE: We don’t verify the digest b/c that means reading the whole file.
       ch.VERBOSE("layer tarball: %s" % path)
       fp = path.open("rb")  # open file avoids reading it all into memory
-      self.blob_upload(digest, fp, note)
+      self.blob_upload(digest, fp, note, exists_p, progress)
       ch.close_(fp)
 
-   def manifest_to_file(self, path, msg, digest=None):
-      """GET manifest for the image and save it at path. If digest is given,
+   def manifest_get(self, path, note, address, statuses, accept):
+      """GET the manifest or manifest list at address (tag or digest), save
+         it at path, and return the response object. statuses is as for
+         request(); HTTP 304 Not Modified is also accepted. note is the prefix
+         for log messages.
+
+         If the download cache is enabled and path already exists, avoid
+         downloading it again if possible. If address is a digest, the
+         existing file is current if it matches, so we don’t talk to the
+         registry at all and return None. Otherwise, we send the ETag saved
+         from the previous download in If-None-Match, and the registry
+         replies 304 if it’s unchanged; if there was no ETag but there was a
+         digest (Docker-Content-Digest), we compare it to that from a HEAD
+         request instead. These validators are saved alongside path."""
+      path_valid = ch.storage.validators_for_download(path)
+      headers = { "Accept": accept }
+      if (ch.dlcache_p and path.exists()):
+         if (address.startswith("sha256:")):
+            if (path.file_hash() == address.split(":", 1)[1]):
+               ch.INFO("%s: using existing file" % note)
+               return None
+         elif (path_valid.exists()):
+            valid = path_valid.json_from_file("cache validators")
+            if (valid.get("etag") is not None):
+               headers["If-None-Match"] = valid["etag"]
+            elif (valid.get("digest") is not None):
+               res = self.request_mirrored("HEAD", "manifests", address,
+                                           statuses, headers=headers)
+               if (res.headers.get("Docker-Content-Digest")
+                   == valid["digest"]):
+                  ch.INFO("%s: unchanged, using existing file" % note)
+                  return res
+      pw = ch.Progress_Writer(path, "%s: downloading" % note)
+      res = self.request_mirrored("GET", "manifests", address,
+                                  statuses | {304}, out=pw, headers=headers)
+      pw.close()
+      if (res.status_code == 304):
+         ch.INFO("%s: unchanged, using existing file" % note)
+      elif (res.status_code == 200):
+         valid = { "etag": res.headers.get("ETag"),
+                   "digest": res.headers.get("Docker-Content-Digest") }
+         ch.VERBOSE("cache validators: %s" % valid)
+         path_valid.file_write(json.dumps(valid))
+      return res
+
+   def manifest_to_file(self, path, note, digest=None):
+      """GET manifest for the image and save it at path, unless the copy
+         already there is current (see manifest_get()). If digest is given,
          use that to fetch the appropriate architecture; otherwise, fetch the
-         default manifest using the exising image reference."""
+         default manifest using the exising image reference. note is the
+         prefix for log messages."""
       if (digest is None):
          digest = self.ref.version
       else:
          digest = "sha256:" + digest
-      url = self._url_of("manifests", digest)
-      pw = ch.Progress_Writer(path, msg)
       accept = "%s;q=0.5" % ",".join(TYPES_MANIFEST.values())
-      res = self.request("GET", url, out=pw, statuses={200, 401, 404},
-                         headers={ "Accept" : accept })
-      pw.close()
-      if (res.status_code != 200):
+      res = self.manifest_get(path, note, digest, {200, 401, 404}, accept)
+      if (res is None):
+         return
+      if (res.status_code not in {200, 304}):
          ch.DEBUG(res.content)
          raise ch.Image_Unavailable_Error()
 
-   def manifest_upload(self, manifest):
-      "Upload manifest (sequence of bytes)."
+   def manifest_upload(self, manifest, type_=TYPES_MANIFEST["docker2"]):
+      "Upload manifest (sequence of bytes) with content type type_."
       # Note: The manifest is *not* uploaded as a blob. We just do one PUT.
       ch.INFO("manifest: uploading")
       url = self._url_of("manifests", self.ref.tag)
       self.request("PUT", url, {201}, data=manifest,
-                   headers={ "Content-Type": TYPES_MANIFEST["docker2"] })
+                   headers={ "Content-Type": type_ },
+                   retry_restart=lambda kwargs: url)  # whole manifest is safe
 
    def request(self, method, url, statuses={200}, out=None, hd=None, **kwargs):
       """Request url using method and return the response object. If statuses
          is given, it is set of acceptable response status codes, defaulting
          to {200}; any other response is a fatal error. If out is given,
          response content will be streamed to this Progress_Writer object and
-         must be non-zero length. If hd is given, validate integrity of
-         downloaded data using expected hash digest.
+         must be non-zero length; HTTP 206 Partial Content is appended to the
+         data already in out (see blob_to_file()). If hd is given, validate
+         integrity of downloaded data using expected hash digest.
 
          Use current session if there is one, or start a new one if not. If
          authentication fails (or isn’t initialized), then authenticate harder
-         and re-try the request."""
+         and re-try the request. Transient failures are retried (see
+         request_raw()); this includes interrupted streaming of the response
+         content, which resumes where it left off if the server supports
+         range requests. All of these share one count of retries, so the
+         request as a whole is retried at most --retries times."""
       # Set up.
       assert (out or hd is None), "digest only checked if streaming"
       self.session_init_maybe()
       ch.VERBOSE("auth: %s" % self.auth)
       if (out is not None):
          kwargs["stream"] = True
-      # Make the request.
+      attempts = [0]
       while True:
-         res = self.request_raw(method, url, statuses | {401}, **kwargs)
-         if (res.status_code != 401):
-            break
-         else:
-            ch.VERBOSE("HTTP 401 unauthorized")
-            if (self.escalate(res)):   # success
-               ch.VERBOSE("retrying with auth: %s" % self.auth)
-            elif (401 in statuses):    # caller can deal with it
+         # Make the request.
+         while True:
+            auth = self.auth
+            res = self.request_raw(method, url, statuses | {401}, auth=auth,
+                                   attempts=attempts, **kwargs)
+            if (res.status_code != 401):
                break
             else:
-               ch.FATAL("unhandled authentication failure")
-      # Stream response if needed.
-      m = hashlib.sha256()
-      if (out is not None and res.status_code == 200):
+               ch.VERBOSE("HTTP 401 unauthorized")
+               with self.lock:
+                  if (self.auth is not auth):
+                     # Another thread escalated while our request was in
+                     # flight.
+                     ch.VERBOSE("retrying with auth: %s" % self.auth)
+                     continue
+                  if (self.auth.stale_p):
+                     ch.VERBOSE("discarding stale auth: %s" % self.auth)
+                     self.token_forget()
+                     self.auth = Auth_None()
+                     continue
+                  escalated_p = self.escalate(res)
+               if (escalated_p):          # success
+                  ch.VERBOSE("retrying with auth: %s" % self.auth)
+               elif (401 in statuses):    # caller can deal with it
+                  break
+               else:
+                  ch.FATAL("unhandled authentication failure")
+         # Stream response if needed.
+         m = hashlib.sha256()
+         if (out is not None and res.status_code == 206):
+            # Resuming. Check that we got the range we asked for, then
+            # continue the hash from the data already on disk.
+            cr = res.headers.get("Content-Range", "")
+            cr_m = re.search(r"^bytes (\d+)-\d+/(\d+|\*)$", cr)
+            if (cr_m is None or int(cr_m[1]) != out.offset):
+               out.discard()
+               ch.FATAL("invalid Content-Range in partial response: %s" % cr)
+            length = None if cr_m[2] == "*" else int(cr_m[2])
+            m = out.path_tmp.file_hasher()
+            ch.VERBOSE("resuming with %d bytes already downloaded"
+                       % out.offset)
+            out.start(length, resume_p=True)
+         elif (out is not None and res.status_code == 200):
+            if (out.offset > 0):
+               ch.VERBOSE("server ignored range; downloading from start")
+            try:
+               length = int(res.headers["Content-Length"])
+            except KeyError:
+               length = None
+            except ValueError:
+               ch.FATAL("invalid Content-Length in response")
+            out.start(length)
+         if (out is not None and res.status_code in {200, 206}):
+            try:
+               for chunk in res.iter_content(ch.HTTP_CHUNK_SIZE):
+                  out.write(chunk)
+                  m.update(chunk) # store downloaded hash digest
+            except requests.exceptions.RequestException as x:
+               # Keep what we have and ask for the rest.
+               problem = "%s interrupted: %s" % (method, x)
+               if (not self.retry_wait(attempts[0], problem)):
+                  ch.FATAL(problem)
+               attempts[0] += 1
+               out.suspend()
+               kwargs["headers"] = dict(kwargs.get("headers", {}),
+                                        Range="bytes=%d-" % out.offset)
+               statuses = statuses | {206}
+               continue
+            # Validate integrity of downloaded data. Delete bad data so a
+            # later attempt doesn’t resume from it.
+            if (hd is not None and hd != m.hexdigest()):
+               out.discard()
+               ch.FATAL("registry streamed response content is invalid",
+                        "partial download deleted; try again")
+         # Done.
+         return res
+
+   def request_mirrored(self, method, type_, address, statuses={200},
+                        out=None, hd=None, **kwargs):
+      """Request the repository URL for type_ and address (see _url_of())
+         using method, which must not change anything (e.g., GET or HEAD),
+         and return the response object. Other arguments are as for
+         request().
+
+         Try each mirror in order first, if any. Failing to get a response
+         from a mirror with an acceptable status other than 401, 404, or 429
+         (e.g., connection error, timeout, bad status, authentication
+         failure, content that doesn’t match hd, or an error partway through
+         the content) is a miss, and we go on to the next mirror, then finally
+         the registry itself. Any content a mirror did send is discarded
+         first (see Progress_Writer.reset()), so the next source starts from
+         scratch rather than appending to it."""
+      for reg in self.mirrors:
          try:
-            length = int(res.headers["Content-Length"])
-         except KeyError:
-            length = None
-         except ValueError:
-            ch.FATAL("invalid Content-Length in response")
-         out.start(length)
-         for chunk in res.iter_content(ch.HTTP_CHUNK_SIZE):
-            out.write(chunk)
-            m.update(chunk) # store downloaded hash digest
-         # Validate integrity of downloaded data
-         if (hd is not None and hd != m.hexdigest()):
-            ch.FATAL("registry streamed response content is invalid")
-      # Done.
-      return res
-
-   def request_raw(self, method, url, statuses, auth=None, **kwargs):
+            res = reg.request(method, reg._url_of(type_, address),
+                              statuses - {401, 404, 429}, out, hd, **kwargs)
+            with self.lock:
+               reg.hits += 1
+            ch.VERBOSE("mirror hit: %s" % reg.mirror)
+            return res
+         except ch.Fatal_Error as x:
+            with self.lock:
+               reg.misses += 1
+            ch.VERBOSE("mirror miss: %s: %s" % (reg.mirror, x.args[0]))
+            if (out is not None):
+               out.reset()
+            if (out is not None and out.offset == 0 and "headers" in kwargs):
+               # Partial data was discarded; don’t ask for a range.
+               kwargs["headers"] = { k:v for (k,v) in kwargs["headers"].items()
+                                     if k != "Range" }
+      return self.request(method, self._url_of(type_, address), statuses,
+                          out, hd, **kwargs)
+
+   def request_raw(self, method, url, statuses, auth=None,
+                   retry_restart=None, attempts=None, **kwargs):
       """Request url using method. statuses is an iterable of acceptable
          response status codes; any other response is a fatal error. Return
          the requests.Response object.
 
          Session must already exist. If auth arg given, use it; otherwise, use
          object’s stored authentication if initialized; otherwise, use no
-         authentication."""
-      ch.VERBOSE("%s: %s" % (method, url))
+         authentication.
+
+         Transient failures, i.e. exceptions such as connection errors and
+         timeouts, or unacceptable statuses in STATUSES_TRANSIENT, are
+         retried with backoff (see retry_wait()) if the request can be safely
+         repeated. GET and HEAD can be; other methods only if retry_restart
+         is given, which is a function called before each retry with the
+         request’s keyword arguments, which it may change (e.g., to send
+         different data), and returns the URL to use, e.g. after rewinding
+         data or starting a new upload. If attempts is given, it is a
+         one-element list holding the number of retries so far, which is
+         updated in place so the caller can share the count."""
       if (auth is None):
          auth = self.auth
-      try:
-         res = self.session.request(method, url, auth=auth, **kwargs)
-         ch.VERBOSE("response status: %d" % res.status_code)
-         self.headers_log(res.headers)
-         if (res.status_code not in statuses):
-            ch.FATAL("%s failed; expected status %s but got %d: %s"
-                  % (method, statuses, res.status_code, res.reason))
-      except requests.exceptions.RequestException as x:
-         ch.FATAL("%s failed: %s" % (method, x))
-      return res
+      if (self.mirror is not None):
+         kwargs.setdefault("timeout", self.mirror.timeout)
+      retry_p = (method in {"GET", "HEAD"} or retry_restart is not None)
+      if (attempts is None):
+         attempts = [0]
+      while True:
+         ch.VERBOSE("%s: %s" % (method, url))
+         res = None
+         try:
+            res = self.session.request(method, url, auth=auth, **kwargs)
+            ch.VERBOSE("response status: %d" % res.status_code)
+            self.headers_log(res.headers)
+            if (res.status_code in statuses):
+               return res
+            problem = ("%s failed; expected status %s but got %d: %s"
+                       % (method, statuses, res.status_code, res.reason))
+            transient_p = (res.status_code in STATUSES_TRANSIENT)
+         except requests.exceptions.RequestException as x:
+            problem = "%s failed: %s" % (method, x)
+            transient_p = True
+         if (not (transient_p and retry_p)
+             or not self.retry_wait(attempts[0], problem, res)):
+            ch.FATAL(problem)
+         attempts[0] += 1
+         if (retry_restart is not None):
+            url = retry_restart(kwargs)
+
+   def retry_wait(self, attempt, problem, res=None):
+      """Sleep before retrying a request that failed transiently because of
+         problem (string), with attempt being the number of retries so far.
+         If response res has a Retry-After header, wait that long; otherwise,
+         use exponential backoff with “full jitter” [1]. Return True after
+         sleeping, or False if we should give up instead, i.e. if out of
+         retries or Retry-After exceeds the maximum delay. Mirrors are never
+         retried, because we can just go on to the next one.
+
+         [1]: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/"""
+      global retry_ct, retry_secs
+      if (self.mirror is not None or attempt >= retries):
+         return False
+      delay = None
+      if (res is not None and "Retry-After" in res.headers):
+         delay = retry_after_parse(res.headers["Retry-After"])
+         if (delay is not None and delay > retry_delay_max):
+            ch.VERBOSE("Retry-After longer than maximum delay: %ds" % delay)
+            return False
+      if (delay is None):
+         delay = random.uniform(0, min(retry_delay_max,
+                                       retry_delay_base * 2**attempt))
+      ch.INFO("%s; retrying in %.1fs (%d/%d)"
+              % (problem, delay, attempt + 1, retries))
+      time.sleep(delay)
+      with retry_lock:
+         retry_ct += 1
+         retry_secs += delay
+      return True
 
    def session_init_maybe(self):
-      "Initialize session if it’s not initialized; otherwise do nothing."
+      """Initialize session if it’s not initialized; otherwise do nothing.
+         Start with a cached token if there is one."""
       if (self.session is None):
          ch.VERBOSE("initializing session")
          self.session = requests.Session()
          self.session.verify = tls_verify
+         self.token_load()
+
+   def token_forget(self):
+      "Remove our token from the token cache, if it’s there."
+      key = self.token_key
+      with tokens_lock:
+         tokens = tokens_load()
+         if (key in tokens):
+            ch.VERBOSE("removing from token cache: %s" % key)
+            del tokens[key]
+            tokens_save(tokens)
+
+   def token_load(self):
+      """If there is a suitable token in the token cache, start with it
+         rather than no authorization."""
+      key = self.token_key
+      if (key is None):
+         return
+      t = tokens_load().get(key)
+      if (t is None):
+         ch.VERBOSE("token cache miss: %s" % key)
+         return
+      classes = { c.__name__:c for c in (Auth_Bearer_Anon, Auth_Bearer_IDed) }
+      class_ = classes[t["class"]]
+      if (class_.auth_p != auth_p):
+         return
+      self.auth = class_(t["token"], t["auth_d"], t["expires"], cached_p=True)
+      ch.VERBOSE("token cache hit: %s: %s" % (key, self.auth))
+
+   def token_save(self):
+      "If our authorization is a bearer token, save it in the token cache."
+      key = self.token_key
+      if (key is None or not isinstance(self.auth, Auth_Bearer_IDed)):
+         return
+      with tokens_lock:
+         tokens = tokens_load()
+         tokens[key] = { "class": self.auth.__class__.__name__,
+                         "token": self.auth.token,
+                         "auth_d": self.auth.auth_d,
+                         "expires": self.auth.expires }
+         tokens_save(tokens)
+      ch.VERBOSE("saved to token cache: %s" % key)
+
+   def upload_chunks(self, url, data):
+      """Upload data, a Progress_Reader, to the upload session at url in
+         chunks of upload_chunk_size bytes, and return the URL to finish the
+         upload at. If sending a chunk fails transiently, ask the session how
+         much data it has and resume from there."""
+      offset = 0
+      chunk = data.read(upload_chunk_size)
+      def resume(kwargs):
+         nonlocal chunk, offset, url
+         (url, offset) = self.upload_status(url)
+         ch.INFO("resuming upload at byte %d" % offset)
+         data.rewind(offset)
+         chunk = data.read(upload_chunk_size)
+         kwargs.update(self.upload_chunk_args(chunk, offset))
+         return url
+      while (len(chunk) > 0):
+         res = self.request("PATCH", url, {202}, retry_restart=resume,
+                            **self.upload_chunk_args(chunk, offset))
+         url = self.location(res)
+         offset += len(chunk)
+         chunk = data.read(upload_chunk_size)
+      return url
+
+   def upload_start(self):
+      "Start an upload session and return its URL."
+      res = self.request("POST", self._url_of("blobs", "uploads/"), {202})
+      return self.location(res)
+
+   def upload_status(self, url):
+      """Ask the upload session at url how much data it has. Return a tuple:
+         the URL to continue at and the number of bytes received."""
+      res = self.request("GET", url, {204})
+      # The Range header is “0-N”, where N is the last byte received.
+      # Unfortunately, if there’s zero or one byte, it’s “0-0” in both
+      # cases; assume zero, since one-byte chunks seem unlikely.
+      m = re.search(r"^(?:bytes=)?0-(\d+)$", res.headers.get("Range", "0-0"))
+      if (m is None):
+         ch.FATAL("invalid Range in upload status: %s" % res.headers["Range"])
+      end = int(m[1])
+      if ("Location" in res.headers):
+         url = self.location(res)
+      return (url, 0 if end == 0 else end + 1)
+
+class Mirror:
+   """Registry to try before the one in the image reference when pulling,
+      e.g. a site-local pull-through cache. Specified as
+      “[SCHEME://]HOST[:PORT][/PREFIX][@TIMEOUT]”, where SCHEME is “https”
+      (default) or “http” and TIMEOUT is in seconds, e.g.:
+
+        >>> str(Mirror("mirror.example.com"))
+        'https://mirror.example.com:443/v2/'
+        >>> m = Mirror("http://10.0.0.1:5000/hub/@2.5")
+        >>> str(m)
+        'http://10.0.0.1:5000/hub/v2/'
+        >>> m.timeout
+        2.5"""
+
+   __slots__ = ("timeout",
+                "url_base")
+
+   def __init__(self, spec):
+      m = re.search(r"^(?:(https?)://)?([^/:@]+)(?::(\d+))?(/[^@]*)?"
+                    + r"(?:@(\d+(?:\.\d*)?))?$", spec)
+      if (m is None):
+         ch.FATAL("invalid mirror: %s" % spec)
+      scheme = m[1] or "https"
+      port = int(m[3]) if m[3] else (80 if scheme == "http" else 443)
+      prefix = (m[4] or "").rstrip("/")
+      self.url_base = "%s://%s:%d%s/v2/" % (scheme, m[2], port, prefix)
+      self.timeout = float(m[5]) if m[5] else MIRROR_TIMEOUT_DEFAULT
+
+   def __str__(self):
+      return self.url_base
+
+
+class Upload_Writer:
+   """Binary file-like object that uploads data written to it as a blob,
+      using a chunked upload session [1], so the data need not be stored
+      anywhere first. Data are sent upload_chunk_size bytes at a time (or
+      UPLOAD_CHUNK_SIZE_DEFAULT if that’s zero, because we can’t hold
+      arbitrarily much in memory). Call close() with the blob’s digest,
+      typically computed along the way, to finish the upload.
+
+      [1]: https://github.com/opencontainers/distribution-spec/blob/main/spec.md#pushing-a-blob-in-chunks"""
+
+   __slots__ = ("buf",
+                "chunk_size",
+                "offset",      # bytes sent so far
+                "progress",
+                "reg",         # HTTP object
+                "url")         # where to send the next chunk
+
+   def __init__(self, reg, url, msg):
+      self.buf = bytearray()
+      self.chunk_size = upload_chunk_size or UPLOAD_CHUNK_SIZE_DEFAULT
+      self.offset = 0
+      self.progress = ch.Progress(msg, "MiB", 2**20, None)
+      self.reg = reg
+      self.url = url
+
+   def chunk_send(self):
+      "Send buffered data, if any, as the next chunk."
+      if (len(self.buf) == 0):
+         return
+      start = self.offset
+      def resume(kwargs):
+         # The registry may have some of the chunk already; send the rest.
+         nonlocal start
+         (self.url, start) = self.reg.upload_status(self.url)
+         ch.INFO("resuming upload at byte %d" % start)
+         if (not self.offset <= start <= self.offset + len(self.buf)):
+            ch.FATAL("can’t resume upload at byte %d" % start)
+         kwargs.update(self.reg.upload_chunk_args(
+                          bytes(self.buf[start - self.offset:]), start))
+         return self.url
+      res = self.reg.request("PATCH", self.url, {202}, retry_restart=resume,
+                             **self.reg.upload_chunk_args(bytes(self.buf),
+                                                          start))
+      self.url = self.reg.location(res)
+      self.offset += len(self.buf)
+      self.progress.update(len(self.buf))
+      self.buf.clear()
+
+   def close(self, digest):
+      """Send remaining data, then finish the upload, telling the registry to
+         expect hash digest, and verify it worked."""
+      self.chunk_send()
+      url = self.url
+      self.reg.request("PUT", url, {201},
+                       params={ "digest": "sha256:%s" % digest },
+                       retry_restart=lambda kwargs: url)
+      self.progress.done()
+      if (not self.reg.blob_exists_p(digest)):
+         ch.FATAL("blob just uploaded does not exist: %s" % digest[:7])
+
+   def flush(self):
+      pass  # we send data only in whole chunks, except the last
+
+   def write(self, data):
+      self.buf += data
+      if (len(self.buf) >= self.chunk_size):
+         self.chunk_send()
+      return len(data)
@@ -248,6 +248,490 @@ EOF
     cd -
 }
 
+@test 'pull with concurrent downloads' {
+    arch_exclude aarch64  # test image not available
+    arch_exclude ppc64le  # test image not available
+    # file-quirks has several layers, so it exercises the worker pool.
+    storage="${BATS_TMPDIR}/pull-jobs"
+    img=charliecloud/file-quirks:2020-10-21
+    img_path="${storage}/img/charliecloud%file-quirks+2020-10-21"
+
+    # serial
+    rm -Rf --one-file-system "$storage"
+    run ch-image -s "$storage" --no-cache --download-jobs=1 pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output != *'blobs with'* ]]
+    ls -lR "$img_path" | sort > "${BATS_TMPDIR}/pull-jobs.1.txt"
+
+    # concurrent
+    rm -Rf --one-file-system "$storage"
+    run ch-image -s "$storage" --no-cache -v --download-jobs=4 pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'downloading '*' blobs with 4 workers'* ]]
+    ls -lR "$img_path" | sort > "${BATS_TMPDIR}/pull-jobs.4.txt"
+    diff -u "${BATS_TMPDIR}/pull-jobs.1.txt" "${BATS_TMPDIR}/pull-jobs.4.txt"
+
+    # invalid
+    run ch-image -s "$storage" --download-jobs=0 pull "$img"
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'--download-jobs must be at least 1: 0'* ]]
+
+    rm -Rf --one-file-system "$storage"
+}
+
+@test 'pull with partial download' {
+    storage="${BATS_TMPDIR}/pull-partial"
+    img=alpine:3.17
+    dlcache="${storage}/dlcache"
+
+    rm -Rf --one-file-system "$storage"
+    ch-image -s "$storage" --no-cache pull "$img"
+    layer=$(cd "$dlcache" && ls -1 *.tar.gz | head -1)
+    hash=${layer%.tar.gz}
+    size=$(stat -c %s "${dlcache}/${layer}")
+
+    # truncated partial file: ask for the rest, and the digest verifies
+    head -c $((size / 2)) "${dlcache}/${layer}" > "${dlcache}/part_${layer}"
+    rm "${dlcache}/${layer}"
+    run ch-image -v -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *"resuming partial download at byte $((size / 2))"* ]]
+    [[ ! -e ${dlcache}/part_${layer} ]]
+    [[ $(sha256sum "${dlcache}/${layer}" | cut -d' ' -f1) = "$hash" ]]
+
+    # partial file that is actually complete: registry may say 416 or send
+    # the whole blob again; either way, we end up with a good blob
+    mv "${dlcache}/${layer}" "${dlcache}/part_${layer}"
+    run ch-image -v -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *"resuming partial download at byte ${size}"* ]]
+    [[ $(sha256sum "${dlcache}/${layer}" | cut -d' ' -f1) = "$hash" ]]
+
+    # --always-download starts over
+    head -c $((size / 2)) "${dlcache}/${layer}" > "${dlcache}/part_${layer}"
+    rm "${dlcache}/${layer}"
+    run ch-image -v -s "$storage" --no-cache --always-download pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output != *'resuming partial download'* ]]
+    [[ $(sha256sum "${dlcache}/${layer}" | cut -d' ' -f1) = "$hash" ]]
+
+    rm -Rf --one-file-system "$storage"
+}
+
+@test 'pull --stream' {
+    arch_exclude aarch64  # test image not available
+    arch_exclude ppc64le  # test image not available
+    storage="${BATS_TMPDIR}/pull-stream"
+    img=charliecloud/file-quirks:2020-10-21
+    img_path="${storage}/img/charliecloud%file-quirks+2020-10-21"
+
+    # reference: list after download
+    rm -Rf --one-file-system "$storage"
+    ch-image -s "$storage" --no-cache pull "$img"
+    ls -lR "$img_path" | sort > "${BATS_TMPDIR}/pull-stream.1.txt"
+
+    # list while downloading
+    rm -Rf --one-file-system "$storage"
+    run ch-image -s "$storage" --no-cache pull --stream "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'listed while downloading'* ]]
+    [[ $output != *': listing'* ]]
+    ls -lR "$img_path" | sort > "${BATS_TMPDIR}/pull-stream.2.txt"
+    diff -u "${BATS_TMPDIR}/pull-stream.1.txt" "${BATS_TMPDIR}/pull-stream.2.txt"
+
+    # layers already downloaded use the listing cached while downloading
+    run ch-image -s "$storage" --no-cache pull --stream "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'using existing file'* ]]
+    [[ $output = *'using cached listing'* ]]
+
+    rm -Rf --one-file-system "$storage"
+}
+
+@test 'pull --from-file' {
+    storage="${BATS_TMPDIR}/pull-many"
+    list="${BATS_TMPDIR}/pull-many.txt"
+    cat <<'EOF' > "$list"
+# same image twice, so all blobs are shared
+alpine:3.17
+alpine:3.17  pull-many-copy   # with destination
+
+EOF
+
+    rm -Rf --one-file-system "$storage"
+    run ch-image -s "$storage" --no-cache pull --parse-only --from-file "$list"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $(echo "$output" | grep -Fc 'alpine') -ge 2 ]]
+
+    run ch-image -s "$storage" --no-cache pull --from-file "$list"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'downloading 2 unique blobs for 2 images'* ]]
+    ch-image -s "$storage" list | grep -Fx alpine:3.17
+    ch-image -s "$storage" list | grep -Fx pull-many-copy
+
+    # errors
+    run ch-image -s "$storage" pull --from-file "$list" alpine:3.17
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'--from-file incompatible with IMAGE_REF'* ]]
+    echo 'alpine:3.17' >> "$list"
+    run ch-image -s "$storage" pull --from-file "$list"
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'pull-many.txt:5: duplicate destination: alpine:3.17'* ]]
+    run ch-image -s "$storage" pull
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'no image to pull'* ]]
+
+    rm -Rf --one-file-system "$storage" "$list"
+}
+
+@test 'pull with retries' {
+    storage="${BATS_TMPDIR}/pull-retries"
+    img=alpine:3.17
+
+    rm -Rf --one-file-system "$storage"
+    run ch-image -v -s "$storage" --no-cache --retries=2 --retry-delay=0.5:4 \
+                 pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'registry retries: 2, delay 0.5 to 4s'* ]]
+
+    # invalid options
+    run ch-image -s "$storage" --retries=-1 pull "$img"
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'--retries must be non-negative: -1'* ]]
+    run ch-image -s "$storage" --retry-delay=soon pull "$img"
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'--retry-delay: can’t parse: soon'* ]]
+
+    # Go through a proxy that refuses the first connection, so the pull must
+    # retry once and then succeed.
+    [[ -z $HTTPS_PROXY && -z $https_proxy ]] || skip 'already using a proxy'
+    rm -Rf --one-file-system "$storage"
+    python3 - > "${storage}.port" 3>&- <<'EOF' &
+import socket, threading
+ls = socket.socket()
+ls.bind(("127.0.0.1", 0))
+ls.listen()
+print(ls.getsockname()[1], flush=True)
+def pipe(a, b):
+   try:
+      while (data := a.recv(65536)):
+         b.sendall(data)
+   except OSError:
+      pass
+   finally:
+      b.close()
+def serve(c, fail_p):
+   f = c.makefile("rb")
+   (_, hostport, _) = f.readline().split()
+   while f.readline().strip():
+      pass
+   if (fail_p):
+      c.sendall(b"HTTP/1.1 503 Service Unavailable\r\n\r\n")
+      c.close()
+      return
+   (host, port) = hostport.decode().rsplit(":", 1)
+   u = socket.create_connection((host, int(port)))
+   c.sendall(b"HTTP/1.1 200 Connection established\r\n\r\n")
+   threading.Thread(target=pipe, args=(u, c), daemon=True).start()
+   pipe(c, u)
+fail_p = True
+while True:
+   (c, _) = ls.accept()
+   threading.Thread(target=serve, args=(c, fail_p), daemon=True).start()
+   fail_p = False
+EOF
+    proxy_pid=$!
+    while [[ ! -s ${storage}.port ]]; do sleep 0.1; done
+    run env HTTPS_PROXY="http://127.0.0.1:$(cat "${storage}.port")" \
+            ch-image -s "$storage" --no-cache --retries=2 \
+                     --retry-delay=0.5:4 pull "$img"
+    kill "$proxy_pid"
+    rm -f "${storage}.port"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'503 Service Unavailable'*'; retrying in '*'s (1/2)'* ]]
+    [[ $output = *'registry requests retried 1 times, waiting '* ]]
+
+    rm -Rf --one-file-system "$storage"
+}
+
+@test 'pull with cached token' {
+    storage="${BATS_TMPDIR}/pull-token"
+    img=alpine:3.17
+
+    rm -Rf --one-file-system "$storage"
+    run ch-image -v -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'saved to token cache: '*' anonymous'* ]]
+    [[ $(stat -c %a "${storage}/tokens.json") = 600 ]]
+
+    run ch-image -v -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'token cache hit: '*' anonymous: Bearer (Anon)'* ]]
+
+    # malformed entry is skipped, not fatal
+    cat > "${storage}/tokens.json" <<'EOF'
+{ "bogus": { "class": "Auth_Bearer_Anon" } }
+EOF
+    run ch-image -v -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'ignoring malformed token cache entry: bogus'* ]]
+
+    rm -Rf --one-file-system "$storage"
+}
+
+@test 'pull unchanged manifest' {
+    storage="${BATS_TMPDIR}/pull-etag"
+    img=alpine:3.17
+
+    rm -Rf --one-file-system "$storage"
+    run ch-image -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'manifest: downloading'* ]]
+    ls "${storage}"/dlcache/*.validators
+
+    # second pull should not download the manifest body
+    run ch-image -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'manifest list: unchanged, using existing file'* ]]
+    [[ $output = *'manifest: using existing file'* ]]
+
+    # unless asked to
+    run ch-image -s "$storage" --no-cache --always-download pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'manifest: downloading'* ]]
+
+    rm -Rf --one-file-system "$storage"
+}
+
+@test 'pull with cached layer listing' {
+    storage="${BATS_TMPDIR}/pull-listing"
+    img=alpine:3.17
+
+    rm -Rf --one-file-system "$storage"
+    run ch-image -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'layer 1/1: '*': listing'* ]]
+    ls "${storage}"/dlcache/*.listing
+
+    # second pull should use the saved listing
+    run ch-image -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'layer 1/1: '*': using cached listing'* ]]
+
+    # bad listing is ignored and replaced
+    for f in "${storage}"/dlcache/*.listing; do
+        echo garbage > "$f"
+    done
+    run ch-image -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'layer 1/1: '*': listing'* ]]
+    run ch-image -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'layer 1/1: '*': using cached listing'* ]]
+
+    rm -Rf --one-file-system "$storage"
+}
+
+@test 'pull with --unpack-jobs' {
+    arch_exclude aarch64  # test image not available
+    arch_exclude ppc64le  # test image not available
+    storage="${BATS_TMPDIR}/pull-unpack-jobs"
+    name=charliecloud/metadata:2021-01-15
+    img=${storage}/img/charliecloud%metadata+2021-01-15
+
+    # serial and parallel extraction should give the same tree
+    rm -Rf --one-file-system "$storage"
+    ch-image -s "$storage" --no-cache --unpack-jobs=1 pull "$name"
+    (cd "$img" && find . -path ./ch -prune -o -printf '%p %y %m %s %l %n\n' \
+                  | sort) > "${BATS_TMPDIR}/unpack-jobs.1"
+    run ch-image -s "$storage" --no-cache -v --unpack-jobs=4 pull "$name"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'unpack jobs: 4'* ]]
+    (cd "$img" && find . -path ./ch -prune -o -printf '%p %y %m %s %l %n\n' \
+                  | sort) > "${BATS_TMPDIR}/unpack-jobs.4"
+    diff -u "${BATS_TMPDIR}/unpack-jobs.1" "${BATS_TMPDIR}/unpack-jobs.4"
+
+    # bad job count
+    run ch-image -s "$storage" --unpack-jobs=0 pull "$name"
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'--unpack-jobs must be at least 1: 0'* ]]
+
+    rm -Rf --one-file-system "$storage"
+}
+
+@test 'pull with --unpack-backend' {
+    arch_exclude aarch64  # test image not available
+    arch_exclude ppc64le  # test image not available
+    storage="${BATS_TMPDIR}/pull-unpack-backend"
+    name=charliecloud/metadata:2021-01-15
+    img=${storage}/img/charliecloud%metadata+2021-01-15
+
+    # both backends should give the same tree, apart from some mtimes
+    rm -Rf --one-file-system "$storage"
+    for backend in python tar; do
+        run ch-image -s "$storage" --no-cache -v --unpack-backend="$backend" \
+                     pull "$name"
+        echo "$output"
+        [[ $status -eq 0 ]]
+        [[ $output = *"unpack backend: ${backend}"* ]]
+        (cd "$img" && find . -path ./ch -prune -o -printf '%p %y %m %s %l %n\n' \
+                      | sort) > "${BATS_TMPDIR}/unpack-backend.${backend}"
+    done
+    diff -u "${BATS_TMPDIR}/unpack-backend.python" \
+            "${BATS_TMPDIR}/unpack-backend.tar"
+
+    # invalid backend
+    run env CH_IMAGE_UNPACK_BACKEND=foo ch-image -s "$storage" pull "$name"
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'--unpack-backend: invalid backend: foo'* ]]
+
+    rm -Rf --one-file-system "$storage"
+}
+
+@test 'pull with --unpack-snapshots' {
+    storage="${BATS_TMPDIR}/pull-unpack-snapshots"
+    img=alpine:3.17
+    rm -Rf --one-file-system "$storage"
+
+    # second image with the same layers saves a snapshot
+    ch-image -s "$storage" --no-cache --unpack-snapshots 2 pull "$img" snap-a
+    run ch-image -s "$storage" --no-cache --unpack-snapshots 2 \
+                 pull "$img" snap-b
+    echo "$output"
+    [[ $status -eq 0 ]]
+    if [[ $output = *'can’t reflink'* ]]; then
+        rm -Rf --one-file-system "$storage"
+        skip 'no reflink support in storage directory'
+    fi
+    [[ $output = *'saving snapshot'* ]]
+
+    # third one copies it rather than extracting
+    run ch-image -s "$storage" --no-cache --unpack-snapshots 2 \
+                 pull "$img" snap-c
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'copying snapshot'* ]]
+    [[ $output != *'extracting'* ]]
+    for i in a c; do
+        (cd "${storage}/img/snap-${i}" \
+         && find . -path ./ch -prune -o -printf '%p %y %m %s %l %n\n' \
+            | sort) > "${BATS_TMPDIR}/unpack-snapshots.${i}"
+    done
+    diff -u "${BATS_TMPDIR}/unpack-snapshots.a" \
+            "${BATS_TMPDIR}/unpack-snapshots.c"
+
+    # deleting the images that use it evicts the snapshot
+    run ch-image -s "$storage" delete snap-a snap-b snap-c
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'layer snapshots: evicted 1, 0 remain'* ]]
+    [[ $(ls -1 "${storage}/sncache") = chains.json ]]
+
+    # invalid count
+    run ch-image -s "$storage" --unpack-snapshots -1 pull "$img" snap-d
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'--unpack-snapshots must be non-negative: -1'* ]]
+
+    rm -Rf --one-file-system "$storage"
+}
+
+@test 'pull with shared download cache' {
+    storage="${BATS_TMPDIR}/pull-shared"
+    shared="${BATS_TMPDIR}/pull-shared.dlcache"
+    img=alpine:3.17
+
+    # populate shared download cache from a different storage directory
+    rm -Rf --one-file-system "$storage" "$shared"
+    ch-image -s "$shared" --no-cache pull "$img"
+
+    # no network for blobs
+    run env CH_IMAGE_SHARED_DLCACHE="${shared}/dlcache" \
+            ch-image -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'config: using shared file'* ]]
+    [[ $output = *'layer 1/1: '*': using shared file'* ]]
+    # manifests aren’t shared, so only the blobs skip downloading
+    [[ $output != *'config: downloading'* ]]
+    [[ $output != *'layer 1/1: '*': downloading'* ]]
+    ch-image -s "$storage" list | grep -F "$img"
+
+    # not consulted with --always-download
+    run env CH_IMAGE_SHARED_DLCACHE="${shared}/dlcache" \
+            ch-image -s "$storage" --no-cache --always-download pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output != *'using shared file'* ]]
+
+    # relative path is an error
+    run env CH_IMAGE_SHARED_DLCACHE=foo \
+            ch-image -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'CH_IMAGE_SHARED_DLCACHE: not absolute path: foo'* ]]
+
+    rm -Rf --one-file-system "$storage" "$shared"
+}
+
+@test 'pull with mirrors' {
+    storage="${BATS_TMPDIR}/pull-mirror"
+    img=alpine:3.17
+    # Nothing listens on port 1, so this mirror always misses.
+    mirror=http://127.0.0.1:1@1
+    regy=registry-1.docker.io
+    [[ -z $CH_REGY_DEFAULT_HOST ]] || regy=$CH_REGY_DEFAULT_HOST
+
+    rm -Rf --one-file-system "$storage"
+    run ch-image -v -s "$storage" --no-cache --mirror "${regy}=${mirror}" \
+                 pull "$img"
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *"mirrors for ${regy}: http://127.0.0.1:1/v2/"* ]]
+    [[ $output = *'mirror miss: http://127.0.0.1:1/v2/'* ]]
+    [[ $output = *'mirror http://127.0.0.1:1/v2/: 0 hits, '*' misses'* ]]
+    ch-image -s "$storage" list | grep -F "$img"
+
+    # invalid mirror
+    run env CH_IMAGE_MIRRORS="${regy}=foo@bar" \
+            ch-image -s "$storage" --no-cache pull "$img"
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'invalid mirror: foo@bar'* ]]
+
+    rm -Rf --one-file-system "$storage"
+}
+
 @test 'pull images with uncommon manifests' {
     arch_exclude aarch64  # test image not available
     arch_exclude ppc64le  # test image not available
@@ -555,3 +1039,35 @@ EOF
     [[ $status -eq 1 ]]
     [[ $output = *'registry-1.docker.io:443/charliecloud/metadata:doesnotexist'* ]]
 }
+
+@test 'pull with download cache limit' {
+    storage="${BATS_TMPDIR}/pull-dlcache-max"
+    rm -Rf --one-file-system "$storage"
+
+    # two images; delete the first so its blobs become evictable
+    ch-image -s "$storage" --no-cache pull alpine:3.16
+    ch-image -s "$storage" --no-cache pull alpine:3.17
+    ch-image -s "$storage" delete alpine:3.16
+    run ch-image -s "$storage" --dlcache-max 5M gestalt dlcache
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'limit:     5.0MiB'* ]]
+    [[ $output = *'evictable:'* ]]
+
+    # tiny limit: evict everything not used by alpine:3.17, then warn
+    run ch-image -s "$storage" --no-cache --dlcache-max 1K pull alpine:3.17
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'download cache: evicted '* ]]
+    [[ $output = *'download cache over limit'* ]]
+    ls -1 "${storage}/dlcache" | (! grep -F 'alpine+3.16')
+    ls -1 "${storage}/dlcache" | grep -F 'alpine+3.17'
+
+    # bad size
+    run ch-image -s "$storage" --dlcache-max 5X gestalt dlcache
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'--dlcache-max: invalid size: 5X'* ]]
+
+    rm -Rf --one-file-system "$storage"
+}
@@ -141,3 +141,211 @@ EOF
     [[ $status -eq 0 ]]
     [[ $output = *'weird=al yankovic'* ]]
 }
+
+@test "${tag}: cross-repository mount" {
+    # Make sure the source repository has the layer.
+    ch-image push --tls-no-verify alpine:3.17 localhost:5000/alpine:3.17
+
+    run ch-image -v --tls-no-verify push \
+                 --mount-from localhost:5000/alpine:3.17 \
+                 --mount-from example.com/other \
+                 alpine:3.17 localhost:5000/alpine-mounted:3.17
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'can’t mount from other registry: example.com:443/other'* ]]
+    [[ $output = *'will try mounting layers from: alpine'* ]]
+    # The destination may still have the layer from a previous run.
+    re='layer 1/1: [0-9a-f]{7}: (mounted from alpine|already present)'
+    [[ $output =~ $re ]]
+}
+
+@test "${tag}: re-use prepared layer" {
+    ch-image build -t tmpimg-ulcache - <<'EOF'
+FROM alpine:3.17
+RUN echo foo > /foo
+EOF
+    ch-image push --tls-no-verify tmpimg-ulcache localhost:5000/tmpimg-ulcache
+    ls "${CH_IMAGE_STORAGE}/ulcache/tmpimg-ulcache.tar.gz"
+
+    # unchanged: re-use
+    run ch-image push --tls-no-verify tmpimg-ulcache \
+                                      localhost:5000/tmpimg-ulcache
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'using 1 prepared layer(s) from upload cache'* ]]
+    [[ $output != *'layer 1/1: preparing'* ]]
+
+    # changed outside the build cache: prepare again
+    touch "${CH_IMAGE_STORAGE}/img/tmpimg-ulcache/foo"
+    run ch-image push --tls-no-verify tmpimg-ulcache \
+                                      localhost:5000/tmpimg-ulcache
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'layer 1/1: preparing'* ]]
+
+    # deleting the image deletes the prepared layer
+    ch-image delete tmpimg-ulcache
+    [[ ! -e "${CH_IMAGE_STORAGE}/ulcache/tmpimg-ulcache.tar.gz" ]]
+    [[ ! -e "${CH_IMAGE_STORAGE}/ulcache/tmpimg-ulcache.layers.json" ]]
+}
+
+@test "${tag}: --stream" {
+    ch-image build -t tmpimg-stream - <<'EOF'
+FROM alpine:3.17
+RUN echo streamed > /stream
+EOF
+    rm -f "${CH_IMAGE_STORAGE}/ulcache/tmpimg-stream."*
+
+    run ch-image push --tls-no-verify --stream tmpimg-stream \
+                                                localhost:5000/tmpimg-stream
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'layer 1/1: streaming'* ]]
+    [[ $output != *'layer 1/1: preparing'* ]]
+    # nothing written to the upload cache
+    [[ -z $(ls "${CH_IMAGE_STORAGE}/ulcache") ]]
+
+    # round trip
+    ch-image pull --tls-no-verify localhost:5000/tmpimg-stream
+    ch-run localhost:5000/tmpimg-stream -- cat /stream | grep -Fx streamed
+    ch-image delete tmpimg-stream localhost:5000/tmpimg-stream
+}
+
+@test "${tag}: --chunk-size" {
+    ch-image build -t tmpimg-chunk - <<'EOF'
+FROM alpine:3.17
+RUN dd if=/dev/urandom of=/random bs=1M count=3
+EOF
+    run ch-image -v push --tls-no-verify --chunk-size 1M tmpimg-chunk \
+                                                  localhost:5000/tmpimg-chunk
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'upload chunk size: 1048576'* ]]
+    [[ $(echo "$output" | grep -Fc 'PATCH: ') -ge 3 ]]
+
+    # round trip
+    ch-image pull --tls-no-verify localhost:5000/tmpimg-chunk
+    diff -u <(ch-run tmpimg-chunk -- sha256sum /random) \
+            <(ch-run localhost:5000/tmpimg-chunk -- sha256sum /random)
+    ch-image delete tmpimg-chunk localhost:5000/tmpimg-chunk
+
+    # bad size
+    run ch-image push --chunk-size 1Q tmpimg-chunk
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'--chunk-size: invalid size: 1Q'* ]]
+}
+
+@test "${tag}: --layers base" {
+    ch-image build -t tmpimg-lbase - <<'EOF'
+FROM alpine:3.17
+RUN echo base > /base && echo doomed > /doomed
+EOF
+    ch-image build -t tmpimg-lapp - <<'EOF'
+FROM tmpimg-lbase
+RUN echo app > /app && rm /doomed
+EOF
+
+    run ch-image push --tls-no-verify --layers base tmpimg-lapp \
+                                                    localhost:5000/tmpimg-lapp
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'layers from: alpine:3.17 tmpimg-lbase tmpimg-lapp'* ]]
+    [[ $output = *'layer 3/3: preparing'* ]]
+
+    # round trip, including the deleted file
+    ch-image pull --tls-no-verify localhost:5000/tmpimg-lapp
+    ch-run localhost:5000/tmpimg-lapp -- cat /base /app
+    ch-run localhost:5000/tmpimg-lapp -- test ! -e /doomed
+    ch-image delete tmpimg-lbase tmpimg-lapp localhost:5000/tmpimg-lapp
+}
+
+@test "${tag}: --upload-jobs" {
+    ch-image build -t tmpimg-jbase - <<'EOF'
+FROM alpine:3.17
+RUN dd if=/dev/urandom of=/random1 bs=1M count=2
+EOF
+    ch-image build -t tmpimg-japp - <<'EOF'
+FROM tmpimg-jbase
+RUN dd if=/dev/urandom of=/random2 bs=1M count=2
+EOF
+
+    run ch-image -v push --tls-no-verify --layers base --upload-jobs 3 \
+                         tmpimg-japp localhost:5000/tmpimg-japp
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'checking if 4 blobs already in repository'* ]]
+    # The repository may still have the base layer from a previous run.
+    re='uploading (3 layers with 3|2 layers with 2) workers'
+    [[ $output =~ $re ]]
+
+    # round trip
+    ch-image pull --tls-no-verify localhost:5000/tmpimg-japp
+    diff -u <(ch-run tmpimg-japp -- sha256sum /random1 /random2) \
+            <(ch-run localhost:5000/tmpimg-japp -- sha256sum /random1 /random2)
+
+    # again; everything is already there
+    run ch-image push --tls-no-verify --layers base --upload-jobs 3 \
+                      tmpimg-japp localhost:5000/tmpimg-japp
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output != *'not present, uploading'* ]]
+    ch-image delete tmpimg-jbase tmpimg-japp localhost:5000/tmpimg-japp
+
+    # invalid
+    run ch-image push --upload-jobs 0 tmpimg-japp
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'--upload-jobs must be at least 1: 0'* ]]
+}
+
+@test "${tag}: --compression=zstd" {
+    command -v zstd > /dev/null \
+    || python3 -c 'import zstandard' 2> /dev/null \
+    || skip 'zstd not available'
+    ch-image build -t tmpimg-zstd - <<'EOF'
+FROM alpine:3.17
+RUN echo squeezed > /zstd
+EOF
+
+    run ch-image -v push --tls-no-verify --compression=zstd:5 tmpimg-zstd \
+                                                    localhost:5000/tmpimg-zstd
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'compression: zstd level 5'* ]]
+    [[ -e "${CH_IMAGE_STORAGE}/ulcache/tmpimg-zstd.tar.zst" ]]
+
+    # round trip
+    run ch-image pull --tls-no-verify localhost:5000/tmpimg-zstd
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'decompressing zstd'* ]]
+    ch-run localhost:5000/tmpimg-zstd -- cat /zstd | grep -Fx squeezed
+    ch-image delete tmpimg-zstd localhost:5000/tmpimg-zstd
+
+    # invalid
+    run ch-image push --compression=zstd:99 tmpimg-zstd
+    echo "$output"
+    [[ $status -eq 1 ]]
+    [[ $output = *'--compression: invalid level for zstd, must be 1–22: 99'* ]]
+}
+
+@test "${tag}: pull skips overwritten files" {
+    ch-image build -t tmpimg-obase - <<'EOF'
+FROM alpine:3.17
+RUN echo old > /overwritten
+EOF
+    ch-image build -t tmpimg-oapp - <<'EOF'
+FROM tmpimg-obase
+RUN echo new > /overwritten
+EOF
+    ch-image push --tls-no-verify --layers base tmpimg-oapp \
+                                                localhost:5000/tmpimg-oapp
+
+    run ch-image -v pull --tls-no-verify localhost:5000/tmpimg-oapp
+    echo "$output"
+    [[ $status -eq 0 ]]
+    [[ $output = *'layer 2/3: '*' members overwritten later'* ]]
+    ch-run localhost:5000/tmpimg-oapp -- cat /overwritten | grep -Fx new
+    ch-image delete tmpimg-obase tmpimg-oapp localhost:5000/tmpimg-oapp
+}